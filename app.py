@@ -8,6 +8,7 @@ from __future__ import annotations
 import ctypes
 import json
 import os
+import sqlite3
 import subprocess
 import sys
 import threading
@@ -44,6 +45,7 @@ ENV_PATH     = BASE_DIR / ".env"
 PID_PATH     = BASE_DIR / "monitor.pid"
 LOCK_PATH    = BASE_DIR / "monitor.lock"
 EVENTS_PATH  = BASE_DIR / "events.jsonl"
+DB_PATH      = BASE_DIR / "milhas.db"        # STORAGE=sqlite
 SESSION_PATH = BASE_DIR / "session.session"
 
 # Produção: monitor_bg/monitor_bg.exe (--onedir, sem flash de CMD)
@@ -101,8 +103,11 @@ def write_env_keys(updates: dict):
     for key, val in updates.items():
         if key not in updated:
             lines.append(f"{key}={val}\n")
-    with open(ENV_PATH, "w", encoding="utf-8") as f:
+    # Arquivo temporário + os.replace: o monitor (hot reload) nunca lê um .env pela metade.
+    tmp = ENV_PATH.with_name(ENV_PATH.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
         f.writelines(lines)
+    os.replace(tmp, ENV_PATH)
 
 
 def get_pid():
@@ -180,7 +185,24 @@ def do_stop():
         return False, str(e)
 
 
+def uses_sqlite() -> bool:
+    return read_env().get("STORAGE", "").lower() == "sqlite"
+
+
 def load_events(n: int = 300) -> list:
+    if uses_sqlite():
+        # Só as últimas n linhas da tabela, sem ler o histórico inteiro
+        if not DB_PATH.exists():
+            return []
+        try:
+            con = sqlite3.connect(DB_PATH, timeout=2)
+            try:
+                rows = con.execute("SELECT data FROM events ORDER BY id DESC LIMIT ?", (n,)).fetchall()
+            finally:
+                con.close()
+            return [json.loads(data) for (data,) in reversed(rows)]
+        except Exception:
+            return []
     if not EVENTS_PATH.exists():
         return []
     try:
@@ -401,9 +423,10 @@ class MilhasUpApp(ctk.CTk):
             "SMILES_THRESHOLD_PER_CPF": _sv("SMILES_THRESHOLD_PER_CPF", "27000"),
             "SMILES_REPLY":           _sv("SMILES_REPLY", "16,00"),
             "SMILES_MAX_MILES":       _sv("SMILES_MAX_MILES", "675000"),
-            "AZUL_THRESHOLD_PER_CPF": _sv("AZUL_THRESHOLD_PER_CPF", "30000"),
-            "AZUL_REPLY":             _sv("AZUL_REPLY",   "18,00"),
-            "AZUL_MAX_MILES":         _sv("AZUL_MAX_MILES", "200000"),
+            # Azul só responde com AZUL_THRESHOLD_PER_CPF no .env: sem valor pré-preenchido
+            "AZUL_THRESHOLD_PER_CPF": _sv("AZUL_THRESHOLD_PER_CPF"),
+            "AZUL_REPLY":             _sv("AZUL_REPLY"),
+            "AZUL_MAX_MILES":         _sv("AZUL_MAX_MILES"),
             "NTFY_TOPIC":             _sv("NTFY_TOPIC"),
             "SEND_DELAY_SECONDS":     _sv("SEND_DELAY_SECONDS", "3"),
             "ACEITA_LIMINAR":         _bv("ACEITA_LIMINAR", True),
@@ -662,7 +685,8 @@ class MilhasUpApp(ctk.CTk):
                 ("📱 Telefone Telegram",    V["TG_PHONE"].get() or env_now.get("TG_PHONE", "—")),
                 ("✈  LATAM mínimo/CPF",     f"{V['LATAM_THRESHOLD_PER_CPF'].get()} milhas"),
                 ("🌟 SMILES mínimo/CPF",     f"{V['SMILES_THRESHOLD_PER_CPF'].get()} milhas"),
-                ("🔵 Azul mínimo/CPF",       f"{V['AZUL_THRESHOLD_PER_CPF'].get()} milhas"),
+                ("🔵 Azul mínimo/CPF",       f"{V['AZUL_THRESHOLD_PER_CPF'].get()} milhas"
+                                             if V['AZUL_THRESHOLD_PER_CPF'].get().strip() else "Desativado"),
                 ("🔔 Notificações ntfy",     V["NTFY_TOPIC"].get() or "Desativado"),
                 ("🎛 Aceita Liminar",        "Sim" if V["ACEITA_LIMINAR"].get() else "Não"),
                 ("🧪 Modo Teste (Dry-run)",  "Ativado (não envia)" if V["DRY_RUN"].get() else "Desativado (envio real)"),
@@ -740,6 +764,9 @@ class MilhasUpApp(ctk.CTk):
                 for prog in ("LATAM", "SMILES", "AZUL"):
                     for suf in ("THRESHOLD_PER_CPF", "REPLY", "MAX_MILES"):
                         k = f"{prog}_{suf}"
+                        # Azul em branco não entra no .env (um valor ali liga o programa)
+                        if prog == "AZUL" and not V[k].get().strip() and k not in env:
+                            continue
                         updates[k] = V[k].get().strip()
             if n >= 4:
                 updates["NTFY_TOPIC"]         = V["NTFY_TOPIC"].get().strip()
@@ -1142,7 +1169,9 @@ class MilhasUpApp(ctk.CTk):
                 data[key] = val
         write_env_keys(data)
         running, _ = is_running()
-        suffix = "\n⚠  Reinicie o monitor para aplicar as mudanças." if running else ""
+        # O monitor relê o .env sozinho (ENV_RELOAD_SECONDS); telefone/API e as chaves lidas só na
+        # partida pedem reinício (ver docs/PRODUTO.md).
+        suffix = "\nO monitor aplica as mudanças em alguns segundos." if running else ""
         self.toast(f"Configurações salvas!{suffix}", True)
 
     # ── Aba Licença ───────────────────────────────────────────────────────────
@@ -1413,7 +1442,15 @@ class MilhasUpApp(ctk.CTk):
     def _clear_logs(self):
         if messagebox.askyesno("Limpar Log", "Deseja apagar o histórico de eventos (events.jsonl)?"):
             try:
-                EVENTS_PATH.write_text("", encoding="utf-8")
+                if uses_sqlite() and DB_PATH.exists():
+                    con = sqlite3.connect(DB_PATH, timeout=5)
+                    try:
+                        with con:
+                            con.execute("DELETE FROM events")
+                    finally:
+                        con.close()
+                else:
+                    EVENTS_PATH.write_text("", encoding="utf-8")
                 self._refresh_logs()
                 self.toast("Log limpo com sucesso.", True)
             except Exception as ex:
@@ -0,0 +1,544 @@
+r"""
+Benchmark de regressão do parsing e da avaliação de mensagens (sem conectar ao Telegram).
+
+Executa:
+    .venv\Scripts\python bench_rules.py                   # compara com bench_baseline.json
+    .venv\Scripts\python bench_rules.py --save-baseline   # grava a baseline desta máquina
+    .venv\Scripts\python bench_rules.py --tolerance 0.30  # aceita até 30% mais lento
+    .venv\Scripts\python bench_rules.py --dedupe          # custo de gravar o dedupe por tamanho do histórico
+    .venv\Scripts\python bench_rules.py --dedupe-memory   # bytes por chave do índice do dedupe (1M chaves)
+    .venv\Scripts\python bench_rules.py --reposts         # replay com reposts editados: quase duplicadas
+
+Sai com código 1 se alguma medida ficar abaixo de (1 - tolerância) x baseline.
+A comparação usa a vazão relativa a um trabalho de referência medido na mesma execução.
+"""
+import sys, os, time, json, random, argparse, platform, asyncio
+from datetime import datetime, timezone
+sys.path.insert(0, os.path.dirname(__file__))
+
+from telethon import TelegramClient, events
+from telethon.sessions import MemorySession
+from telethon.tl.types import UpdateNewChannelMessage, Message, PeerChannel, PeerUser
+
+from monitor import (
+    parse_miles, parse_cpfs, detect_program,
+    parse_offer_price_cents, norm_text, parse_offer, parse_lots, sha1,
+    OfferPrefilter, ParseCache, parse_offers, RuleSet, RawTargetFilter, target_peer_ids, DedupeStore,
+    SeenSet, dedupe_key, NearDupIndex, replay
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+# ── Gerador de corpus sintético ───────────────────────────────────────────────
+CHATTER = [
+    "bom dia pessoal",
+    "alguém sabe se a promoção de transferência ainda está valendo?",
+    "kkkkkkk",
+    "vendo 3 passagens pra gru amanhã, chama no pv",
+    "obrigado!! 🙏🙏",
+    "quanto tá pagando o milheiro hoje?",
+    "fechado com o @fulano, valeu",
+    "alguém com 2 cpf disponível pra emissão hoje?",
+    "também acho, tá caro demais",
+    "latam tá cobrando taxa de 80 reais agora",
+    "boa noite grupo 🌙",
+    "segue o link da promo: https://exemplo.com/promo?id=12345",
+]
+PROGRAMS = ["latam", "LATAM", "Latam", "tam", "smiles", "SMILES", "smile", "Smiles", "azul"]
+VERBS    = ["compro", "Compro", "C>", "compra", "", "preciso de"]
+CPF_FMT  = ["{n} cpf", "{n} cpfs", "{n}CPF", "{n} CPF's", "{n} cpf’s", "{n} cpf."]
+EMOJIS   = ["", "", " 🔥", " ✈️", " 💰", " 🚀🚀", " ✅"]
+
+
+def _miles_token(rng):
+    """Milhas em todos os formatos aceitos por parse_miles."""
+    k = rng.randint(20, 400)
+    kind = rng.randrange(6)
+    if kind == 0:
+        return f"{k},{rng.randint(1, 9)}k"                        # 94,2k
+    if kind == 1:
+        return f"{k}.{rng.randint(0, 999):03d}{rng.choice('kK')}"  # 81.600K (K redundante)
+    if kind == 2:
+        return f"{k}{rng.choice(['k', 'K', ' k'])}"                # 100k
+    if kind == 3:
+        return f"{k},{rng.randint(1, 9)}"                          # 106,8 (shorthand)
+    if kind == 4:
+        return f"{k}{rng.choice('.,')}{rng.randint(0, 999):03d}"   # 81.600 / 160,134
+    return str(k * 1000 + rng.randint(0, 999))                     # 94200
+
+
+def _price_token(rng):
+    r = f"{rng.randint(12, 30)},{rng.choice(['00', '50', '80', '90'])}"
+    return rng.choice(["", r, r, f"R$ {r}", f"r${r}"])
+
+
+def make_offer(rng):
+    parts = [rng.choice(VERBS), _miles_token(rng), rng.choice(PROGRAMS),
+             rng.choice(CPF_FMT).format(n=rng.randint(1, 6)), _price_token(rng)]
+    if rng.random() < 0.5:
+        parts[1], parts[2] = parts[2], parts[1]
+    text = " ".join(p for p in parts if p) + rng.choice(EMOJIS)
+    if rng.random() < 0.2:
+        text = text.replace(" ", "\n", 1)
+    return text
+
+
+def make_corpus(n=20000, offer_ratio=0.15, seed=1234):
+    """Lista determinística de n mensagens: ofertas em todos os formatos + conversa."""
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n):
+        if rng.random() < offer_ratio:
+            out.append(make_offer(rng))
+        else:
+            out.append(rng.choice(CHATTER))
+    return out
+
+
+def make_lot_list(rng, max_chars=4096):
+    """Uma mensagem com vários lotes (um por linha), até o limite de caracteres do Telegram."""
+    lines = [rng.choice(["Compro:", "COMPRO LATAM:", "Lista de hoje 👇", "C> smiles"])]
+    size = len(lines[0])
+    while True:
+        line = make_offer(rng).replace("\n", " ")
+        if size + 1 + len(line) > max_chars:
+            return "\n".join(lines)
+        lines.append(line)
+        size += 1 + len(line)
+
+
+def make_lot_corpus(n, max_chars, seed=4321):
+    rng = random.Random(seed)
+    return [make_lot_list(rng, max_chars) for _ in range(n)]
+
+
+# Listas longas: o custo por KB tem que ser o mesmo em 1k e 4k caracteres (tempo linear).
+LOT_CORPORA = {
+    "parse_lots_1k": (1024, 200),   # (caracteres por mensagem, mensagens)
+    "parse_lots_4k": (4096, 50),
+}
+
+
+# Conta de usuário em 200 grupos, 10 monitorados: ~5% dos updates interessam.
+UPDATE_CHATS, UPDATE_TARGETS = 200, [-1000000000000 - c for c in range(1, 11)]
+
+
+def make_update_stream(corpus, seed=99):
+    """Um UpdateNewChannelMessage por mensagem do corpus, espalhado por UPDATE_CHATS grupos."""
+    rng = random.Random(seed)
+    date = datetime.now(timezone.utc)
+    stream = []
+    for i, text in enumerate(corpus, start=1):
+        msg = Message(id=i, peer_id=PeerChannel(rng.randint(1, UPDATE_CHATS)), date=date,
+                      message=text, from_id=PeerUser(rng.randint(1, 5000)))
+        update = UpdateNewChannelMessage(msg, pts=i, pts_count=1)
+        update._entities = {}
+        stream.append(update)
+    return stream
+
+
+async def _dispatch_all(stream, raw):
+    """Dispatcher do Telethon (offline) com o handler registrado como no monitor."""
+    client = TelegramClient(MemorySession(), 1, 'bench')
+    client._mb_entity_cache.set_self_user(1, False, 1)
+    async def handler(event):
+        pass
+    if raw:
+        client.add_event_handler(RawTargetFilter(client, handler, target_peer_ids(UPDATE_TARGETS)),
+                                 events.Raw(types=RawTargetFilter.UPDATE_TYPES))
+    else:
+        client.add_event_handler(handler, events.NewMessage(chats=UPDATE_TARGETS))
+    await client._dispatch_update(stream[0])      # resolve o builder fora da medida
+    t0 = time.perf_counter()
+    for update in stream:
+        await client._dispatch_update(update)
+    return time.perf_counter() - t0
+
+
+# ── Funções medidas ──────────────────────────────────────────────────────────
+RULES = RuleSet.from_env(defaults={'LATAM_MAX_MILES': '800000', 'SMILES_MAX_MILES': '113700'})
+
+
+def chain(text):
+    """Caminho antigo do handler: norm_text + detect_program, depois parse_* separados."""
+    program = detect_program(norm_text(text))
+    if program is None:
+        return None
+    return program, parse_miles(text), parse_cpfs(text), parse_offer_price_cents(text)
+
+
+def evaluate(text, _pf=OfferPrefilter(RULES.programs)):
+    """Decisão completa do handler (sem I/O): prefiltro, parse, cap, threshold, preço."""
+    if not _pf(text):
+        return None
+    decision = RULES.evaluate(parse_offer(text, RULES.programs))
+    return decision.reply_cents if decision.eligible else None
+
+_PREFILTER = OfferPrefilter(RULES.programs)
+
+HARNESSES = [
+    # (nome, função por mensagem)
+    ("detect_program",          lambda t: detect_program(norm_text(t))),
+    ("parse_miles",             parse_miles),
+    ("parse_cpfs",              parse_cpfs),
+    ("parse_offer_price_cents", parse_offer_price_cents),
+    ("chain",                   chain),
+    ("prefilter",               _PREFILTER),
+    ("parse_offer",             parse_offer),
+    ("parse_cache",             ParseCache(RULES.programs)),   # textos repetidos = hits
+    ("evaluate",                evaluate),
+]
+
+
+def _calibration(text):
+    # Trabalho de referência em Python puro + str: mede a velocidade da máquina/momento.
+    n = 0
+    for c in text:
+        if c.isdigit():
+            n += 1
+    return n
+
+
+def _time_once(fn, corpus):
+    t0 = time.perf_counter()
+    for text in corpus:
+        fn(text)
+    return time.perf_counter() - t0
+
+
+def _time_batch(corpus):
+    t0 = time.perf_counter()
+    parse_offers(corpus, workers=1)
+    return time.perf_counter() - t0
+
+
+def run(corpus, repeat):
+    """msg/s de cada medida (melhor de `repeat` rodadas).
+
+    As medidas são intercaladas (uma passada de cada por rodada) para que ruído de
+    CPU afete todas igualmente, e cada uma também é expressa relativa ao trabalho de
+    referência (_calibration) medido nas mesmas rodadas: é esse número relativo que
+    é comparado com a baseline, o que tolera máquinas e momentos diferentes.
+    """
+    lot_corpora = {name: make_lot_corpus(n, chars) for name, (chars, n) in LOT_CORPORA.items()}
+    stream = make_update_stream(corpus)
+    update_modes = {"updates_newmessage": False, "updates_raw_filter": True}
+    names = ["calibration"] + [name for name, _ in HARNESSES] + ["parse_offers"] + list(lot_corpora) + list(update_modes)
+    fns = dict(HARNESSES, calibration=_calibration)
+    best = dict.fromkeys(names, float('inf'))
+    for _ in range(repeat):
+        for name in names:
+            if name == "parse_offers":
+                dt = _time_batch(corpus)
+            elif name in lot_corpora:
+                dt = _time_once(parse_lots, lot_corpora[name])
+            elif name in update_modes:
+                dt = asyncio.run(_dispatch_all(stream, update_modes[name]))
+            else:
+                dt = _time_once(fns[name], corpus)
+            best[name] = min(best[name], dt)
+    rates = {name: len(lot_corpora.get(name, corpus)) / dt for name, dt in best.items()}
+    ref = rates.pop("calibration")
+    return rates, {name: rate / ref for name, rate in rates.items()}
+
+
+# ── Persistência do dedupe (--dedupe) ────────────────────────────────────────
+DEDUPE_SIZES = (1_000, 10_000, 100_000, 200_000)
+
+
+def make_seen(n, seed=7):
+    """`seen` com n respostas realistas (texto da oferta cortado em 500 caracteres)."""
+    rng = random.Random(seed)
+    seen = {}
+    for i in range(n):
+        text = " ".join(make_offer(rng) for _ in range(rng.randint(1, 4)))[:500]
+        seen[sha1(f"{i}|{text}")] = {'ts': 1_700_000_000 + i, 'program': 'LATAM', 'miles': 90_000 + i,
+                                     'cpfs': 2, 'per_cpf': 45_000, 'sender': f"Fulano {i % 997}", 'text': text}
+    return seen
+
+
+def _save_state_full(state, path):
+    # Como era antes: state.json inteiro, indent=2, a cada oferta respondida.
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def bench_dedupe(writes=200):
+    """µs por gravação: state.json inteiro vs uma linha no journal, com n chaves já gravadas."""
+    import tempfile
+    print(f"{'─'*72}")
+    print(f"  {'chaves':>8s} {'state.json inteiro':>20s} {'journal':>12s} {'compactação':>13s}")
+    rng = random.Random(11)
+    for n in DEDUPE_SIZES:
+        seen = make_seen(n)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'state.json')
+            state = {'seen': seen}
+            full_writes = max(2, min(writes, 500_000 // n))       # o modo antigo é caro: menos amostras
+            t0 = time.perf_counter()
+            for _ in range(full_writes):
+                _save_state_full(state, path)
+            full = (time.perf_counter() - t0) / full_writes
+            store = DedupeStore(path, state=state, compact_every=10**9)
+            entries = [(dedupe_key(f"novo {i}|{make_offer(rng)}"), i) for i in range(writes)]
+            t0 = time.perf_counter()
+            for key, ts in entries:
+                store.record(key, ts)
+            journal = (time.perf_counter() - t0) / writes
+            t0 = time.perf_counter()
+            store.compact()
+            compaction = time.perf_counter() - t0
+        print(f"  {n:8,d} {full * 1e6:18,.0f}µs {journal * 1e6:10,.1f}µs {compaction * 1e3:11,.0f}ms")
+    print(f"{'─'*72}")
+    print("journal: custo por gravação constante; a compactação roda a cada DEDUPE_COMPACT_EVERY gravações,")
+    print("numa thread (compact_async), e ao iniciar/encerrar o monitor.")
+
+
+def bench_dedupe_memory(n=1_000_000, lookups=200_000):
+    """Bytes por chave: dict sha1 hex → payload (formato antigo de `seen`) vs SeenSet."""
+    import gc, tracemalloc
+    rng = random.Random(5)
+    texts = [" ".join(make_offer(rng) for _ in range(rng.randint(1, 4)))[:490] for _ in range(1000)]
+
+    def legacy():
+        seen = {}
+        for i in range(n):
+            text = f"{texts[i % 1000]} #{i}"                   # um texto por oferta, como no histórico
+            seen[sha1(f"{i}|{text}")] = {'ts': 1_700_000_000 + i, 'program': 'LATAM', 'miles': 90_000 + i,
+                                         'cpfs': 2, 'per_cpf': 45_000, 'sender': f"Fulano {i % 997}",
+                                         'text': text}
+        return seen, [sha1(f"{i}|{texts[i % 1000]} #{i}") for i in range(0, n, max(1, n // lookups))]
+
+    def compact():
+        seen = SeenSet()
+        for i in range(n):
+            seen.add(dedupe_key(f"{i}|{texts[i % 1000]} #{i}"), 1_700_000_000 + i)
+        return seen, [dedupe_key(f"{i}|{texts[i % 1000]} #{i}") for i in range(0, n, max(1, n // lookups))]
+
+    print(f"{'─'*72}")
+    print(f"  {n:,d} chaves {'bytes/chave':>14s} {'total':>10s} {'consulta':>10s} {'snapshot':>10s}")
+    for label, build in (("dict + payload", legacy), ("SeenSet", compact)):
+        gc.collect()
+        tracemalloc.start()
+        seen, probes = build()
+        probe_bytes = sum(sys.getsizeof(k) for k in probes) + sys.getsizeof(probes)
+        size = tracemalloc.get_traced_memory()[0] - probe_bytes
+        tracemalloc.stop()
+        t0 = time.perf_counter()
+        hits = sum(1 for k in probes if k in seen)
+        lookup = (time.perf_counter() - t0) / len(probes)
+        assert hits == len(probes)
+        if isinstance(seen, SeenSet):
+            snapshot = len(json.dumps(SeenSet.encode(seen.pack())))
+        else:
+            snapshot = len(json.dumps(seen, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        print(f"  {label:14s} {size / n:14,.0f} {size / 2**20:8,.0f}MB {lookup * 1e9:8,.0f}ns "
+              f"{snapshot / 2**20:8,.0f}MB")
+        del seen, probes
+    print(f"{'─'*72}")
+    print("O payload (texto, milhas, CPFs, remetente) continua no registro `eligible` de events.jsonl.")
+
+
+# ── Reposts editados (--reposts) ──────────────────────────────────────────────
+REPOST_HEADERS = ["🚨 COMPRO {p} 🚨", "Compro {p}", "C> {p}", "{p} - compro hoje", "compro milhas {p}"]
+REPOST_EXTRAS  = ["Chama no PV", "Pagamento na hora", "Emissão hoje", "Só perfil verificado", "Pix na hora"]
+REPOST_BUMPS   = ["Ainda preciso!", "UP", "Alguém?", "Continuo comprando", "Subindo"]
+
+
+def make_real_offer(rng):
+    """Oferta no formato dos grupos: cabeçalho, milhas, CPFs, preço e uma ou duas linhas soltas."""
+    program = rng.choice(["LATAM", "SMILES"])
+    cpfs = rng.randint(1, 3)
+    miles = rng.randrange(25, 95) * 1000 * cpfs
+    miles_fmt = rng.choice([f"{miles // 1000}.{miles % 1000:03d} milhas", f"{miles // 1000}k", f"{miles}"])
+    lines = [rng.choice(REPOST_HEADERS).format(p=rng.choice([program, program.lower()])), miles_fmt,
+             f"{cpfs} CPF{'s' if cpfs > 1 else ''}", f"Pago {rng.randint(14, 26)},{rng.choice(['00', '50'])}"]
+    lines += rng.sample(REPOST_EXTRAS, rng.randint(0, 2))
+    return "\n".join(lines)
+
+
+def make_repost(rng, text):
+    """O mesmo pedido editado: emoji a mais, outro preço, linhas trocadas ou um "UP"."""
+    lines = text.split("\n")
+    kind = rng.randrange(4)
+    if kind == 0:
+        return text + rng.choice([" 🔥", " ✈️✈️", " 💰", " 🚀"])
+    if kind == 1:
+        return "\n".join(f"Pago {rng.randint(14, 26)},{rng.choice(['00', '50', '90'])}" if l.startswith("Pago")
+                         else l for l in lines)
+    if kind == 2:
+        rng.shuffle(lines)
+        return "\n".join(lines)
+    return text + "\n" + rng.choice(REPOST_BUMPS)
+
+
+def make_repost_export(offers=1500, chats=20, senders=60, repost_ratio=0.5, chatter=3000,
+                       hours=12, late_ratio=0.3, seed=2024):
+    """Export (formato Telegram Desktop) com ofertas, reposts editados do mesmo autor e conversa.
+
+    As mensagens se espalham por `hours` horas; cada repost vem de 1 a 50 min depois do
+    anterior, ou (com chance `late_ratio`) de 1h30 a 4h depois, fora da janela padrão.
+    """
+    rng = random.Random(seed)
+    span = hours * 3600
+    stream = []                             # (segundos desde o início, chat, autor, texto, pedido ou None)
+    for order in range(offers):
+        chat, sender = rng.randrange(chats), rng.randrange(senders)
+        text = make_real_offer(rng)
+        at = rng.random() * span
+        stream.append((at, chat, sender, text, order))
+        for _ in range(rng.randint(1, 3) if rng.random() < repost_ratio else 0):
+            at += rng.uniform(5400, 14400) if rng.random() < late_ratio else rng.uniform(60, 3000)
+            stream.append((at, chat, sender, make_repost(rng, text), order))
+    stream += [(rng.random() * span, rng.randrange(chats), rng.randrange(senders), rng.choice(CHATTER), None)
+               for _ in range(chatter)]
+    stream.sort(key=lambda m: m[0])
+    start = datetime(2026, 1, 1, 8, 0).timestamp()
+    export = {'chats': {'list': [{'name': f"Grupo {c}", 'type': 'private_supergroup', 'id': 5000 + c, 'messages': []}
+                                 for c in range(chats)]}}
+    orders = {}                             # id da mensagem -> pedido de que ela é (original ou repost)
+    for msg_id, (at, chat, sender, text, order) in enumerate(stream, start=1):
+        export['chats']['list'][chat]['messages'].append({
+            'id': msg_id, 'type': 'message',
+            'date': datetime.fromtimestamp(int(start + at)).isoformat(),
+            'from': f"Comprador {sender}", 'from_id': f"user{sender}", 'text': text})
+        if order is not None:
+            orders[msg_id] = order
+    return export, orders
+
+
+def bench_reposts(threshold=0.6, window=3600.0):
+    """Replay do mesmo export com e sem o índice de quase duplicadas."""
+    import contextlib, io, tempfile
+    export, orders = make_repost_export()
+    total = sum(len(c['messages']) for c in export['chats']['list'])
+    print(f"{'─'*72}")
+    print(f"  {total:,d} mensagens, {len(set(orders.values())):,d} pedidos + {len(orders) - len(set(orders.values())):,d} "
+          f"reposts editados, {len(export['chats']['list'])} grupos (NEAR_DUP_THRESHOLD={threshold})")
+    print(f"  {'modo':22s} {'respostas':>10s} {'pedidos':>9s} {'repetidas':>10s} {'na janela':>10s} {'tempo':>9s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'result.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(export, f, ensure_ascii=False)
+        for label, near_dups in (("só chave exata", None),
+                                 ("+ quase duplicadas", NearDupIndex(threshold=threshold, window=window))):
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                sent = asyncio.run(replay(path, RULES, near_dups=near_dups))
+            elapsed = time.perf_counter() - t0
+            answered = [orders[ev.message.id] for ev, _, _ in sent]
+            # pedidos: quantos pedidos distintos receberam resposta; repetidas: respostas além da primeira;
+            # na janela: repetidas a menos de `window` da resposta anterior ao mesmo pedido
+            last, inside = {}, 0
+            for ev, _, _ in sorted(sent, key=lambda s: s[0].message.date):
+                order, at = orders[ev.message.id], ev.message.date.timestamp()
+                if order in last and at - last[order] < window:
+                    inside += 1
+                last[order] = at
+            print(f"  {label:22s} {len(sent):10,d} {len(set(answered)):9,d} "
+                  f"{len(answered) - len(set(answered)):10,d} {inside:10,d} {elapsed:8.2f}s")
+    # latência de uma consulta com o índice cheio
+    rng = random.Random(3)
+    idx = NearDupIndex(threshold=threshold, window=10**9)
+    texts = [norm_text(make_real_offer(rng)) for _ in range(2000)]
+    for i in range(20_000):
+        idx.claim((i % 50, i % 300, "LATAM", 50_000 + i, 2), texts[i % 2000], i)
+    times = []
+    for i in range(5_000):
+        t0 = time.perf_counter()
+        idx.claim((i % 50, i % 300, "LATAM", 50_000 + i * 7, 2), texts[(i * 7) % 2000], 20_000 + i)
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    print(f"  claim(): p50 {times[len(times) // 2] * 1e6:.0f}µs  p99 {times[int(len(times) * 0.99)] * 1e6:.0f}µs"
+          f"  com {len(idx):,d} ofertas no índice")
+    print(f"{'─'*72}")
+    print("Com o índice, sobram como repetidas os reposts que chegaram depois da janela (pela data do")
+    print("export): o mesmo comprador pediu de novo horas depois e é respondido de novo.")
+
+
+def machine_info():
+    return {'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'node': platform.node()}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--save-baseline', action='store_true', help='grava os resultados como nova baseline')
+    ap.add_argument('--tolerance', type=float, default=0.25, help='queda máxima aceita (0.25 = 25%%)')
+    ap.add_argument('--size', type=int, default=20000, help='mensagens no corpus')
+    ap.add_argument('--repeat', type=int, default=5, help='repetições (vale a melhor)')
+    ap.add_argument('--dedupe', action='store_true', help='só o benchmark de persistência do dedupe')
+    ap.add_argument('--dedupe-memory', type=int, nargs='?', const=1_000_000, metavar='N',
+                    help='só o benchmark de memória do índice do dedupe (padrão: 1M chaves)')
+    ap.add_argument('--reposts', action='store_true', help='só o replay de reposts editados (quase duplicadas)')
+    args = ap.parse_args()
+
+    if args.reposts:
+        bench_reposts()
+        return 0
+    if args.dedupe:
+        bench_dedupe()
+        return 0
+    if args.dedupe_memory:
+        bench_dedupe_memory(args.dedupe_memory)
+        return 0
+
+    corpus = make_corpus(args.size)
+    offers = sum(1 for t in corpus if _PREFILTER(t))
+    print(f"\nCorpus: {len(corpus)} mensagens ({offers} passam no prefiltro)")
+    rates, scores = run(corpus, args.repeat)
+
+    baseline = None
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    base = (baseline or {}).get('scores', {})
+
+    print(f"{'─'*72}")
+    print(f"  {'medida':26s} {'µs/msg':>8s} {'msg/s':>12s} {'relativo':>9s} {'vs base':>9s}")
+    failed = []
+    for name, rate in rates.items():
+        score = scores[name]
+        ref = base.get(name)
+        line = f"  {name:26s} {1e6 / rate:8.2f} {rate:12,.0f} {score:9.4f}"
+        if ref:
+            delta = score / ref - 1
+            line += f" {delta:+9.1%}"
+            if delta < -args.tolerance:
+                failed.append(name)
+                line += '  ✗ REGRESSÃO'
+        print(line)
+    print(f"{'─'*72}")
+    print(f"parse_offer vs chain: {rates['parse_offer'] / rates['chain']:.2f}x")
+    per_kb = {name: 1e6 / rates[name] / (chars / 1024) for name, (chars, _) in LOT_CORPORA.items()}
+    print("parse_lots µs/KB: " + "  ".join(f"{name[11:]}={v:.1f}" for name, v in per_kb.items()))
+    print(f"updates ({len(UPDATE_TARGETS)} de {UPDATE_CHATS} grupos monitorados): raw filter vs NewMessage "
+          f"{rates['updates_raw_filter'] / rates['updates_newmessage']:.2f}x")
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump({'corpus': {'size': args.size}, 'machine': machine_info(),
+                       'rates': {k: round(v) for k, v in rates.items()},
+                       'scores': {k: round(v, 5) for k, v in scores.items()}},
+                      f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"Baseline gravada em {BASELINE_PATH}")
+        return 0
+
+    if baseline is None:
+        print("Sem baseline (rode com --save-baseline).")
+        return 0
+    if baseline.get('corpus', {}).get('size') != args.size:
+        print("[WARN] baseline gravada com outro --size — compare com cautela.")
+    if baseline.get('machine') != machine_info():
+        print("[WARN] baseline gravada em outra máquina/Python — compare com cautela.")
+    if failed:
+        print(f"FALHA: regressão acima de {args.tolerance:.0%} em: {', '.join(failed)}")
+        return 1
+    print(f"OK: nenhuma medida abaixo de -{args.tolerance:.0%} da baseline")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
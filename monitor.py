@@ -2,11 +2,24 @@ import os
 import re
 import json
 import time
+import base64
 import hashlib
 import argparse
+import asyncio
 import sys
+import queue
+import atexit
+import sqlite3
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import repeat
 from dataclasses import dataclass
 from pathlib import Path
+from types import MappingProxyType
 from decimal import Decimal, InvalidOperation
 
 # Force UTF-8 output on Windows consoles to avoid crashes on emojis/special chars in names.
@@ -17,8 +30,10 @@ except Exception:
     pass
 
 from telethon import TelegramClient, events
-from telethon.errors import SessionPasswordNeededError
-from dotenv import load_dotenv
+from telethon.errors import SessionPasswordNeededError, FloodWaitError
+from telethon.tl.types import (UpdateNewChannelMessage, UpdateNewMessage, UpdateShortChatMessage,
+                               UpdateShortMessage, Message, PeerChannel, PeerChat, PeerUser)
+from dotenv import load_dotenv, dotenv_values
 
 # ── Base directory: pasta do .exe quando frozen, pasta do script em dev ───────
 # PyInstaller --onedir coloca o exe em monitor_bg/monitor_bg.exe.
@@ -37,31 +52,439 @@ else:
 STATE_PATH            = os.path.join(_BASE, 'state.json')
 EVENTS_LOG_PATH       = os.path.join(_BASE, 'events.jsonl')
 WHATSAPP_EVENTS_PATH  = os.path.join(_BASE, 'whatsapp-events.jsonl')
+TARGETS_CACHE_PATH    = os.path.join(_BASE, 'targets_cache.json')
+DB_PATH               = os.path.join(_BASE, 'milhas.db')
 LOCK_PATH             = os.path.join(_BASE, 'monitor.lock')
 PID_PATH              = os.path.join(_BASE, 'monitor.pid')
 
-@dataclass
+@dataclass(frozen=True)
 class Rule:
-    program: str  # 'LATAM' or 'SMILES'
+    program: str  # name from PROGRAM_REGISTRY ('LATAM', 'SMILES', ...)
     threshold_per_cpf: int
     reply: str
+    max_miles: int | None = None    # cap on total miles in the message (None = no cap)
+    inclusive: bool = False         # True: per_cpf >= threshold; False: per_cpf > threshold
+    reply_cents: int | None = None  # derived from reply when not given
+
+    def __post_init__(self):
+        if self.reply_cents is None:
+            object.__setattr__(self, 'reply_cents', parse_reply_cents(self.reply))
+
+    def evaluate(self, parsed: 'ParsedOffer') -> 'Decision':
+        """Cap, threshold and reply price for an offer of this program (pure, no I/O)."""
+        program, miles, cpfs = self.program, parsed.miles, parsed.cpfs
+        if self.max_miles is not None and miles > self.max_miles:
+            return Decision(False, f"{program} acima do cap ({miles} > {self.max_miles})",
+                            program, miles, cpfs)
+
+        per_cpf = compute_per_cpf(miles, cpfs)
+        if self.inclusive:
+            eligible = per_cpf >= self.threshold_per_cpf
+        else:
+            eligible = per_cpf > self.threshold_per_cpf
+        if not eligible:
+            op = '>=' if self.inclusive else '>'
+            return Decision(False, f"{program} {per_cpf}/CPF nao atinge threshold {self.threshold_per_cpf} ({op})",
+                            program, miles, cpfs, per_cpf)
+
+        # Never bid below the offered price in the message.
+        offer_cents = parsed.offer_cents
+        final_cents = self.reply_cents
+        if offer_cents is not None and final_cents is not None:
+            final_cents = max(final_cents, offer_cents)
+        reply = format_price_cents(final_cents) if final_cents is not None else self.reply
+        offer = format_price_cents(offer_cents) if offer_cents is not None else '?'
+        return Decision(True, f"{program} {miles}/{cpfs}={per_cpf}/CPF | oferta={offer} | resposta={reply}",
+                        program, miles, cpfs, per_cpf, offer_cents, final_cents, reply)
+
+@dataclass(frozen=True)
+class Decision:
+    eligible: bool
+    reason: str
+    program: str | None = None
+    miles: int | None = None
+    cpfs: int | None = None
+    per_cpf: int | None = None
+    offer_cents: int | None = None
+    reply_cents: int | None = None
+    reply: str | None = None        # text to send (final price, never below the offer)
 
 K_MULTIPLIER = 1000
 
-def load_state():
-    if not os.path.exists(STATE_PATH):
+def parse_reply_cents(reply: str):
+    """Rule reply is a string like "15,50". Returns cents or None."""
+    try:
+        rr = reply.strip().replace('.', ',')
+        m = re.fullmatch(r"(\d{1,2}),(\d{2})", rr)
+        if m:
+            return int(m.group(1)) * 100 + int(m.group(2))
+    except Exception:
+        pass
+    return None
+
+def _env_int(name: str, default: str, defaults: dict | None = None) -> int:
+    default = (defaults or {}).get(name, default)
+    try:
+        return int((os.getenv(name, default) or default).strip())
+    except Exception:
+        return int(default)
+
+# ── Program registry ─────────────────────────────────────────────────────────
+@dataclass(frozen=True)
+class Program:
+    name: str
+    aliases: tuple                  # whole words, lowercase ("tam" does not match "tamanho")
+    inclusive: bool = False         # default comparison: per_cpf >= threshold (True) or > (False)
+    threshold_per_cpf: int | None = None    # defaults; None = must be set in .env
+    reply: str | None = None
+    max_miles: int = 0              # 0 = no cap
+    enabled: bool = False           # answered by default, without any <NAME>_* in .env
+
+# Adding a program is one line here. Order is the detection priority when a message
+# mentions more than one program (LATAM wins over SMILES, as before).
+PROGRAM_REGISTRY = (
+    Program('LATAM',  ('latam', 'tam', 'latampass'), True,  50000, '25,00', 800000, enabled=True),
+    Program('SMILES', ('smiles', 'smile'),           False, 60000, '15,50', 113700, enabled=True),
+    Program('AZUL',   ('azul', 'tudoazul'),          False, 30000, '18,00', 200000),
+    Program('TAP',    ('tap', 'milesgo')),
+    Program('LIVELO', ('livelo',)),
+    Program('ESFERA', ('esfera',)),
+)
+
+_ALIAS_RE = re.compile(r"[^\W\d_]+")      # an alias is a single word (letters only)
+_NO_PROGRAM = (len(PROGRAM_REGISTRY), None)
+
+class ProgramTable:
+    """Alias -> program lookup compiled from the registry.
+
+    All aliases are compiled into one regex, so detection is a single scan of the text
+    (in C) plus one dict lookup per alias found, however many programs are registered.
+    """
+
+    def __init__(self, programs=PROGRAM_REGISTRY, extra_aliases: dict | None = None):
+        extra_aliases = extra_aliases or {}
+        self.names = tuple(p.name for p in programs)
+        self.aliases = {}           # alias -> (rank, program name); rank = registry order
+        ranks = {p.name: rank for rank, p in enumerate(PROGRAM_REGISTRY)}
+        for p in programs:
+            for alias in (*p.aliases, *extra_aliases.get(p.name, ())):
+                alias = alias.strip().lower()
+                if not _ALIAS_RE.fullmatch(alias):
+                    raise ValueError(f'Invalid alias {alias!r} for {p.name}: use a single word (letters only).')
+                self.aliases.setdefault(alias, (ranks[p.name], p.name))
+        # Longest first, so "latampass" is reported rather than failing over to "latam".
+        alts = '|'.join(map(re.escape, sorted(self.aliases, key=len, reverse=True))) or r'(?!)'
+        # Whole words only, like \b: "tamanho", "2tam" and "tam_" are not "tam".
+        self._alias_re = re.compile(rf"(?<!\w)(?:{alts})(?!\w)")
+        # Prefilter: the aliases as plain substrings (looser than the whole-word detection);
+        # an alias containing a shorter one ("latam" / "tam") adds nothing.
+        subs = [a for a in self.aliases if not any(b != a and b in a for b in self.aliases)]
+        subs = '|'.join(map(re.escape, sorted(subs))) or r'(?!)'
+        self.prefilter_re = re.compile(
+            rf"(?=.*?cpf)(?=.*?(?:{subs}))(?=.*?\d)", re.IGNORECASE | re.DOTALL)
+
+    def detect(self, lowered: str):
+        """(program, span) of the highest-priority program in an already lowercased text."""
+        best, span = _NO_PROGRAM, None
+        search = self._alias_re.search
+        m = search(lowered)
+        while m is not None:
+            hit = self.aliases[m.group()]
+            if hit[0] < best[0]:
+                best, span = hit, m.span()
+                if hit[0] == 0:
+                    break
+            m = search(lowered, m.end())
+        return best[1], span
+
+DEFAULT_PROGRAMS = ProgramTable()
+
+def _env_list(name: str) -> list:
+    return [x.strip() for x in (os.getenv(name) or '').split(',') if x.strip()]
+
+@dataclass(frozen=True)
+class RuleSet:
+    """Immutable rules, compiled once from the environment.
+
+    The handler only does dict lookups and int compares per message: env vars, caps and
+    reply cents are all resolved here.
+    """
+    rules: 'MappingProxyType[str, Rule]'
+    programs: ProgramTable = DEFAULT_PROGRAMS
+
+    @classmethod
+    def from_env(cls, defaults: dict | None = None) -> 'RuleSet':
+        """Builds the rules of the enabled programs of PROGRAM_REGISTRY.
+
+        Per program: <NAME>_THRESHOLD_PER_CPF / _REPLY / _MAX_MILES (0 = no cap),
+        <NAME>_COMPARE (">=" or ">") and <NAME>_ALIASES (extra words, comma separated).
+        PROGRAMS (comma separated) picks the programs to answer; without it, the enabled
+        ones plus any program whose <NAME>_THRESHOLD_PER_CPF is set.
+        `defaults` overrides the built-in defaults by env var name (used by test_rules.py).
+        """
+        d = defaults or {}
+        registry = {p.name: p for p in PROGRAM_REGISTRY}
+        names = [n.upper() for n in _env_list('PROGRAMS')]
+        for name in names:
+            if name not in registry:
+                raise ValueError(f'Unknown program in PROGRAMS: {name} (known: {", ".join(registry)})')
+        if not names:
+            names = [p.name for p in PROGRAM_REGISTRY
+                     if p.enabled or os.getenv(f'{p.name}_THRESHOLD_PER_CPF') or f'{p.name}_THRESHOLD_PER_CPF' in d]
+
+        rules = {}
+        for name in names:
+            p = registry[name]
+            threshold = os.getenv(f'{name}_THRESHOLD_PER_CPF', d.get(f'{name}_THRESHOLD_PER_CPF', p.threshold_per_cpf))
+            reply = os.getenv(f'{name}_REPLY', d.get(f'{name}_REPLY', p.reply))
+            if threshold is None or reply is None:
+                raise ValueError(f'{name} is enabled: set {name}_THRESHOLD_PER_CPF and {name}_REPLY in .env')
+            max_miles = _env_int(f'{name}_MAX_MILES', str(p.max_miles), d)
+            compare = (os.getenv(f'{name}_COMPARE') or d.get(f'{name}_COMPARE') or '').strip()
+            if compare not in ('', '>=', '>'):
+                raise ValueError(f'{name}_COMPARE must be ">=" or ">", got {compare!r}')
+            inclusive = p.inclusive if not compare else compare == '>='
+            rules[name] = Rule(name, int(threshold), reply, max_miles if max_miles > 0 else None, inclusive)
+
+        # Only the answered programs are detected: the prefilter stays as tight as the rules.
+        extra = {name: _env_list(f'{name}_ALIASES') for name in names}
+        programs = ProgramTable([registry[name] for name in registry if name in rules], extra)
+        return cls(MappingProxyType(rules), programs)
+
+    def __contains__(self, program):
+        return program in self.rules
+
+    def __getitem__(self, program) -> Rule:
+        return self.rules[program]
+
+    def items(self):
+        return self.rules.items()
+
+    def evaluate(self, parsed: 'ParsedOffer') -> Decision:
+        program = parsed.program
+        if program is None:
+            return Decision(False, "programa nao detectado")
+        rule = self.rules.get(program)
+        if rule is None:
+            return Decision(False, f"sem regra para {program}", program)
+        if parsed.miles is None:
+            return Decision(False, "milhas nao detectadas", program)
+        if parsed.cpfs is None or parsed.cpfs <= 0:
+            return Decision(False, "CPFs nao detectados", program, parsed.miles)
+        return rule.evaluate(parsed)
+
+def load_state(path: str | None = None):
+    path = path or STATE_PATH
+    if not os.path.exists(path):
         return {"seen": {}}
-    with open(STATE_PATH, 'r', encoding='utf-8') as f:
+    with open(path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def save_state(state):
-    tmp = STATE_PATH + '.tmp'
+def save_state(state, path: str | None = None):
+    path = path or STATE_PATH
+    tmp = path + '.tmp'
     with open(tmp, 'w', encoding='utf-8') as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, STATE_PATH)
+        json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp, path)
+
+class SeenSet:
+    """Dedupe index: 16-byte digests for membership, with their timestamps in recording order.
+
+    The check only needs membership, so a key is a 16-byte bytes object in a set rather
+    than a hex string mapped to a payload dict (the payload is in the `eligible` record of
+    the event log). Recording order lives in two flat arrays, 16 + 8 bytes per key, consumed
+    from `head`: keys older than `ttl` seconds expire in amortized O(1), and a snapshot is
+    the raw bytes of the arrays. ttl <= 0 keeps every key.
+    """
+
+    __slots__ = ('keys', 'digests', 'stamps', 'head', 'ttl', 'cutoff', 'expired')
+
+    def __init__(self, ttl: float = 0):
+        self.keys = set()
+        self.digests = bytearray()      # DIGEST_SIZE bytes per key, in recording order
+        self.stamps = array('q')        # ts of each digest
+        self.head = 0                   # first live position (older ones expired)
+        self.ttl = ttl
+        self.cutoff = 0
+        self.expired = 0
+
+    @classmethod
+    def of(cls, state: dict, ttl: float = 0) -> 'SeenSet':
+        """state['seen'] as a SeenSet, converting what load_state() read in place."""
+        seen = state.get('seen')
+        if not isinstance(seen, SeenSet):
+            seen = state['seen'] = cls.decode(seen, ttl)
+        return seen
+
+    @classmethod
+    def decode(cls, data, ttl: float = 0) -> 'SeenSet':
+        """From the snapshot format, or the older {sha1 hex: entry} dict of state.json."""
+        seen = cls(ttl)
+        if isinstance(data, dict) and data.get('format') == 'digest16':
+            seen.digests = bytearray(base64.b64decode(data['keys']))
+            seen.stamps.frombytes(base64.b64decode(data['ts']))
+            if sys.byteorder != 'little':
+                seen.stamps.byteswap()
+            d = seen.digests
+            seen.keys = {bytes(d[i:i + DIGEST_SIZE]) for i in range(0, len(d), DIGEST_SIZE)}
+        elif data:
+            for ts, key in sorted((e.get('ts', 0) if isinstance(e, dict) else 0, k) for k, e in data.items()):
+                seen.add(bytes.fromhex(key[:DIGEST_SIZE * 2]), ts)
+        seen.expire()
+        return seen
+
+    def pack(self) -> tuple:
+        """Copies of the live part of the arrays; cheap, and safe to encode in another thread."""
+        stamps = self.stamps[self.head:]
+        if sys.byteorder != 'little':
+            stamps.byteswap()
+        return bytes(self.digests[self.head * DIGEST_SIZE:]), stamps.tobytes()
+
+    @staticmethod
+    def encode(packed: tuple) -> dict:
+        keys, stamps = packed
+        return {'format': 'digest16', 'keys': base64.b64encode(keys).decode('ascii'),
+                'ts': base64.b64encode(stamps).decode('ascii')}
+
+    def __contains__(self, key) -> bool:
+        return key in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __iter__(self):
+        """(digest, ts) of the live keys, oldest first."""
+        d = self.digests
+        for i in range(self.head, len(self.stamps)):
+            yield bytes(d[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]), self.stamps[i]
+
+    def add(self, key: bytes, ts: int) -> bool:
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        self.digests += key
+        self.stamps.append(ts)
+        return True
+
+    def expire(self, now: float | None = None) -> int:
+        """Drops the keys recorded before now - ttl; returns how many went."""
+        if self.ttl <= 0:
+            return 0
+        self.cutoff = cutoff = int((time.time() if now is None else now) - self.ttl)
+        stamps, digests, keys = self.stamps, self.digests, self.keys
+        i, end = self.head, len(stamps)
+        while i < end and stamps[i] < cutoff:
+            keys.discard(bytes(digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]))
+            i += 1
+        n = i - self.head
+        self.head = i
+        if i > 1024 and i * 2 > end:
+            # drop the consumed prefix once it is most of the arrays
+            del digests[:i * DIGEST_SIZE]
+            del stamps[:i]
+            self.head = 0
+        self.expired += n
+        return n
+
+class DedupeStore:
+    """Dedupe state as a snapshot (state.json) plus an append-only journal.
+
+    record() appends one compact line per answered offer, so a write costs the same with
+    10 or 100k keys in `seen`. compact() folds the journal into a new snapshot; the async
+    variant serializes in a worker thread, off the event loop. Loading reads the snapshot
+    and replays the journal(s) over it, so a crash at any point loses nothing that was
+    recorded. `path` defaults to STATE_PATH at call time (replay points it elsewhere).
+    With `ttl` (seconds) set, keys older than that are evicted and never reach a snapshot.
+    """
+
+    def __init__(self, path: str | None = None, state: dict | None = None, compact_every: int = 5000,
+                 ttl: float = 0):
+        self.path = path
+        self.compact_every = compact_every
+        self.ttl = ttl
+        self.pending = 0            # journal records since the last compaction
+        self.compacting = False
+        self.state = state if state is not None else self.load()
+        self.seen = SeenSet.of(self.state, ttl)
+
+    @property
+    def state_path(self) -> str:
+        return self.path or STATE_PATH
+
+    @property
+    def journal_path(self) -> str:
+        return self.state_path + '.journal'
+
+    def load(self) -> dict:
+        state = load_state(self.state_path)
+        seen = state['seen'] = SeenSet.decode(state.get('seen'), self.ttl)
+        # .journal.1 is only left behind by a compaction that did not finish
+        for path in (self.journal_path + '.1', self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue        # torn last line
+                    seen.add(bytes.fromhex(rec['k'][:DIGEST_SIZE * 2]), rec.get('ts', 0))
+                    self.pending += 1
+        seen.expire()
+        return state
+
+    def record(self, key: bytes, ts: int):
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'k': key.hex(), 'ts': ts}, separators=(',', ':')) + '\n')
+        self.pending += 1
+        self.seen.add(key, ts)          # no-op when the handler already claimed it
+        self.seen.expire()
+
+    def due(self) -> bool:
+        return self.pending >= self.compact_every and not self.compacting
+
+    def _rotate(self) -> dict:
+        """Moves the journal aside and copies the state; runs on the loop, between records."""
+        self.seen.expire()
+        journal = self.journal_path
+        if os.path.exists(journal):
+            if os.path.exists(journal + '.1'):
+                # previous compaction failed: keep both generations
+                with open(journal, 'r', encoding='utf-8') as src, open(journal + '.1', 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                os.remove(journal)
+            else:
+                os.replace(journal, journal + '.1')
+        self.pending = 0
+        snapshot = {k: (dict(v) if isinstance(v, dict) else v) for k, v in self.state.items() if k != 'seen'}
+        snapshot['seen'] = self.seen.pack()
+        return snapshot
+
+    def _write_snapshot(self, snapshot: dict):
+        snapshot['seen'] = SeenSet.encode(snapshot['seen'])
+        save_state(snapshot, self.state_path)
+        try:
+            os.remove(self.journal_path + '.1')
+        except FileNotFoundError:
+            pass
+
+    def compact(self):
+        self._write_snapshot(self._rotate())
+
+    async def compact_async(self):
+        if self.compacting:
+            return
+        self.compacting = True
+        try:
+            await asyncio.to_thread(self._write_snapshot, self._rotate())
+        finally:
+            self.compacting = False
 
 def append_event_log(obj: dict):
-    # JSONL for easy tail/grep.
+    # JSONL for easy tail/grep; with STORAGE=sqlite the history goes to the database instead.
+    if EVENT_STORE is not None:
+        EVENT_STORE.append_event(obj)
+        return
     with open(EVENTS_LOG_PATH, 'a', encoding='utf-8') as f:
         f.write(json.dumps(obj, ensure_ascii=False) + '\n')
 
@@ -111,6 +534,12 @@ def acquire_single_instance_lock():
 def sha1(s: str) -> str:
     return hashlib.sha1(s.encode('utf-8')).hexdigest()
 
+DIGEST_SIZE = 16
+
+def dedupe_key(key_src: str) -> bytes:
+    # First half of the SHA-1: hex keys of an older state.json convert to the same digest.
+    return hashlib.sha1(key_src.encode('utf-8')).digest()[:DIGEST_SIZE]
+
 def parse_miles(text: str):
     """Returns miles as int or None.
 
@@ -220,14 +649,10 @@ def format_price_cents(cents: int) -> str:
 def detect_program(text: str):
     """Detects the loyalty program mentioned in the message.
 
-    Be permissive: in groups people write variations like "smile", "smiles", "latam", "tam".
+    Be permissive: in groups people write variations like "smile", "smiles", "latam", "tam"
+    (see the aliases in PROGRAM_REGISTRY).
     """
-    t = text.lower()
-    if 'latam' in t or re.search(r"\btam\b", t):
-        return 'LATAM'
-    if 'smiles' in t or re.search(r"\bsmile\b", t):
-        return 'SMILES'
-    return None
+    return DEFAULT_PROGRAMS.detect(text.lower())[0]
 
 def is_buy_message(text: str):
     # keep permissive: 'compro', 'c>', 'compra' etc.
@@ -237,6 +662,302 @@ def is_buy_message(text: str):
 def compute_per_cpf(miles: int, cpfs: int) -> int:
     return int(miles // cpfs)
 
+# Prefilter: a message can only become an offer if it mentions a program, has a digit
+# and says "cpf" (parse_cpfs needs it). The three conditions are lookaheads anchored at
+# the start of the text (ProgramTable.prefilter_re), so a non-candidate costs one match()
+# call that scans the raw text in C and returns None: no lowercasing, no normalization,
+# no parse. Aliases are searched as plain substrings, looser than the whole-word program
+# detection, so the prefilter never drops a real offer.
+class OfferPrefilter:
+    """Cheap first stage of the handler; counts dropped vs passed messages."""
+
+    __slots__ = ('dropped', 'passed', '_match')
+
+    def __init__(self, programs: ProgramTable = DEFAULT_PROGRAMS):
+        self.dropped = 0
+        self.passed = 0
+        self._match = programs.prefilter_re.match
+
+    def __call__(self, text: str) -> bool:
+        if self._match(text) is None:
+            self.dropped += 1
+            return False
+        self.passed += 1
+        return True
+
+    def stats(self) -> dict:
+        return {'dropped': self.dropped, 'passed': self.passed}
+
+@dataclass
+class ParsedOffer:
+    program: str | None        # 'LATAM' / 'SMILES' / None
+    miles: int | None
+    cpfs: int | None
+    offer_cents: int | None
+    spans: dict                # field -> (start, end) in the raw text
+
+# Single-pass extraction engine.
+#
+# Every pattern used by parse_miles / parse_cpfs / parse_offer_price_cents starts with
+# "\b\d", so they can only match where a digit run begins. parse_offer walks the digit
+# runs once (_DIGITS_RE) and tries the same patterns, precompiled, anchored at each run
+# (pattern.match(text, pos) gives the same groups re.search would return there). The
+# first run where a pattern matches is exactly the leftmost re.search match. Cheap
+# checks on the run length and the next char skip patterns that cannot match, and a
+# miles format is only tried while no higher-priority one has been found.
+_DIGITS_RE     = re.compile(r"\d+")
+_MILES_TK_RE   = re.compile(r"\b(\d{1,3}(?:[\.,]\d{3})+)\s*[kK]\b")     # 81.600k / 37.800K
+_MILES_K_RE    = re.compile(r"\b(\d+)([\.,](\d+))?\s*[kK]\b")          # 94,2k / 94k
+_MILES_T_RE    = re.compile(r"\b(\d{1,3}(?:[\.,]\d{3})+)\b")             # 160.134
+_MILES_SH_RE   = re.compile(r"\b(\d{2,3})[\.,](\d)\b")                   # 106,8
+_MILES_INT_RE  = re.compile(r"\b(\d{4,})\b")                             # 94200
+_CPFS_RE       = re.compile(r"\b(\d{1,2})\s*cpf(?:s|['’]s)?\b", re.IGNORECASE)
+# The optional "r$" prefix of parse_offer_price_cents never changes the captured digits.
+_PRICE_RE      = re.compile(r"\b(\d{1,2})[\.,](\d{2})\b")
+
+def parse_offer(text: str, programs: ProgramTable = DEFAULT_PROGRAMS) -> ParsedOffer:
+    """Extracts program, miles, cpfs and offer price in one pass over the raw text.
+
+    Same results as norm_text + detect_program + parse_miles + parse_cpfs +
+    parse_offer_price_cents, including the priority order between the miles formats.
+    """
+    spans = {}
+
+    # detect_program: one alias-table lookup per word of the lowercased text.
+    # (Whitespace normalization never changes these matches, so norm_text is not needed.)
+    program, span = programs.detect(text.lower())
+    if span is not None:
+        spans['program'] = span     # offsets in text.lower()
+
+    miles = None
+    miles_rank = 6          # lower rank = higher priority format (see parse_miles)
+    cpfs = None
+    cpfs_done = False
+    offer_cents = None
+
+    n = len(text)
+    for tok in _DIGITS_RE.finditer(text):
+        start, end = tok.span()
+        if start > 0:
+            c = text[start - 1]
+            if c.isalnum() or c == '_':
+                continue        # no "\b" before the run: nothing can match here
+        run = end - start
+        nxt = text[end] if end < n else ''
+        sep = nxt == '.' or nxt == ','
+
+        if miles_rank > 1:
+            if sep and run <= 3:
+                m = _MILES_TK_RE.match(text, start)
+                if m:
+                    miles = int(m.group(1).replace('.', '').replace(',', ''))
+                    miles_rank = 1
+                    spans['miles'] = m.span(1)
+            if miles_rank > 2 and (sep or nxt in 'kK' or nxt.isspace()):
+                m = _MILES_K_RE.match(text, start)
+                if m:
+                    whole, frac = m.group(1), m.group(3)
+                    if frac:
+                        miles = int(round(float(f"{whole}.{frac}") * K_MULTIPLIER))
+                    else:
+                        miles = int(whole) * K_MULTIPLIER
+                    miles_rank = 2
+                    spans['miles'] = (start, m.end(2) if frac else m.end(1))
+            if miles_rank > 3 and sep and run <= 3:
+                m = _MILES_T_RE.match(text, start)
+                if m:
+                    miles = int(m.group(1).replace('.', '').replace(',', ''))
+                    miles_rank = 3
+                    spans['miles'] = m.span(1)
+            if miles_rank > 4 and sep and 2 <= run <= 3:
+                m = _MILES_SH_RE.match(text, start)
+                if m:
+                    miles = int(m.group(1)) * 1000 + int(m.group(2)) * 100
+                    miles_rank = 4
+                    spans['miles'] = (start, m.end(2))
+            if miles_rank > 5 and run >= 4:
+                m = _MILES_INT_RE.match(text, start)
+                if m:
+                    miles = int(m.group(1))
+                    miles_rank = 5
+                    spans['miles'] = m.span(1)
+
+        if not cpfs_done and run <= 2 and (nxt in 'cC' or nxt.isspace()):
+            m = _CPFS_RE.match(text, start)
+            if m:
+                # parse_cpfs only looks at the first match ("0 cpf" => None).
+                cpfs_done = True
+                count = int(m.group(1))
+                if count > 0:
+                    cpfs = count
+                    spans['cpfs'] = m.span(1)
+
+        if offer_cents is None and sep and run <= 2:
+            m = _PRICE_RE.match(text, start)
+            if m:
+                offer_cents = int(m.group(1)) * 100 + int(m.group(2))
+                spans['offer'] = (start, m.end(2))
+
+    return ParsedOffer(program, miles, cpfs, offer_cents, spans)
+
+# Multi-lot messages: one lot per line or per " / ", ";" or "|" separated chunk.
+_LOT_SEP_RE = re.compile(r"\n|\s/\s|[;|]")
+
+def parse_lots(text: str, programs: ProgramTable = DEFAULT_PROGRAMS) -> list[ParsedOffer]:
+    """Splits a message into lots and parses each one ("LATAM 100k 2 cpf / SMILES 60k 1 cpf").
+
+    A segment is a lot when it has both miles and CPFs. Segments without a program inherit
+    the last program seen, so a header line like "Compro LATAM:" applies to the lines
+    below it; lots before the first program (named only at the end, "100k 2 cpf /
+    150k 2 cpf / LATAM") take that first program. A lot without its own price takes the
+    first price written outside any lot ("Compro LATAM 30,00 o milheiro" or a closing
+    "Pago 30,00"), so it is never answered below the buyer's price. Each segment is
+    parsed once, so the whole message is still linear in its length. With fewer than two
+    lots the message is parsed as a whole, exactly like parse_offer (a single offer may
+    be spread over several lines).
+    """
+    n = len(text)
+    if _LOT_SEP_RE.search(text) is None:
+        return [parse_offer(text, programs)]      # one segment: nothing to split
+    lots = []
+    program = first_program = shared_price = None
+    pos = 0
+    while pos <= n:
+        m = _LOT_SEP_RE.search(text, pos)
+        end = m.start() if m else n
+        if end > pos:
+            p = parse_offer(text[pos:end], programs)
+            if p.program is not None:
+                program = p.program
+                first_program = first_program or program
+            if p.miles is not None and p.cpfs is not None:
+                spans = {k: (a + pos, b + pos) for k, (a, b) in p.spans.items()}
+                lots.append(ParsedOffer(program, p.miles, p.cpfs, p.offer_cents, spans))
+            elif shared_price is None:
+                shared_price = p.offer_cents
+        if m is None:
+            break
+        pos = m.end()
+    if len(lots) < 2:
+        return [parse_offer(text, programs)]
+    if first_program is not None or shared_price is not None:
+        lots = [lot if lot.program is not None and lot.offer_cents is not None
+                else ParsedOffer(lot.program or first_program, lot.miles, lot.cpfs,
+                                 lot.offer_cents if lot.offer_cents is not None else shared_price, lot.spans)
+                for lot in lots]
+    return lots
+
+class ParseCache:
+    """Bounded LRU of parse_lots results, keyed by a hash of the raw text.
+
+    The same offer is usually cross-posted to several TG_TARGETS within seconds; repeats
+    cost one blake2b of the text instead of the regex pipeline. Cached lots are shared
+    between calls and must be treated as read-only. capacity=0 disables the cache.
+    """
+
+    __slots__ = ('programs', 'capacity', 'hits', 'misses', '_lots')
+
+    def __init__(self, programs: ProgramTable = DEFAULT_PROGRAMS, capacity: int = 1024):
+        self.programs = programs
+        self.capacity = max(0, capacity)
+        self.hits = 0
+        self.misses = 0
+        self._lots = OrderedDict()
+
+    def __call__(self, text: str) -> list[ParsedOffer]:
+        if not self.capacity:
+            self.misses += 1
+            return parse_lots(text, self.programs)
+        key = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        lots = self._lots.get(key)
+        if lots is not None:
+            self._lots.move_to_end(key)
+            self.hits += 1
+            return lots
+        self.misses += 1
+        lots = self._lots[key] = parse_lots(text, self.programs)
+        if len(self._lots) > self.capacity:
+            self._lots.popitem(last=False)
+        return lots
+
+    def __len__(self):
+        return len(self._lots)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._lots),
+                'capacity': self.capacity}
+
+def format_miles(miles: int) -> str:
+    """94200 -> "94.200" (pt-BR thousands separator)."""
+    return f"{miles:,}".replace(',', '.')
+
+# ── Batch parsing (backfills of archived chats) ──────────────────────────────
+PROGRAM_CODES = {None: 0, **{p.name: code for code, p in enumerate(PROGRAM_REGISTRY, start=1)}}
+MISSING = -1                # value stored in the int columns when a field was not found
+_INT64_MAX = 2 ** 63 - 1
+
+@dataclass
+class ParsedOffers:
+    """Columnar result of parse_offers: parallel arrays, one slot per input text."""
+    program: array          # 'b' codes from PROGRAM_CODES
+    miles: array            # 'q', MISSING when not found
+    cpfs: array             # 'h', MISSING when not found
+    offer_cents: array      # 'l', MISSING when not found
+    valid: bytearray        # 1 when program, miles and cpfs were all found
+
+    def __len__(self):
+        return len(self.valid)
+
+def _empty_columns() -> ParsedOffers:
+    return ParsedOffers(array('b'), array('q'), array('h'), array('l'), bytearray())
+
+def _parse_offers_chunk(texts, programs: ProgramTable = DEFAULT_PROGRAMS) -> ParsedOffers:
+    cols = _empty_columns()
+    program, miles, cpfs, offer_cents, valid = (
+        cols.program, cols.miles, cols.cpfs, cols.offer_cents, cols.valid)
+    codes = PROGRAM_CODES
+    for text in texts:
+        p = parse_offer(text or '', programs)
+        program.append(codes[p.program])
+        # Clamp absurd digit runs to the int64 column; still far above any cap.
+        miles.append(MISSING if p.miles is None else min(p.miles, _INT64_MAX))
+        cpfs.append(MISSING if p.cpfs is None else p.cpfs)
+        offer_cents.append(MISSING if p.offer_cents is None else p.offer_cents)
+        valid.append(1 if p.program is not None and p.miles is not None and p.cpfs is not None else 0)
+    return cols
+
+def parse_offers(texts, workers: int | None = None, chunk_size: int = 20000,
+                 programs: ProgramTable = DEFAULT_PROGRAMS) -> ParsedOffers:
+    """Runs parse_offer over many texts and returns columnar output.
+
+    Chunks are spread over a process pool (workers=None => os.cpu_count()).
+    Small inputs, or workers=1, are parsed inline: spawning the pool costs more than it saves.
+    On Windows the caller must be behind `if __name__ == '__main__':` (spawn re-imports it).
+    """
+    texts = texts if isinstance(texts, list) else list(texts)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(chunks))
+    if workers <= 1:
+        parts = map(_parse_offers_chunk, chunks, repeat(programs))
+        return _concat_columns(parts)
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return _concat_columns(pool.map(_parse_offers_chunk, chunks, repeat(programs, len(chunks))))
+
+def _concat_columns(parts) -> ParsedOffers:
+    out = _empty_columns()
+    for part in parts:
+        out.program.extend(part.program)
+        out.miles.extend(part.miles)
+        out.cpfs.extend(part.cpfs)
+        out.offer_cents.extend(part.offer_cents)
+        out.valid.extend(part.valid)
+    return out
+
+
 def send_whatsapp_callmebot(phone: str, apikey: str, message: str):
     """Send a WhatsApp message via CallMeBot free API (best-effort, non-blocking).
 
@@ -307,188 +1028,1111 @@ async def resolve_target(client: TelegramClient, target: str):
     - exact @username
     - group title (exact or partial, case-insensitive)
     """
-    target = (target or '').strip()
-    if re.fullmatch(r"-?\d+", target):
-        return int(target)
+    return (await resolve_targets(client, [target], cache_path=None))[0]
 
-    # Try Telethon resolution first (works for @username and some titles)
+def load_targets_cache(path: str) -> dict:
     try:
-        return await client.get_entity(target)
-    except Exception:
-        pass
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    # Fallback: scan dialogs and match by title (case-insensitive, partial)
-    wanted = norm_text(target)
-    best = None
-    async for d in client.iter_dialogs():
-        title = getattr(d, 'name', None) or ''
-        tnorm = norm_text(title)
-        if not tnorm:
-            continue
-        if tnorm == wanted:
-            return d.entity
-        if wanted and wanted in tnorm:
-            best = d.entity
-            # keep searching for exact match; otherwise the first partial match wins
-    if best is not None:
-        return best
+def save_targets_cache(path: str, cache: dict):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+def _target_cache_entry(entity) -> dict | None:
+    """id + access_hash of a resolved entity (enough to rebuild its InputPeer offline)."""
+    from telethon import utils
+    from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+    peer = utils.get_input_peer(entity)
+    title = getattr(entity, 'title', None) or sender_display_name(entity)
+    if isinstance(peer, InputPeerChannel):
+        return {'kind': 'channel', 'id': peer.channel_id, 'access_hash': peer.access_hash, 'title': title}
+    if isinstance(peer, InputPeerChat):
+        return {'kind': 'chat', 'id': peer.chat_id, 'title': title}
+    if isinstance(peer, InputPeerUser):
+        return {'kind': 'user', 'id': peer.user_id, 'access_hash': peer.access_hash, 'title': title}
+    return None
 
-    raise ValueError(f'Cannot find any entity corresponding to "{target}". Set TG_TARGET to the exact title or numeric id.')
+def _target_input_peer(entry: dict):
+    from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+    kind = entry.get('kind')
+    if kind == 'channel':
+        return InputPeerChannel(int(entry['id']), int(entry['access_hash']))
+    if kind == 'chat':
+        return InputPeerChat(int(entry['id']))
+    if kind == 'user':
+        return InputPeerUser(int(entry['id']), int(entry['access_hash']))
+    raise ValueError(f'bad targets cache entry: {entry!r}')
+
+async def resolve_targets(client: TelegramClient, targets: list, cache_path: str | None = TARGETS_CACHE_PATH) -> list:
+    """Resolves every TG_TARGETS entry (same rules as resolve_target), in order.
+
+    Ids and access hashes are kept in `cache_path` keyed by the target string. Cached
+    targets are checked with one batched get_entity call and only the ones that fail are
+    resolved again. Titles that need a dialog scan are all matched in a single
+    iter_dialogs pass instead of one scan per target.
+    """
+    cache = load_targets_cache(cache_path) if cache_path else {}
+    resolved = {}
+
+    # Numeric ids need no lookup.
+    for target in targets:
+        t = (target or '').strip()
+        if re.fullmatch(r"-?\d+", t):
+            resolved[target] = int(t)
+
+    # Cached entities: one round-trip for all of them; a failure falls back to one by one.
+    cached = [t for t in targets if t not in resolved and t in cache]
+    if cached:
+        try:
+            peers = [_target_input_peer(cache[t]) for t in cached]
+            for t, ent in zip(cached, await client.get_entity(peers)):
+                resolved[t] = ent
+        except Exception:
+            for t in cached:
+                try:
+                    resolved[t] = await client.get_entity(_target_input_peer(cache[t]))
+                except Exception:
+                    cache.pop(t, None)      # stale: resolve it again below
 
-async def main():
-    load_dotenv(dotenv_path=os.path.join(_BASE, '.env'), override=True)
+    # Try Telethon resolution first (works for @username and some titles)
+    pending = []
+    for target in targets:
+        if target in resolved:
+            continue
+        try:
+            resolved[target] = await client.get_entity((target or '').strip())
+        except Exception:
+            pending.append(target)
+
+    # Fallback: scan dialogs once and match every pending title (case-insensitive, partial)
+    if pending:
+        wanted = {t: norm_text(t) for t in pending}
+        partial = {}
+        async for d in client.iter_dialogs():
+            tnorm = norm_text(getattr(d, 'name', None) or '')
+            if not tnorm:
+                continue
+            for t, w in list(wanted.items()):
+                if tnorm == w:
+                    resolved[t] = d.entity
+                    del wanted[t]
+                    partial.pop(t, None)
+                elif w and w in tnorm:
+                    # keep searching for exact match; otherwise the first partial match wins
+                    partial.setdefault(t, d.entity)
+            if not wanted:
+                break
+        resolved.update(partial)
+
+    for target in targets:
+        if target not in resolved:
+            raise ValueError(f'Cannot find any entity corresponding to "{target}". Set TG_TARGET to the exact title or numeric id.')
+
+    if cache_path:
+        fresh = {}
+        for target in targets:
+            ent = resolved[target]
+            if isinstance(ent, int):
+                continue
+            try:
+                entry = _target_cache_entry(ent)
+            except Exception:
+                entry = None
+            if entry:
+                fresh[target] = entry
+        if fresh != {t: cache.get(t) for t in fresh}:
+            try:
+                save_targets_cache(cache_path, {**cache, **fresh})
+            except OSError as e:
+                print(f"[WARN] could not write {cache_path}: {e}")
+    return [resolved[t] for t in targets]
+
+# ── SQLite (STORAGE=sqlite) ──────────────────────────────────────────────────
+
+SQLITE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS dedupe (key BLOB PRIMARY KEY, ts INTEGER NOT NULL) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS dedupe_ts ON dedupe (ts)',
+    'CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, ts INTEGER NOT NULL, kind TEXT, '
+    'chat_id INTEGER, program TEXT, account TEXT, data TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS events_chat_ts ON events (chat_id, ts)',
+    'CREATE INDEX IF NOT EXISTS events_program_ts ON events (program, ts)',
+    'CREATE INDEX IF NOT EXISTS events_kind_ts ON events (kind, ts)',
+    'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)',
+)
+
+SQLITE_WRITES = {
+    'dedupe': 'INSERT OR REPLACE INTO dedupe (key, ts) VALUES (?, ?)',
+    'event': 'INSERT INTO events (ts, kind, chat_id, program, account, data) VALUES (?, ?, ?, ?, ?, ?)',
+    'meta':  'INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+    'expire': 'DELETE FROM dedupe WHERE ts < ?',
+}
+
+EVENT_STORE = None      # SqliteStore that append_event_log() writes to; None = events.jsonl
+
+def sqlite_connect(path: str):
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')     # readers (GUI, stats) never block the writer
+    conn.execute('PRAGMA synchronous=NORMAL')
+    for stmt in SQLITE_SCHEMA:
+        conn.execute(stmt)
+    conn.commit()
+    return conn
+
+def _event_row(rec: dict) -> tuple:
+    chat_id = rec.get('chat_id')
+    return (rec.get('ts') or int(time.time()), rec.get('kind'),
+            chat_id if isinstance(chat_id, int) else None, rec.get('program'), rec.get('account'),
+            json.dumps(rec, ensure_ascii=False))
+
+class SqliteStore:
+    """Dedupe state and event history in one SQLite database (WAL mode).
+
+    Same interface as DedupeStore, plus append_event() behind append_event_log(). Callers
+    only enqueue; a single writer thread drains the queue and commits what it finds in one
+    transaction, so the event loop never waits on disk. `seen` is still checked in memory;
+    the table is its durable copy, loaded at startup (only the keys inside `ttl`, if set).
+    """
 
-    # ── Verificação de Licença ──────────────────────────────────────────────
-    try:
-        from license import LicenseManager  # type: ignore
-        _lic_mgr = LicenseManager(Path(_BASE))
-        _lic_ok, _lic_reason = _lic_mgr.check_or_grace()
-        if not _lic_ok:
-            _msgs = {
-                'not_activated':  'Licença não ativada. Abra o MilhasUP.exe para ativar.',
-                'expired_local':  'Licença expirada. Renove no suporte.',
-                'revoked':        'Licença revogada. Contate o suporte.',
-                'grace_expired':  'Sem conexão com servidor de licença por mais de 24h.',
-            }
-            print(f'[LICENSE] BLOQUEADO — {_msgs.get(_lic_reason, _lic_reason)}', flush=True)
-            append_event_log({'ts': int(time.time()), 'kind': 'license_block',
-                              'reason': _lic_reason})
-            sys.exit(2)
-        print(f'[LICENSE] OK ({_lic_reason})', flush=True)
-    except ImportError:
-        _lic_mgr = None   # license.py não presente — modo dev sem licença
-    # ─────────────────────────────────────────────────────────────────────────
+    def __init__(self, path: str | None = None, batch: int = 500, ttl: float = 0):
+        self.path = path or DB_PATH
+        self.batch = batch
+        self.compacting = False
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        conn = sqlite_connect(self.path)
+        try:
+            self.state = self.load(conn, ttl)
+        finally:
+            conn.close()
+        self.seen = self.state['seen']
+        self._writer = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def load(conn, ttl: float = 0) -> dict:
+        seen = SeenSet(ttl)
+        since = int(time.time() - ttl) if ttl > 0 else 0
+        for key, ts in conn.execute('SELECT key, ts FROM dedupe WHERE ts >= ? ORDER BY ts', (since,)):
+            seen.add(key, ts)
+        row = conn.execute("SELECT value FROM meta WHERE name = 'last_ids'").fetchone()
+        return {'seen': seen, 'last_ids': json.loads(row[0]) if row else {}}
+
+    def record(self, key: bytes, ts: int):
+        self._queue.put(('dedupe', (key, ts)))
+        self.seen.add(key, ts)
+        if self.seen.expire():
+            self._queue.put(('expire', (self.seen.cutoff,)))
+
+    def append_event(self, rec: dict):
+        self._queue.put(('event', _event_row(rec)))
+
+    def _run(self):
+        conn = sqlite_connect(self.path)
+        stop = False
+        while not stop:
+            items = [self._queue.get()]
+            while len(items) < self.batch:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with conn:
+                    for op, row in items:
+                        if op is None:
+                            stop = True
+                        else:
+                            conn.execute(SQLITE_WRITES[op], row)
+                self.written += len(items)
+                self.batches += 1
+            except sqlite3.Error as e:
+                self.errors += 1
+                print(f'[SQLITE] falha ao gravar {len(items)} registros: {e}', flush=True)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+        conn.close()
+
+    def due(self) -> bool:
+        return False            # nothing to fold: every record is already in its table
+
+    def _checkpoint(self):
+        self.seen.expire()
+        if self.seen.ttl > 0:           # also sweeps rows whose key left memory some other way
+            self._queue.put(('expire', (self.seen.cutoff,)))
+        # last_ids moves on every message, so it is persisted here rather than per record
+        last_ids = json.dumps(self.state.get('last_ids', {}), separators=(',', ':'))
+        self._queue.put(('meta', ('last_ids', last_ids)))
+
+    def compact(self):
+        """Persists last_ids and waits until everything queued is committed."""
+        self._checkpoint()
+        self._queue.join()
+
+    async def compact_async(self):
+        if self.compacting:
+            return
+        self.compacting = True
+        try:
+            self._checkpoint()
+            await asyncio.to_thread(self._queue.join)
+        finally:
+            self.compacting = False
 
-    lock_handle = acquire_single_instance_lock()
-    if lock_handle is None:
-        print('[INFO] Another monitor instance is already running. Exiting.')
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.compact()
+        self._queue.put((None, None))
+        self._writer.join(timeout=10)
+
+    def stats(self) -> dict:
+        return {'written': self.written, 'batches': self.batches, 'queued': self._queue.qsize(),
+                'errors': self.errors, 'seen': len(self.seen), 'expired': self.seen.expired}
+
+def iter_event_lines(path: str, kinds: tuple = ()):
+    """Raw JSON lines of the event history: events.jsonl, or the events table of a .db."""
+    if not path.endswith('.db'):
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from f
         return
+    conn = sqlite3.connect(path, timeout=10)
+    try:
+        sql = 'SELECT data FROM events'
+        if kinds:
+            sql += f" WHERE kind IN ({','.join('?' * len(kinds))})"
+        for (data,) in conn.execute(sql + ' ORDER BY id', kinds):
+            yield data
+    finally:
+        conn.close()
+
+def query_events(path: str, *, since: int | None = None, until: int | None = None,
+                 chat_id: int | None = None, program: str | None = None, kind: str | None = None,
+                 limit: int | None = None) -> list[dict]:
+    """Time-range query over the events table (uses the (chat_id, ts)/(program, ts) indexes)."""
+    where, params = [], []
+    for column, op, value in (('ts', '>=', since), ('ts', '<', until), ('chat_id', '=', chat_id),
+                              ('program', '=', program), ('kind', '=', kind)):
+        if value is not None:
+            where.append(f'{column} {op} ?')
+            params.append(value)
+    sql = 'SELECT data FROM events' + (' WHERE ' + ' AND '.join(where) if where else '') + ' ORDER BY ts, id'
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    conn = sqlite3.connect(path, timeout=10)
+    try:
+        return [json.loads(data) for (data,) in conn.execute(sql, params)]
+    finally:
+        conn.close()
 
-    ap = argparse.ArgumentParser()
-    ap.add_argument('--send', action='store_true', help='actually send messages (overrides DRY_RUN=1)')
-    ap.add_argument('--dry-run', action='store_true', help='force dry run (never send)')
-    ap.add_argument('--auth', action='store_true', help='apenas autentica o Telegram e sai (cria session.session)')
-    args = ap.parse_args()
+def migrate_to_sqlite(db_path: str, state_path: str | None = None, events_path: str | None = None) -> dict:
+    """`monitor.py migrate`: imports state.json (+ journal) and events.jsonl into db_path.
 
+    Safe to run again: keys already in the table are kept, last_ids keeps the highest id per
+    chat, and events.jsonl is read from the offset where the previous run stopped.
+    """
+    source = DedupeStore(state_path or STATE_PATH)
+    events_path = events_path or EVENTS_LOG_PATH
+    counts = {'seen': 0, 'events': 0, 'invalid': 0}
+    conn = sqlite_connect(db_path)
+    try:
+        with conn:
+            cur = conn.executemany(SQLITE_WRITES['dedupe'].replace('OR REPLACE', 'OR IGNORE'), source.seen)
+            counts['seen'] = max(cur.rowcount, 0)
+            meta = dict(conn.execute('SELECT name, value FROM meta'))
+            last_ids = json.loads(meta.get('last_ids', '{}'))
+            for chat, msg_id in source.state.get('last_ids', {}).items():
+                last_ids[chat] = max(last_ids.get(chat, 0), msg_id)
+            conn.execute(SQLITE_WRITES['meta'], ('last_ids', json.dumps(last_ids, separators=(',', ':'))))
+            if os.path.exists(events_path):
+                offset = int(meta.get('events_jsonl_offset', 0))
+                if offset > os.path.getsize(events_path):
+                    offset = 0          # the log was cleared since the last migration
+                rows = []
+                with open(events_path, 'rb') as f:
+                    f.seek(offset)
+                    for raw in f:
+                        if not raw.endswith(b'\n'):
+                            break       # line still being written
+                        offset += len(raw)
+                        try:
+                            rows.append(_event_row(json.loads(raw)))
+                        except ValueError:
+                            counts['invalid'] += 1
+                conn.executemany(SQLITE_WRITES['event'], rows)
+                counts['events'] = len(rows)
+                conn.execute(SQLITE_WRITES['meta'], ('events_jsonl_offset', str(offset)))
+    finally:
+        conn.close()
+    return counts
+
+# ── Accounts (sharding TG_TARGETS over several sessions) ────────────────────
+@dataclass(frozen=True)
+class Account:
+    """One Telegram session. `name` is None in the single-account setup (TG_ACCOUNTS unset)."""
+    name: str | None
+    phone: str
+    session: str
+    api_id: int
+    api_hash: str
+    targets: tuple = ()
+
+    @property
+    def label(self) -> str:
+        return self.name or 'default'
+
+    @property
+    def targets_cache_path(self) -> str:
+        # access_hash is per account: each session keeps its own resolution cache
+        if self.name is None:
+            return TARGETS_CACHE_PATH
+        return os.path.join(_BASE, f'targets_cache_{self.name}.json')
+
+def shard_targets(targets: list, accounts: list, pinned: dict | None = None) -> dict:
+    """Splits targets over accounts: pinned ones stay put, the rest go to the least loaded.
+
+    Ties go to the first account in `accounts`, so the split is stable across restarts
+    as long as TG_TARGETS and TG_ACCOUNTS keep their order.
+    """
+    pinned = pinned or {}
+    shards = {a: [] for a in accounts}
+    owner = {}
+    for account in accounts:
+        for t in pinned.get(account, ()):
+            if t in owner:
+                raise ValueError(f'target {t!r} pinned to both {owner[t]} and {account}')
+            owner[t] = account
+            shards[account].append(t)
+    for t in targets:
+        if t not in owner:
+            account = min(accounts, key=lambda a: len(shards[a]))
+            owner[t] = account
+            shards[account].append(t)
+    return shards
+
+def load_accounts(targets: list) -> list:
+    """Accounts from the environment.
+
+    Without TG_ACCOUNTS this is the usual single session (TG_PHONE, `session`). With
+    TG_ACCOUNTS=a,b each account reads TG_<A>_PHONE, TG_<A>_SESSION (default session_a),
+    TG_<A>_API_ID/TG_<A>_API_HASH (default: the shared TG_API_ID/TG_API_HASH) and
+    TG_<A>_TARGETS (targets pinned to it); the rest of TG_TARGETS is shared out evenly.
+    """
     api_id = os.getenv('TG_API_ID')
     api_hash = os.getenv('TG_API_HASH')
-    phone = os.getenv('TG_PHONE')
-    targets_raw = os.getenv('TG_TARGETS') or os.getenv('TG_TARGET')
-
-    if not api_id or not api_hash or not phone:
-        raise SystemExit('Missing env vars. Fill .env (TG_API_ID, TG_API_HASH, TG_PHONE).')
-
-    # ── Modo --auth: só autentica e sai ───────────────────────────────────────
-    if args.auth:
-        print(f"\n=== MilhasUP Monitor — Autenticação Telegram ===")
-        print(f"Telefone: {phone}")
-        print("Conectando ao Telegram...\n")
-        auth_client = TelegramClient(os.path.join(_BASE, 'session'), int(api_id), api_hash)
-        await auth_client.connect()
-        await ensure_login(auth_client, phone, force_interactive=True)
-        await auth_client.disconnect()
-        print("\n✅ Autenticação concluída! Pode fechar esta janela.")
-        input("Pressione Enter para fechar...")
+    names = _env_list('TG_ACCOUNTS')
+    if not names:
+        phone = os.getenv('TG_PHONE')
+        if not api_id or not api_hash or not phone:
+            raise SystemExit('Missing env vars. Fill .env (TG_API_ID, TG_API_HASH, TG_PHONE).')
+        return [Account(None, phone, os.path.join(_BASE, 'session'), int(api_id), api_hash, tuple(targets))]
+    if len(set(names)) != len(names):
+        raise SystemExit(f'TG_ACCOUNTS has repeated names: {names}')
+    pinned = {name: _env_list(f'TG_{name.upper()}_TARGETS') for name in names}
+    try:
+        shards = shard_targets(targets, names, pinned)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    accounts = []
+    for name in names:
+        prefix = f'TG_{name.upper()}_'
+        phone = os.getenv(prefix + 'PHONE')
+        acc_id = os.getenv(prefix + 'API_ID') or api_id
+        acc_hash = os.getenv(prefix + 'API_HASH') or api_hash
+        if not acc_id or not acc_hash or not phone:
+            raise SystemExit(f'Missing env vars for account {name!r} ({prefix}PHONE, TG_API_ID, TG_API_HASH).')
+        session = os.getenv(prefix + 'SESSION') or f'session_{name}'
+        accounts.append(Account(name, phone, os.path.join(_BASE, session), int(acc_id), acc_hash,
+                                tuple(shards[name])))
+    return accounts
+
+def print_account_stats(path: str):
+    """`monitor.py stats accounts`: per-account load from the event history."""
+    rows = {}
+    for line in iter_event_lines(path, ('account_status', 'eligible', 'send_result', 'flood_wait')):
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        kind = rec.get('kind')
+        if kind not in ('account_status', 'eligible', 'send_result', 'flood_wait'):
+            continue
+        row = rows.setdefault(rec.get('account') or 'default', {
+            'targets': 0, 'eligible': 0, 'sent': 0, 'failed': 0, 'flood_waits': 0, 'last_ts': 0})
+        if kind == 'account_status':
+            row['targets'] = rec.get('targets', row['targets'])
+        elif kind == 'eligible':
+            row['eligible'] += 1
+        elif kind == 'send_result':
+            row['sent' if rec.get('sent_via') else 'failed'] += 1
+        else:
+            row['flood_waits'] += 1
+        row['last_ts'] = max(row['last_ts'], rec.get('ts') or 0)
+    if not rows:
+        print(f'Nenhum registro por conta em {path}.')
         return
+    total = sum(r['sent'] for r in rows.values()) or 1
+    print(f"{'conta':14s} {'grupos':>6s} {'elegíveis':>9s} {'enviadas':>8s} {'falhas':>6s} {'flood':>5s} {'carga':>6s}  último evento")
+    for name, r in sorted(rows.items()):
+        last = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r['last_ts'])) if r['last_ts'] else '-'
+        print(f"{name:14s} {r['targets']:6d} {r['eligible']:9d} {r['sent']:8d} {r['failed']:6d} "
+              f"{r['flood_waits']:5d} {r['sent'] / total:6.0%}  {last}")
+
+# ── Near-duplicate reposts (MinHash + LSH bands) ─────────────────────────────
+
+_WORD_RE = re.compile(r"[^\W\d_]+")     # words with letters; numbers are in the scope or are the price
+_MINHASH_PRIME = (1 << 61) - 1
+
+class NearDupIndex:
+    """Catches reposts that the exact dedupe key misses, within a time window.
+
+    An extra emoji, another price line or reordered sentences give a new dedupe key but
+    keep most of the words. Each offer becomes the set of its words (emoji, numbers,
+    punctuation and order ignored) and a MinHash signature of bands x rows values. Entries
+    that share a band in the same scope (chat, sender, program, miles, CPFs, so another
+    lot or another buyer is never matched) are candidates; the exact Jaccard similarity of
+    the word sets must reach `threshold`. A lookup reads `bands` buckets whatever the size of the index, and
+    entries older than `window` seconds leave from a time-ordered deque.
+    """
 
-    if not targets_raw:
-        raise SystemExit('Missing env var TG_TARGETS.')
+    __slots__ = ('threshold', 'window', 'bands', 'rows', '_perms', '_buckets', '_order',
+                 'lookups', 'hits', 'expired')
+
+    def __init__(self, threshold: float = 0.6, window: float = 3600.0, bands: int = 8, rows: int = 4):
+        self.threshold = threshold
+        self.window = window
+        self.bands = bands
+        self.rows = rows
+        # h -> (a*h + b) mod p, one pair per signature value; with the blake2b word hashes
+        # below (str hash() is salted per process) the signatures are the same on every run
+        self._perms = [(int.from_bytes(hashlib.blake2b(b'a%d' % i, digest_size=8).digest(), 'big') | 1,
+                        int.from_bytes(hashlib.blake2b(b'b%d' % i, digest_size=8).digest(), 'big'))
+                       for i in range(bands * rows)]
+        self._buckets = {}          # band key -> [entry, ...]
+        self._order = deque()       # entries (ts, scope, words, band keys), oldest first
+        self.lookups = 0
+        self.hits = 0
+        self.expired = 0
+
+    def configure(self, *, threshold: float, window: float):
+        self.threshold = threshold
+        self.window = window
+
+    def _band_keys(self, scope: tuple, words: frozenset) -> list:
+        p = _MINHASH_PRIME
+        hashes = [int.from_bytes(hashlib.blake2b(w.encode(), digest_size=8).digest(), 'big') & p
+                  for w in words]
+        sig = [min((a * h + b) % p for h in hashes) for a, b in self._perms]
+        r = self.rows
+        return [hash((scope, i, *sig[i * r:(i + 1) * r])) for i in range(self.bands)]
+
+    def claim(self, scope: tuple, text: str, ts: float) -> float | None:
+        """Similarity of the closest earlier offer in `scope`, or None after indexing this one."""
+        if self.window <= 0:
+            return None
+        self.expire(ts)
+        words = frozenset(_WORD_RE.findall(text))
+        if not words:
+            return None
+        keys = self._band_keys(scope, words)
+        self.lookups += 1
+        best = 0.0
+        for key in keys:
+            for entry in self._buckets.get(key, ()):
+                if entry[1] != scope or abs(ts - entry[0]) > self.window:
+                    continue
+                common = len(words & entry[2])
+                best = max(best, common / (len(words) + len(entry[2]) - common))
+        if best >= self.threshold:
+            self.hits += 1
+            return best
+        entry = (ts, scope, words, keys)
+        self._order.append(entry)
+        for key in keys:
+            self._buckets.setdefault(key, []).append(entry)
+        return None
 
-    targets = [t.strip() for t in targets_raw.split(',') if t.strip()]
+    def expire(self, now: float):
+        cutoff = now - self.window
+        order, buckets = self._order, self._buckets
+        while order and order[0][0] < cutoff:
+            entry = order.popleft()
+            for key in entry[3]:
+                bucket = buckets.get(key)
+                if bucket is not None and entry in bucket:
+                    bucket.remove(entry)
+                    if not bucket:
+                        del buckets[key]
+            self.expired += 1
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def stats(self) -> dict:
+        return {'entries': len(self._order), 'lookups': self.lookups, 'hits': self.hits,
+                'expired': self.expired}
+
+def near_dup_options_from_env() -> dict:
+    """NearDupIndex settings taken from the environment (see NearDupIndex.configure)."""
+    return {
+        'threshold': float(os.getenv('NEAR_DUP_THRESHOLD', '0.6') or '0.6'),
+        'window': float(os.getenv('NEAR_DUP_WINDOW_MINUTES', '60') or '60') * 60,
+    }
 
-    api_id = int(api_id)
+# ── Chat / sender names ──────────────────────────────────────────────────────
+class TTLCache:
+    """Bounded LRU whose entries expire after `ttl` seconds; counts hits and misses."""
+
+    __slots__ = ('ttl', 'maxsize', 'hits', 'misses', '_data')
+
+    def __init__(self, ttl: float = 3600.0, maxsize: int = 4096):
+        self.ttl = ttl
+        self.maxsize = max(1, maxsize)
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()      # key -> (expires_at monotonic, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None:
+            if item[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data),
+                'hit_rate': round(self.hits / total, 3) if total else None}
+
+def chat_display_name(chat, chat_id=None):
+    return (getattr(chat, 'title', None) or getattr(chat, 'username', None) or str(chat_id) or '').strip() or None
+
+def sender_display_name(sender):
+    if sender is None:
+        return None
+    name = (getattr(sender, 'first_name', None) or '').strip() or None
+    last = (getattr(sender, 'last_name', None) or '').strip() or None
+    if name and last:
+        name = f"{name} {last}".strip()
+    if not name:
+        name = (getattr(sender, 'title', None) or '').strip() or None
+    if not name:
+        name = (getattr(sender, 'username', None) or '').strip() or None
+    return name
+
+_NOT_CACHED = object()
+
+class NameCache:
+    """Chat titles and sender display names by chat_id / sender_id.
+
+    Repeat groups and senders are answered from memory instead of an MTProto round-trip
+    (event.get_chat / event.get_sender). Lookups stay best-effort: errors give None and
+    are not cached.
+    """
 
-    dry_env = os.getenv('DRY_RUN', '1').strip() == '1'
-    dry_run = dry_env          # use .env value as base; default=True (safe)
-    if args.send:              # --send CLI flag forces live
-        dry_run = False
-    if args.dry_run:           # --dry-run CLI flag forces dry
-        dry_run = True
+    def __init__(self, ttl: float = 3600.0, maxsize: int = 4096):
+        self.chats = TTLCache(ttl, maxsize)
+        self.senders = TTLCache(ttl, maxsize)
 
-    rules = {
-        'LATAM': Rule('LATAM', int(os.getenv('LATAM_THRESHOLD_PER_CPF', '50000')), os.getenv('LATAM_REPLY', '25,00')),
-        'SMILES': Rule('SMILES', int(os.getenv('SMILES_THRESHOLD_PER_CPF', '60000')), os.getenv('SMILES_REPLY', '15,50')),
-    }
+    def seed(self, entities):
+        """Pre-populates chat titles from the entities resolve_target returned."""
+        from telethon import utils
+        for ent in entities:
+            if isinstance(ent, int):
+                continue            # numeric TG_TARGETS: title unknown until the first message
+            try:
+                chat_id = utils.get_peer_id(ent)
+                # same fallback as chat_title(): an entity without a title is named by its id
+                self.chats.put(chat_id, chat_display_name(ent, chat_id))
+            except Exception:
+                pass
 
-    send_delay_seconds = float(os.getenv('SEND_DELAY_SECONDS', '2').strip() or '2')
-    whatsapp_relay_enabled = os.getenv('WHATSAPP_RELAY', '1').strip() == '1'
-    aceita_liminar = os.getenv('ACEITA_LIMINAR', '1').strip() == '1'
+    async def chat_title(self, event):
+        chat_id = getattr(event, 'chat_id', None)
+        title = self.chats.get(chat_id, _NOT_CACHED) if chat_id is not None else _NOT_CACHED
+        if title is not _NOT_CACHED:
+            return title
+        try:
+            title = chat_display_name(await event.get_chat(), chat_id)
+        except Exception:
+            return None
+        if chat_id is not None:
+            self.chats.put(chat_id, title)
+        return title
+
+    async def sender_name(self, event):
+        sender_id = getattr(event, 'sender_id', None)
+        name = self.senders.get(sender_id, _NOT_CACHED) if sender_id is not None else _NOT_CACHED
+        if name is not _NOT_CACHED:
+            return name
+        try:
+            name = sender_display_name(await event.get_sender())
+        except Exception:
+            return None
+        if sender_id is not None:
+            self.senders.put(sender_id, name)
+        return name
 
-    state = load_state()
-    seen = state.setdefault('seen', {})
+    def stats(self) -> dict:
+        return {'chats': self.chats.stats(), 'senders': self.senders.stats()}
 
-    try:
-        _log  # type: ignore  # noqa: F821
-    except NameError:
-        def _log(msg: str): pass  # type: ignore  # dev mode — sem log em arquivo
+# ── Handler metrics ──────────────────────────────────────────────────────────
+# Fixed histogram buckets: upper bounds in µs, 1-2-5 steps from 10µs to 60s (+ overflow).
+HIST_BOUNDS_US = (10, 20, 50, 100, 200, 500, 1_000, 2_000, 5_000, 10_000, 20_000, 50_000,
+                  100_000, 200_000, 500_000, 1_000_000, 2_000_000, 5_000_000, 10_000_000,
+                  30_000_000, 60_000_000)
+HANDLER_STAGES = ('parse', 'get_chat', 'get_sender', 'save_state', 'event_log',
+                  'send_queue', 'send_delay', 'reply', 'notify')
 
-    _log(f'Targets: {targets} | DRY_RUN={dry_run}')
-    _log('Criando TelegramClient...')
+class _StageSpan:
+    __slots__ = ('hist', 'stage', 't0')
 
-    client = TelegramClient(os.path.join(_BASE, 'session'), api_id, api_hash)
-    _log('Conectando ao Telegram...')
-    await client.connect()
-    _log('Conectado. Verificando sessao...')
-    await ensure_login(client, phone)
-    _log('Sessao OK. Resolvendo targets...')
+    def __init__(self, hist, stage):
+        self.hist = hist
+        self.stage = stage
 
-    entities = []
-    for t in targets:
-        _log(f'  resolve_target: {t!r}')
-        ent = await resolve_target(client, t)
-        entities.append(ent)
-        _log(f'  -> OK: {ent}')
+    def __enter__(self):
+        self.t0 = time.perf_counter()
 
-    _log(f'Todos os targets resolvidos ({len(entities)}). Registrando handler...')
-    print('---')
-    print('Targets:', targets)
-    print('Dry run:', dry_run)
-    print('Rules:', {k: {'threshold_per_cpf': v.threshold_per_cpf, 'reply': v.reply} for k,v in rules.items()})
-    print('---')
+    def __exit__(self, *exc):
+        self.hist.record(self.stage, time.perf_counter() - self.t0)
 
-    @client.on(events.NewMessage(chats=entities))
-    async def handler(event):
-        text = event.raw_text or ''
-        tnorm = norm_text(text)
+class StageHistograms:
+    """Per-stage latency histograms of the handler, kept in memory.
 
-        program = detect_program(tnorm)
-        if program not in rules:
-            return
+    `with hist.time('get_chat'): ...` adds one sample; flush() returns the counts since
+    the last flush as a `kind: "metrics"` record for events.jsonl and starts over.
+    """
 
-        # Only proceed when we can extract both miles and CPF count.
-        miles = parse_miles(text)
-        cpfs = parse_cpfs(text)
+    def __init__(self):
+        self.since = int(time.time())
+        self.stages = {}            # stage -> [counts per bucket, n, sum_us, max_us]
+
+    def time(self, stage: str) -> _StageSpan:
+        return _StageSpan(self, stage)
+
+    def record(self, stage: str, seconds: float):
+        us = seconds * 1e6
+        h = self.stages.get(stage)
+        if h is None:
+            h = self.stages[stage] = [[0] * (len(HIST_BOUNDS_US) + 1), 0, 0.0, 0.0]
+        h[0][bisect_left(HIST_BOUNDS_US, us)] += 1
+        h[1] += 1
+        h[2] += us
+        if us > h[3]:
+            h[3] = us
+
+    def flush(self) -> dict | None:
+        if not self.stages:
+            return None
+        now = int(time.time())
+        rec = {
+            'ts': now, 'kind': 'metrics', 'since': self.since,
+            'bounds_us': list(HIST_BOUNDS_US),
+            'stages': {stage: {'counts': counts, 'n': n, 'sum_us': round(total), 'max_us': round(peak)}
+                       for stage, (counts, n, total, peak) in self.stages.items()},
+        }
+        self.since = now
+        self.stages = {}
+        return rec
+
+def histogram_percentile(counts, q: float, max_us: float) -> float:
+    """Upper bound (µs) of the bucket holding the q-quantile; the overflow bucket reports max."""
+    n = sum(counts)
+    if not n:
+        return 0.0
+    rank = q * n
+    seen = 0
+    for i, c in enumerate(counts):
+        seen += c
+        if seen >= rank and c:
+            return min(HIST_BOUNDS_US[i], max_us) if i < len(HIST_BOUNDS_US) else max_us
+    return max_us
+
+def _fmt_us(us: float) -> str:
+    if us >= 1e6:
+        return f'{us / 1e6:.2f}s'
+    if us >= 1e3:
+        return f'{us / 1e3:.1f}ms'
+    return f'{us:.0f}µs'
+
+def format_stage_table(stages: dict, label: str = 'stage', width: int = 12) -> str:
+    """p50/p95/p99 per stage from the 'stages' dict of one (or merged) metrics records."""
+    lines = [f"{label:{width}s} {'n':>8s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'max':>9s}"]
+    order = [s for s in HANDLER_STAGES if s in stages] + sorted(set(stages) - set(HANDLER_STAGES))
+    for stage in order:
+        h = stages[stage]
+        p = [histogram_percentile(h['counts'], q, h['max_us']) for q in (0.50, 0.95, 0.99)]
+        lines.append(f"{stage[:width]:{width}s} {h['n']:8d} " + ' '.join(f'{_fmt_us(v):>9s}' for v in p)
+                     + f" {_fmt_us(h['max_us']):>9s}")
+    return '\n'.join(lines)
+
+def print_stage_stats(path: str):
+    """`monitor.py stats stages`: merges every metrics record of events.jsonl."""
+    merged = {}
+    records = 0
+    for line in iter_event_lines(path, ('metrics',)):
+        if '"metrics"' not in line:
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        if rec.get('kind') != 'metrics' or rec.get('bounds_us') != list(HIST_BOUNDS_US):
+            continue
+        records += 1
+        for stage, h in rec['stages'].items():
+            m = merged.setdefault(stage, {'counts': [0] * (len(HIST_BOUNDS_US) + 1),
+                                          'n': 0, 'sum_us': 0, 'max_us': 0})
+            m['counts'] = [a + b for a, b in zip(m['counts'], h['counts'])]
+            m['n'] += h['n']
+            m['sum_us'] += h['sum_us']
+            m['max_us'] = max(m['max_us'], h['max_us'])
+    if not merged:
+        print(f'Nenhum registro de métricas em {path}.')
+        return
+    print(f'{records} registros de métricas em {path}')
+    print(format_stage_table(merged))
 
-        if miles is None or cpfs is None or cpfs <= 0:
-            return
+def message_timestamp(event) -> float | None:
+    """Unix time Telegram gave the message (`message.date`, whole seconds), if known."""
+    date = getattr(getattr(event, 'message', None), 'date', None)
+    return date.timestamp() if hasattr(date, 'timestamp') else None
 
-        # Optional caps: only evaluate offers up to a max miles count (total miles in the message)
-        # Defaults match current business rules: SMILES up to 249k, LATAM up to 800k.
-        try:
-            smiles_max = int((os.getenv('SMILES_MAX_MILES', '113700') or '113700').strip())
-        except Exception:
-            smiles_max = 113700
-        try:
-            latam_max = int((os.getenv('LATAM_MAX_MILES', '800000') or '800000').strip())
-        except Exception:
-            latam_max = 800000
+def print_latency_stats(path: str):
+    """`monitor.py stats latency`: offer-to-reply percentiles per program and per group.
 
-        if program == 'SMILES' and miles > smiles_max:
-            return
-        if program == 'LATAM' and miles > latam_max:
-            return
+    Streams the send_result records of events.jsonl into the same fixed-bucket histograms
+    as `stats stages`, so memory does not grow with the log. Past 60s only max is exact.
+    """
+    tables = {key: StageHistograms() for key in ('program', 'program_net', 'group', 'group_net')}
+    records = 0
+    for line in iter_event_lines(path, ('send_result',)):
+        if '"send_result"' not in line or '"e2e_ms"' not in line:
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        if rec.get('kind') != 'send_result' or rec.get('e2e_ms') is None:
+            continue
+        records += 1
+        e2e = rec['e2e_ms'] / 1000
+        net = e2e - (rec.get('delay_ms') or 0) / 1000
+        group = str(rec.get('chat_title') or rec.get('chat_id'))
+        program = str(rec.get('program'))
+        tables['program'].record(program, e2e)
+        tables['program_net'].record(program, net)
+        tables['group'].record(group, e2e)
+        tables['group_net'].record(group, net)
+    if not records:
+        print(f'Nenhuma resposta com latência em {path}.')
+        return
+    print(f'{records} respostas em {path} (mensagem no Telegram → resposta enviada; date do Telegram tem resolução de 1s)')
+    for key, title, label, width in (
+            ('program', 'Por programa (com SEND_DELAY)', 'programa', 12),
+            ('program_net', 'Por programa (sem SEND_DELAY)', 'programa', 12),
+            ('group', 'Por grupo (com SEND_DELAY)', 'grupo', 28),
+            ('group_net', 'Por grupo (sem SEND_DELAY)', 'grupo', 28)):
+        print(f'\n{title}')
+        print(format_stage_table(tables[key].flush()['stages'], label=label, width=width))
+
+# ── Outbound replies ─────────────────────────────────────────────────────────
+class PeerCache:
+    """InputPeer of every reply/notify destination, resolved once at startup.
+
+    send_message(chat_id) or send_message('me') makes Telethon look the peer up (session
+    sqlite, or the network for a username) before the first send; an InputPeer is used
+    as is. Keys are the marked chat id of each target and the raw notify target string.
+    """
+    __slots__ = ('_peers', 'hits', 'misses')
+
+    def __init__(self):
+        self._peers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        peer = self._peers.get(key)
+        if peer is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return peer
+
+    async def warm(self, client, entities=(), names=()) -> list:
+        """Resolves targets and named peers (TG_NOTIFY_TARGET); returns one self-check row each."""
+        from telethon import utils
+        rows = []
+        for what in [*entities, *names]:
+            t0 = time.perf_counter()
+            key, error = what, None
+            try:
+                if isinstance(what, (int, str)):
+                    peer = await client.get_input_entity(what)
+                else:
+                    key, peer = utils.get_peer_id(what), utils.get_input_peer(what)
+                self._peers[key] = peer
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            rows.append({'peer': str(key), 'ms': round((time.perf_counter() - t0) * 1000, 2), 'error': error})
+        return rows
+
+    def stats(self) -> dict:
+        return {'peers': len(self._peers), 'hits': self.hits, 'misses': self.misses}
+
+def format_peer_check(rows: list) -> str:
+    lines = [f"{'peer':24s} {'ms':>8s}  status"]
+    for r in rows:
+        lines.append(f"{r['peer']:24s} {r['ms']:8.2f}  {'OK' if not r['error'] else r['error']}")
+    return '\n'.join(lines)
+
+class SendScheduler:
+    """Sends replies from one FIFO queue + worker task per chat.
+
+    The handler only calls submit() and returns. Each chat waits `delay` seconds after the
+    offer was queued and keeps `min_interval` seconds between its own sends; at most
+    `concurrency` sends are in flight across all chats, so a burst over many groups goes
+    out in parallel instead of queueing behind each other's sleeps. A FloodWaitError
+    reschedules the same send after the requested wait (up to `max_flood_wait` seconds in
+    total) instead of failing.
+    """
 
-        per_cpf = compute_per_cpf(miles, cpfs)
-        rule = rules[program]
+    def __init__(self, client, *, delay: float = 0.0, min_interval: float = 0.0,
+                 concurrency: int = 4, max_flood_wait: float = 300.0,
+                 metrics: 'StageHistograms | None' = None, account: str | None = None,
+                 peers: 'PeerCache | None' = None):
+        self.client = client
+        self.account = account
+        self.peers = peers if peers is not None else PeerCache()
+        self.delay = delay
+        self.min_interval = min_interval
+        self.max_flood_wait = max_flood_wait
+        self.metrics = metrics if metrics is not None else StageHistograms()
+        self.sent = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self._queues = {}           # chat_id -> asyncio.Queue
+        self._deferred = set()      # post-send tasks (reply-first mode)
+        self._workers = {}          # chat_id -> worker task
+        self._concurrency = max(1, concurrency)
+        self._slots = None          # asyncio.Semaphore, created inside the running loop
+
+    def submit(self, event, msg: str, send_mode: str, on_done=None):
+        """Queues a reply; on_done(sent_via, send_error, timing) is awaited after the send.
+
+        `timing` has queue_ms, delay_ms (the send delay actually slept), reply_ms (the
+        send call, FloodWait retries included) and replied_at (Unix time it returned).
+        """
+        chat_id = event.chat_id
+        q = self._queues.get(chat_id)
+        if q is None:
+            if self._slots is None:
+                self._slots = asyncio.Semaphore(self._concurrency)
+            q = self._queues[chat_id] = asyncio.Queue()
+            self._workers[chat_id] = asyncio.get_running_loop().create_task(self._worker(chat_id, q))
+        q.put_nowait((time.monotonic(), event, msg, send_mode, on_done))
+
+    def defer(self, coro):
+        """Runs post-send work as its own task, off the chat's send queue."""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._deferred.add(task)
+        task.add_done_callback(self._deferred.discard)
+
+    async def join(self):
+        """Waits until every queued reply was sent (or gave up) and its post-send work ran."""
+        for q in list(self._queues.values()):
+            await q.join()
+        while self._deferred:
+            await asyncio.gather(*self._deferred, return_exceptions=True)
+
+    def configure(self, *, delay: float, min_interval: float, concurrency: int, max_flood_wait: float):
+        """Applies new settings (hot reload). Queued replies keep their place in line."""
+        self.delay = delay
+        self.min_interval = min_interval
+        self.max_flood_wait = max_flood_wait
+        if max(1, concurrency) != self._concurrency:
+            self._concurrency = max(1, concurrency)
+            if self._slots is not None:
+                # sends already holding a slot finish on the old semaphore
+                self._slots = asyncio.Semaphore(self._concurrency)
+
+    def close(self):
+        for task in self._workers.values():
+            task.cancel()
+        self._workers.clear()
+        self._queues.clear()
+
+    def stats(self) -> dict:
+        return {'sent': self.sent, 'failed': self.failed, 'flood_waits': self.flood_waits,
+                'queued': sum(q.qsize() for q in self._queues.values()), 'chats': len(self._queues)}
+
+    async def _worker(self, chat_id, q: asyncio.Queue):
+        last_send = float('-inf')
+        while True:
+            queued_at, event, msg, send_mode, on_done = await q.get()
+            try:
+                now = time.monotonic()
+                self.metrics.record('send_queue', now - queued_at)
+                wait = max(self.delay - (now - queued_at), self.min_interval - (now - last_send))
+                if wait > 0:
+                    with self.metrics.time('send_delay'):
+                        await asyncio.sleep(wait)
+                started = time.monotonic()
+                sent_via, send_error = await self._send(event, msg, send_mode)
+                replied_at = time.time()
+                last_send = time.monotonic()
+                if sent_via:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                if on_done is not None:
+                    await on_done(sent_via, send_error, {
+                        'queue_ms': round((now - queued_at) * 1000, 1),
+                        'delay_ms': round(max(wait, 0) * 1000, 1),
+                        'reply_ms': round((last_send - started) * 1000, 1),
+                        'replied_at': replied_at,
+                    })
+            except Exception as e:
+                print(f"[WARN] send worker for chat {chat_id}: {type(e).__name__}: {e}")
+            finally:
+                q.task_done()
 
-        eligible = False
-        if program == 'LATAM':
-            eligible = per_cpf >= rule.threshold_per_cpf
+    async def _send(self, event, msg: str, send_mode: str):
+        waited = 0
+        while True:
+            try:
+                async with self._slots:
+                    with self.metrics.time('reply'):
+                        return await self._send_once(event, msg, send_mode)
+            except FloodWaitError as e:
+                self.flood_waits += 1
+                rec = {'ts': int(time.time()), 'kind': 'flood_wait',
+                       'chat_id': event.chat_id, 'seconds': e.seconds}
+                if self.account:
+                    rec['account'] = self.account
+                append_event_log(rec)
+                if waited + e.seconds > self.max_flood_wait:
+                    return None, f"FloodWaitError: {e.seconds}s (waited {waited}s, giving up)"
+                print(f"[WARN] FloodWait {e.seconds}s on chat {event.chat_id}; rescheduling.")
+                await asyncio.sleep(e.seconds)
+                waited += e.seconds
+
+    async def _send_plain(self, event, peer, msg: str):
+        # Without a cached peer, event.respond() sends to the event's own chat.
+        if peer is not None:
+            await self.client.send_message(peer, msg)
         else:
-            eligible = per_cpf > rule.threshold_per_cpf
+            await event.respond(msg)
 
-        if not eligible:
+    async def _send_once(self, event, msg: str, send_mode: str):
+        client = self.client
+        # Warm InputPeer: no entity lookup on the send path (falls back to the chat id).
+        peer = self.peers.get(event.chat_id)
+        try:
+            # Prefer reply for speed + contextual threading.
+            if send_mode == 'reply':
+                reply_to = getattr(getattr(event, 'message', None), 'id', None)
+                if peer is not None and reply_to is not None:
+                    await client.send_message(peer, msg, reply_to=reply_to)
+                else:
+                    await event.reply(msg)
+                return 'reply', None
+            # Plain send to the same chat
+            await self._send_plain(event, peer, msg)
+            return 'plain', None
+        except FloodWaitError:
+            raise
+        except Exception as e:
+            send_error = f"{type(e).__name__}: {e}"
+            print(f"[WARN] send failed ({send_error}). Falling back to plain send.")
+        try:
+            await self._send_plain(event, peer, msg)
+            return 'plain-fallback', send_error
+        except FloodWaitError:
+            raise
+        except Exception as e2:
+            return None, f"{send_error} | fallback {type(e2).__name__}: {e2}"
+
+def make_handler(client, rules: 'RuleSet', state: dict, *, dry_run: bool, send_delay_seconds: float,
+                 whatsapp_relay_enabled: bool = True, aceita_liminar: bool = True,
+                 send_mode: str = 'reply', notify_target: str = '',
+                 wa_phone: str = '', wa_apikey: str = '', ntfy_topic: str = '',
+                 prefilter: 'OfferPrefilter | None' = None,
+                 parse_cache: 'ParseCache | None' = None,
+                 metrics: 'StageHistograms | None' = None,
+                 scheduler: 'SendScheduler | None' = None,
+                 names: 'NameCache | None' = None,
+                 reply_first: bool = False,
+                 account: str | None = None,
+                 store: 'DedupeStore | None' = None,
+                 near_dups: 'NearDupIndex | None' = None):
+    """Builds the NewMessage handler.
+
+    Shared by the live monitor and `monitor.py replay`, which drives it with a fake client.
+    With several accounts there is one handler per account, all sharing `state` (so the
+    dedupe claim covers every account) and tagging their log records with `account`.
+    """
+    seen = SeenSet.of(state)
+    last_ids = state.setdefault('last_ids', {})     # chat_id -> last message id seen (catch_up)
+    if store is None:
+        store = DedupeStore(state=state)
+    if prefilter is None:
+        prefilter = OfferPrefilter(rules.programs)
+    if parse_cache is None:
+        parse_cache = ParseCache(rules.programs)
+    if metrics is None:
+        metrics = StageHistograms()
+    if scheduler is None:
+        scheduler = SendScheduler(client, delay=send_delay_seconds, metrics=metrics)
+    if names is None:
+        names = NameCache()
+    tag = {'account': account} if account else {}
+
+    async def handler(event):
+        msg_id = getattr(getattr(event, 'message', None), 'id', None)
+        if isinstance(msg_id, int):
+            chat_key = str(event.chat_id)
+            if msg_id > last_ids.get(chat_key, 0):
+                last_ids[chat_key] = msg_id
+        text = event.raw_text or ''
+        if not prefilter(text):
             return
+        with metrics.time('parse'):
+            lots = parse_cache(text)
+            decisions = [d for d in map(rules.evaluate, lots) if d.eligible]
+        for decision in decisions:
+            await handle_lot(event, text, decision, multi_lot=len(lots) > 1)
+
+    async def handle_lot(event, text: str, decision: Decision, multi_lot: bool):
+        program = decision.program
+        miles = decision.miles
+        cpfs = decision.cpfs
+        per_cpf = decision.per_cpf
+        rule = rules[program]
 
         # Filtra ofertas com palavra "liminar" se configurado para não aceitar
         if not aceita_liminar and 'liminar' in text.lower():
@@ -502,193 +2146,897 @@ async def main():
 
         # Dedupe per-chat: the same proposal can appear in multiple groups and we want to reply in each one.
         chat_id = getattr(event, 'chat_id', None)
+        tnorm = norm_text(text)
         key_src = f"{program}|{chat_id}|{tnorm}|{miles}|{cpfs}|{per_cpf}"
-        key = sha1(key_src)
-
-        # Get chat/group info (best-effort)
-        chat_title = None
-        try:
-            chat = await event.get_chat()
-            chat_title = (getattr(chat, 'title', None) or getattr(chat, 'username', None) or str(chat_id) or '').strip() or None
-        except Exception:
-            pass
+        key = dedupe_key(key_src)
 
         if key in seen:
             return
+        if near_dups is not None:
+            # Repost with small edits; the window uses Telegram's date, so catch-up judges old messages right
+            scope = (chat_id, getattr(event, 'sender_id', None), program, miles, cpfs)
+            similar = near_dups.claim(scope, tnorm, message_timestamp(event) or time.time())
+            if similar is not None:
+                append_event_log({
+                    'ts': int(time.time()), 'kind': 'skipped', 'program': program,
+                    'reason': 'quase duplicada', 'similarity': round(similar, 2),
+                    'chat_id': chat_id, 'miles': miles, 'cpfs': cpfs, **tag,
+                })
+                return
+        ts = int(time.time())
+        # Claimed before any await, so a repost handled meanwhile is skipped.
+        # Only the digest is kept; the offer itself goes to the eligible record below.
+        seen.add(key, ts)
+
+        offer_cents = decision.offer_cents
+        msg = decision.reply
+        if multi_lot:
+            # Several lots in one message: say which one each price is for.
+            msg = f"{program} {format_miles(miles)}: {msg}"
+
+        async def record_eligible():
+            """Chat/sender names, state.json and the eligible log record."""
+            # Get chat/group info (best-effort, cached per chat_id)
+            with metrics.time('get_chat'):
+                chat_title = await names.chat_title(event)
+
+            # Try to capture sender display name (best-effort, cached per sender_id)
+            with metrics.time('get_sender'):
+                sender_name = await names.sender_name(event)
+
+            with metrics.time('save_state'):
+                store.record(key, ts)
+            if store.due():
+                scheduler.defer(store.compact_async())
+
+            print(f"[ELIGIBLE] {program} miles={miles} cpfs={cpfs} per_cpf={per_cpf} offer={format_price_cents(offer_cents) if offer_cents is not None else None} -> {msg} | dry_run={dry_run} | sender={sender_name} | chat={chat_title or chat_id}")
+
+            # Write a machine-readable event record
+            with metrics.time('event_log'):
+                append_event_log({
+                    'ts': ts,
+                    'kind': 'eligible',
+                    'key': key.hex(),
+                    'program': program,
+                    'chat_id': chat_id,
+                    'chat_title': chat_title,
+                    'miles': miles,
+                    'cpfs': cpfs,
+                    'per_cpf': per_cpf,
+                    'offer_price_cents': offer_cents,
+                    'rule_reply': rule.reply,
+                    'final_reply': msg,
+                    'dry_run': dry_run,
+                    'send_mode': send_mode,
+                    'sender': sender_name,
+                    'text': text,
+                    **tag,
+                })
+            return chat_title, sender_name
+
+        async def after_send(sent_via, send_error, timing, chat_title, sender_name):
+            """send_result log, WhatsApp relay record and notifications."""
+            # Offer-to-reply latency: message.date (Telegram) until the send call returned
+            latency = {'delay_ms': timing['delay_ms'], 'reply_ms': timing['reply_ms']}
+            posted = message_timestamp(event)
+            if sent_via and posted is not None:
+                latency['e2e_ms'] = round((timing['replied_at'] - posted) * 1000)
+
+            # Record send result
+            with metrics.time('event_log'):
+                append_event_log({
+                    'ts': int(time.time()),
+                    'kind': 'send_result',
+                    'program': program,
+                    'chat_id': chat_id,
+                    'chat_title': chat_title,
+                    'miles': miles,
+                    'cpfs': cpfs,
+                    'per_cpf': per_cpf,
+                    'offer_price_cents': offer_cents,
+                    'rule_reply': rule.reply,
+                    'final_reply': msg,
+                    'sent_via': sent_via,
+                    'sender': sender_name,
+                    'error': send_error,
+                    **latency,
+                    **tag,
+                })
+
+            if not sent_via:
+                return
+
+            # Queue a WhatsApp relay event (OpenClaw will forward it)
+            if whatsapp_relay_enabled:
+                append_whatsapp_event({
+                    # Wall-clock time when we queued the relay event
+                    'ts': int(time.time()),
+                    'kind': 'telegram_auto_reply',
+                    'program': program,
+                    'group': chat_title,
+                    'chat_id': chat_id,
+                    # Telegram message id (stable dedupe key across restarts)
+                    'msg_id': getattr(getattr(event, 'message', None), 'id', None),
+                    'sender': sender_name,
+                    'miles': miles,
+                    'cpfs': cpfs,
+                    'per_cpf': per_cpf,
+                    'offer': format_price_cents(offer_cents) if offer_cents is not None else None,
+                    'reply': msg,
+                    'sent_via': sent_via,
+                })
+
+            # Build shared summary text (used by both Telegram and WhatsApp notify)
+            summary = (
+                f"[AUTO] {program} | {miles}/{cpfs} = {per_cpf}/CPF | offer="
+                f"{format_price_cents(offer_cents) if offer_cents is not None else '??'} | "
+                f"reply {msg} via {sent_via} | group: {chat_title or chat_id} | from: {sender_name or '??'}"
+            )
+
+            # Optional: notify to Saved Messages / another chat via Telegram
+            if notify_target:
+                with metrics.time('notify'):
+                    try:
+                        await client.send_message(scheduler.peers.get(notify_target, notify_target), summary)
+                    except Exception as e:
+                        append_event_log({'ts': int(time.time()), 'kind': 'notify_error', 'error': str(e)})
+
+            # Optional: notify via WhatsApp (CallMeBot free API)
+            if wa_phone and wa_apikey:
+                import threading
+                threading.Thread(
+                    target=send_whatsapp_callmebot,
+                    args=(wa_phone, wa_apikey, summary),
+                    daemon=True
+                ).start()
+
+            # Optional: push notification via ntfy.sh (free, Android/iOS)
+            if ntfy_topic:
+                import threading
+                threading.Thread(
+                    target=send_ntfy,
+                    args=(ntfy_topic, summary),
+                    daemon=True
+                ).start()
+
+        if reply_first and not dry_run:
+            # Fast path: nothing but the decision and the dedupe check runs before the reply.
+            # Names, state.json, logs and notifications follow once it went out, off the
+            # chat's send queue so the next reply in this chat does not wait for them.
+            async def post_send(sent_via, send_error, timing):
+                chat_title, sender_name = await record_eligible()
+                await after_send(sent_via, send_error, timing, chat_title, sender_name)
+
+            async def on_sent(sent_via, send_error, timing):
+                scheduler.defer(post_send(sent_via, send_error, timing))
+
+            scheduler.submit(event, msg, send_mode, on_sent)
+            return
 
-        # Try to capture sender display name (best-effort)
-        sender_name = None
-        try:
-            sender = await event.get_sender()
-            if sender is not None:
-                sender_name = (getattr(sender, 'first_name', None) or '').strip() or None
-                last = (getattr(sender, 'last_name', None) or '').strip() or None
-                if sender_name and last:
-                    sender_name = f"{sender_name} {last}".strip()
-                if not sender_name:
-                    sender_name = (getattr(sender, 'title', None) or '').strip() or None
-                if not sender_name:
-                    sender_name = (getattr(sender, 'username', None) or '').strip() or None
-        except Exception:
-            pass
+        chat_title, sender_name = await record_eligible()
+        if dry_run:
+            return
 
-        ts = int(time.time())
-        seen[key] = {
-            'ts': ts,
-            'program': program,
-            'miles': miles,
-            'cpfs': cpfs,
-            'per_cpf': per_cpf,
-            'sender': sender_name,
-            'text': text[:500]
-        }
-        save_state(state)
+        # Small delay (anti-spam / mimic human latency), rate limits and FloodWait are handled
+        # by the scheduler; the rest runs once the reply went out.
+        async def on_sent(sent_via, send_error, timing):
+            await after_send(sent_via, send_error, timing, chat_title, sender_name)
+
+        scheduler.submit(event, msg, send_mode, on_sent)
+
+    return handler
+
+# ── Raw update filter (before NewMessage events are built) ───────────────────
+def target_peer_ids(entities) -> frozenset:
+    """Marked ids (event.chat_id form) of the targets; a bare positive id may be any peer type."""
+    from telethon import utils
+    ids = set()
+    for ent in entities:
+        if isinstance(ent, int) and ent > 0:
+            ids.update(utils.get_peer_id(cls(ent)) for cls in (PeerUser, PeerChat, PeerChannel))
+        elif isinstance(ent, int):
+            ids.add(ent)
+        else:
+            ids.add(utils.get_peer_id(ent))
+    return frozenset(ids)
 
-        # Never bid below the offered price in the message.
-        offer_cents = parse_offer_price_cents(text)
+class RawTargetFilter:
+    """Raw-update callback that only builds a NewMessage event for target chats.
 
-        # Rule reply is a string like "15,50". Convert it to cents.
-        rule_reply_cents = None
-        try:
-            rr = rule.reply.strip().replace('.', ',')
-            m = re.fullmatch(r"(\d{1,2}),(\d{2})", rr)
-            if m:
-                rule_reply_cents = int(m.group(1)) * 100 + int(m.group(2))
-        except Exception:
-            rule_reply_cents = None
-
-        final_cents = rule_reply_cents
-        if offer_cents is not None and rule_reply_cents is not None:
-            final_cents = max(rule_reply_cents, offer_cents)
-        msg = format_price_cents(final_cents) if final_cents is not None else rule.reply
-
-        print(f"[ELIGIBLE] {program} miles={miles} cpfs={cpfs} per_cpf={per_cpf} offer={format_price_cents(offer_cents) if offer_cents is not None else None} -> {msg} | dry_run={dry_run} | sender={sender_name} | chat={chat_title or chat_id}")
-
-        # Write a machine-readable event record
-        append_event_log({
-            'ts': ts,
-            'kind': 'eligible',
-            'program': program,
-            'chat_id': chat_id,
-            'chat_title': chat_title,
-            'miles': miles,
-            'cpfs': cpfs,
-            'per_cpf': per_cpf,
-            'offer_price_cents': offer_cents,
-            'rule_reply': rule.reply,
-            'final_reply': msg,
-            'dry_run': dry_run,
-            'send_mode': os.getenv('SEND_MODE', 'reply').strip().lower(),
-            'sender': sender_name,
-            'text': text
-        })
+    events.NewMessage(chats=...) builds the full event (message init, entity lookups)
+    for every update of every dialog the account is in, and only then drops the ones from
+    other chats. This callback reads the peer id straight off the update and promotes
+    just the matching ones, the same way Telethon's dispatcher would.
+    Register with `events.Raw(types=RawTargetFilter.UPDATE_TYPES)`.
+    """
+    UPDATE_TYPES = (UpdateNewChannelMessage, UpdateNewMessage, UpdateShortChatMessage, UpdateShortMessage)
+
+    __slots__ = ('client', 'handler', 'ids', 'seen', 'accepted')
+
+    def __init__(self, client, handler, ids: frozenset):
+        self.client = client
+        self.handler = handler
+        self.ids = ids              # swapped as a whole on retarget
+        self.seen = 0
+        self.accepted = 0
+
+    def peer_id(self, update) -> int | None:
+        """Marked chat id of a message update, or None for anything else (service messages too)."""
+        msg = getattr(update, 'message', None)
+        if type(msg) is Message:
+            peer = msg.peer_id
+            cls = type(peer)
+            if cls is PeerChannel:
+                return -1000000000000 - peer.channel_id
+            if cls is PeerChat:
+                return -peer.chat_id
+            if cls is PeerUser:
+                return peer.user_id
+            return None
+        if type(update) is UpdateShortChatMessage:
+            return -update.chat_id
+        if type(update) is UpdateShortMessage:
+            return update.user_id
+        return None
 
-        if dry_run:
+    async def __call__(self, update):
+        self.seen += 1
+        if self.peer_id(update) not in self.ids:
             return
+        event = events.NewMessage.build(update, None, self.client._self_id)
+        if event is None:
+            return
+        self.accepted += 1
+        # What telethon's EventBuilderDict does for the events it builds itself.
+        event.original_update = update
+        event._entities = getattr(update, '_entities', {})
+        event._set_client(self.client)
+        await self.handler(event)
+
+    def stats(self) -> dict:
+        return {'seen': self.seen, 'accepted': self.accepted, 'dropped': self.seen - self.accepted}
+
+# ── Gap catch-up (restarts and reconnects) ───────────────────────────────────
+class CatchUpEvent:
+    """A message fetched by catch_up(), passed to the handler as if it were a NewMessage event."""
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+    def __getattr__(self, item):
+        # raw_text, chat_id, sender_id, reply(), get_chat(), get_sender() all live on Message
+        return getattr(self.message, item)
+
+async def catch_up(client, handler, entities: list, last_ids: dict, *, max_age: float,
+                   concurrency: int = 4, limit: int = 200, since: dict | None = None) -> dict:
+    """Runs `handler` over the messages posted after `last_ids[chat]` in each target.
+
+    `since` is a copy of last_ids taken when the gap began (before the handlers were
+    registered, or when the connection was found down): the live handler moves last_ids
+    on meanwhile, and one live message must not make the scan skip the whole gap.
+
+    Only chats seen before are fetched (a new target starts from its next live message),
+    at most `concurrency` of them at a time. Messages older than `max_age` seconds are
+    never handled: the scan stops at the first one, so an offer from hours ago is not
+    answered after a long outage. Dedupe still applies, so a message that also arrives
+    live is answered once.
+    """
+    from telethon import utils
+    slots = asyncio.Semaphore(max(1, concurrency))
+    totals = {'chats': 0, 'fetched': 0, 'handled': 0, 'stale': 0}
+
+    async def one(entity):
+        chat_key = str(entity if isinstance(entity, int) else utils.get_peer_id(entity))
+        min_id = (last_ids if since is None else since).get(chat_key)
+        if not min_id:
+            return
+        cutoff = time.time() - max_age
+        fresh = []
+        async with slots:
+            totals['chats'] += 1
+            async for m in client.iter_messages(entity, min_id=min_id, limit=limit):   # newest first
+                totals['fetched'] += 1
+                if m.date is not None and m.date.timestamp() < cutoff:
+                    totals['stale'] += 1
+                    last_ids[chat_key] = max(last_ids.get(chat_key, 0), m.id)
+                    break
+                fresh.append(m)
+        for m in reversed(fresh):           # oldest first, like live updates
+            await handler(CatchUpEvent(m))
+            totals['handled'] += 1
+
+    results = await asyncio.gather(*(one(e) for e in entities), return_exceptions=True)
+    totals['errors'] = [f"{type(r).__name__}: {r}" for r in results if isinstance(r, Exception)]
+    return totals
+
+# ── Hot reload (.env) ────────────────────────────────────────────────────────
+def handler_options_from_env() -> dict:
+    """make_handler keyword arguments taken from the environment (re-read on every reload)."""
+    return {
+        'send_delay_seconds': float(os.getenv('SEND_DELAY_SECONDS', '2').strip() or '2'),
+        'whatsapp_relay_enabled': os.getenv('WHATSAPP_RELAY', '1').strip() == '1',
+        'aceita_liminar': os.getenv('ACEITA_LIMINAR', '1').strip() == '1',
+        'send_mode': os.getenv('SEND_MODE', 'reply').strip().lower(),
+        'notify_target': (os.getenv('TG_NOTIFY_TARGET') or '').strip(),
+        'wa_phone': (os.getenv('WHATSAPP_NOTIFY_PHONE') or '').strip(),
+        'wa_apikey': (os.getenv('WHATSAPP_CALLMEBOT_APIKEY') or '').strip(),
+        'ntfy_topic': (os.getenv('NTFY_TOPIC') or '').strip(),
+        'reply_first': os.getenv('REPLY_FIRST', '0').strip() == '1',
+    }
+
+def scheduler_options_from_env() -> dict:
+    """SendScheduler settings taken from the environment (see SendScheduler.configure)."""
+    return {
+        'delay': float(os.getenv('SEND_DELAY_SECONDS', '2').strip() or '2'),
+        'min_interval': float(os.getenv('SEND_MIN_INTERVAL_SECONDS', '0') or '0'),
+        'concurrency': int(os.getenv('SEND_CONCURRENCY', '4') or '4'),
+        'max_flood_wait': float(os.getenv('SEND_MAX_FLOOD_WAIT_SECONDS', '300') or '300'),
+    }
+
+# Keys a running monitor cannot apply: they pick the sessions it is logged in with...
+_RESTART_ENV_RE = re.compile(r"STORAGE|TG_(API_ID|API_HASH|PHONE|ACCOUNTS)|TG_\w+_(PHONE|SESSION|API_ID|API_HASH)")
+# ...or main() reads them once at startup (dedupe store, name cache, update filter, timers).
+_STARTUP_ENV_RE = re.compile(r"DEDUPE_(TTL_HOURS|COMPACT_EVERY)|NAME_CACHE_(TTL_SECONDS|SIZE)|METRICS_FLUSH_SECONDS"
+                             r"|CATCHUP_MAX_AGE_SECONDS|RAW_UPDATE_FILTER|ENV_RELOAD_SECONDS")
+
+def restart_required_keys(changed: list, *, startup: bool = True) -> list:
+    """Changed keys that need a restart; startup=False keeps only the session keys."""
+    return [k for k in changed if _RESTART_ENV_RE.fullmatch(k) or (startup and _STARTUP_ENV_RE.fullmatch(k))]
+
+class EnvWatcher:
+    """Polls the mtime of .env and copies the file into os.environ when it changes.
+
+    poll() only reads the file; the caller checks the new values inside staged() and
+    calls apply() once they are accepted, so a rejected .env never reaches os.environ.
+    Keys deleted from the file are removed from os.environ too, so their defaults come
+    back instead of the stale value.
+    """
+    __slots__ = ('path', 'mtime', 'values', 'pending')
 
-        # Small delay before sending (anti-spam / mimic human latency)
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = self._mtime()
+        self.values = dotenv_values(path) if self.mtime is not None else {}
+        self.pending = self.values
+
+    def _mtime(self):
         try:
-            import asyncio
-            await asyncio.sleep(send_delay_seconds)
-        except Exception:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def poll(self) -> list | None:
+        """Keys whose value changed since the last apply(), or None if the file did not change."""
+        mtime = self._mtime()
+        if mtime is None or mtime == self.mtime:
+            return None
+        self.mtime = mtime
+        values = self.pending = dotenv_values(self.path)
+        return sorted(k for k in set(values) | set(self.values) if values.get(k) != self.values.get(k))
+
+    def apply(self):
+        """Copies the last polled file into os.environ."""
+        values = self.pending
+        for k in set(self.values) - set(values):
+            os.environ.pop(k, None)
+        for k, v in values.items():
+            if v is not None:
+                os.environ[k] = v
+        self.values = values
+
+    @contextmanager
+    def staged(self):
+        """os.environ as apply() would leave it, put back on exit. Do not await inside."""
+        current = self.values
+        saved = {k: os.environ.get(k) for k in set(current) | set(self.pending)}
+        self.apply()
+        try:
+            yield
+        finally:
+            self.values = current
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+class HandlerSlot:
+    """NewMessage callback whose handler can be swapped while the client runs.
+
+    Registered once per account; a reload only rebinds `handler`, so events already
+    being handled finish with the old rules and the next one sees the new ones.
+    """
+    __slots__ = ('handler',)
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    async def __call__(self, event):
+        await self.handler(event)
+
+# ── Replay (offline backtest over a Telegram Desktop JSON export) ────────────
+# Telegram Desktop exports bare ids; Telethon's event.chat_id uses the "marked" form.
+_EXPORT_CHANNEL_TYPES = {'private_supergroup', 'public_supergroup', 'private_channel', 'public_channel'}
+
+def _export_chat_id(chat: dict):
+    cid = chat.get('id')
+    if not isinstance(cid, int):
+        return cid
+    if chat.get('type') in _EXPORT_CHANNEL_TYPES:
+        return int(f'-100{cid}')
+    if chat.get('type') == 'private_group':
+        return -cid
+    return cid
+
+def _export_text(text) -> str:
+    # "text" is either a plain string or a list mixing strings and {"type", "text"} entities.
+    if isinstance(text, str):
+        return text
+    if isinstance(text, list):
+        return ''.join(part if isinstance(part, str) else (part.get('text') or '') for part in text)
+    return ''
+
+def _export_date(msg: dict):
+    # Newer exports carry "date_unixtime" (a string); "date" is local time without offset.
+    unix = msg.get('date_unixtime')
+    if unix:
+        try:
+            return datetime.fromtimestamp(int(unix), timezone.utc)
+        except (TypeError, ValueError, OverflowError):
             pass
+    try:
+        return datetime.fromisoformat(msg['date'])
+    except (KeyError, TypeError, ValueError):
+        return None
 
-        send_mode = os.getenv('SEND_MODE', 'reply').strip().lower()
+def iter_export_messages(path: str):
+    """Yields (chat, message) for every plain message of a Telegram Desktop JSON export.
 
-        sent_via = None
-        send_error = None
+    Accepts both a single-chat export and a full account export (chats.list).
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if 'messages' in data:
+        chats = [data]
+    else:
+        chats = (data.get('chats') or {}).get('list') or []
+    for chat in chats:
+        for msg in chat.get('messages') or []:
+            if msg.get('type', 'message') != 'message':
+                continue
+            yield chat, msg
+
+class _ReplayPeer:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+class ReplayEvent:
+    """The subset of a Telethon NewMessage event that the handler uses."""
+
+    def __init__(self, client, chat: dict, msg: dict):
+        self.client = client
+        self.raw_text = _export_text(msg.get('text'))
+        self.chat_id = _export_chat_id(chat)
+        self.chat_title = chat.get('name')
+        self.sender_name = msg.get('from')
+        self.sender_id = msg.get('from_id') or self.sender_name
+        self.message = _ReplayPeer(id=msg.get('id'), date=_export_date(msg))
+
+    async def get_chat(self):
+        return _ReplayPeer(title=self.chat_title, username=None)
+
+    async def get_sender(self):
+        return _ReplayPeer(first_name=self.sender_name, last_name=None, title=None, username=None)
+
+    async def reply(self, msg):
+        self.client.sent.append((self, msg, 'reply'))
+
+    async def respond(self, msg):
+        self.client.sent.append((self, msg, 'plain'))
+
+class ReplayClient:
+    """Stands in for TelegramClient: records every send instead of talking to Telegram."""
+
+    def __init__(self):
+        self.sent = []          # (event, msg, 'reply' | 'plain'), in send order
+
+async def replay(path: str, rules: 'RuleSet', *, aceita_liminar: bool = True, send_mode: str = 'reply',
+                 reply_first: bool = False, near_dups: 'NearDupIndex | None' = None):
+    """Runs the live handler over an export and prints the messages it would answer.
+
+    Same parse / eligibility / dedupe / reply-price code path as the monitor (the handler
+    runs with dry_run=False against ReplayClient), with no send delay and no notifications.
+    State and event logs go to a temporary folder, never to the real state.json/events.jsonl.
+    """
+    import contextlib
+    import io
+    import tempfile
+
+    global STATE_PATH, EVENTS_LOG_PATH, WHATSAPP_EVENTS_PATH
+    paths = (STATE_PATH, EVENTS_LOG_PATH, WHATSAPP_EVENTS_PATH)
+
+    client = ReplayClient()
+    prefilter = OfferPrefilter(rules.programs)
+    parse_cache = ParseCache(rules.programs)
+    metrics = StageHistograms()
+    scheduler = SendScheduler(client, metrics=metrics)
+    names = NameCache()
+    handler = make_handler(
+        client, rules, {'seen': {}},
+        dry_run=False,
+        send_delay_seconds=0,
+        whatsapp_relay_enabled=False,
+        aceita_liminar=aceita_liminar,
+        send_mode=send_mode,
+        prefilter=prefilter,
+        parse_cache=parse_cache,
+        metrics=metrics,
+        scheduler=scheduler,
+        names=names,
+        reply_first=reply_first,
+        near_dups=near_dups,
+    )
+
+    total = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        STATE_PATH = os.path.join(tmp, 'state.json')
+        EVENTS_LOG_PATH = os.path.join(tmp, 'events.jsonl')
+        WHATSAPP_EVENTS_PATH = os.path.join(tmp, 'whatsapp-events.jsonl')
         try:
-            # Prefer reply for speed + contextual threading.
-            if send_mode == 'reply':
-                await event.reply(msg)
-                sent_via = 'reply'
-            else:
-                # Plain send to the same chat
-                await client.send_message(event.chat_id, msg)
-                sent_via = 'plain'
-        except Exception as e:
-            send_error = f"{type(e).__name__}: {e}"
-            print(f"[WARN] send failed ({send_error}). Falling back to plain send.")
-            try:
-                await client.send_message(event.chat_id, msg)
-                sent_via = 'plain-fallback'
-            except Exception as e2:
-                send_error = f"{send_error} | fallback {type(e2).__name__}: {e2}"
-                raise
-
-        # Record send result
-        append_event_log({
-            'ts': int(time.time()),
-            'kind': 'send_result',
-            'program': program,
-            'chat_id': chat_id,
-            'chat_title': chat_title,
-            'miles': miles,
-            'cpfs': cpfs,
-            'per_cpf': per_cpf,
-            'offer_price_cents': offer_cents,
-            'rule_reply': rule.reply,
-            'final_reply': msg,
-            'sent_via': sent_via,
-            'sender': sender_name,
-            'error': send_error,
-        })
-
-        # Queue a WhatsApp relay event (OpenClaw will forward it)
-        if whatsapp_relay_enabled:
-            append_whatsapp_event({
-                # Wall-clock time when we queued the relay event
-                'ts': int(time.time()),
-                'kind': 'telegram_auto_reply',
-                'program': program,
-                'group': chat_title,
-                'chat_id': chat_id,
-                # Telegram message id (stable dedupe key across restarts)
-                'msg_id': getattr(getattr(event, 'message', None), 'id', None),
-                'sender': sender_name,
-                'miles': miles,
-                'cpfs': cpfs,
-                'per_cpf': per_cpf,
-                'offer': format_price_cents(offer_cents) if offer_cents is not None else None,
-                'reply': msg,
-                'sent_via': sent_via,
-            })
+            t0 = time.perf_counter()
+            # The handler prints one [ELIGIBLE] line per offer; the summary below replaces it.
+            with contextlib.redirect_stdout(io.StringIO()):
+                for chat, msg in iter_export_messages(path):
+                    event = ReplayEvent(client, chat, msg)
+                    await handler(event)
+                    total += 1
+                await scheduler.join()
+            elapsed = time.perf_counter() - t0
+        finally:
+            scheduler.close()
+            STATE_PATH, EVENTS_LOG_PATH, WHATSAPP_EVENTS_PATH = paths
+
+    for event, msg, via in client.sent:
+        text = event.raw_text.replace('\n', ' ')
+        if len(text) > 80:
+            text = text[:77] + '...'
+        print(f"{event.message.date}  {event.chat_title or event.chat_id}  #{event.message.id}  -> {msg} ({via})  | {text}")
+
+    rate = total / elapsed if elapsed > 0 else float('inf')
+    print('---')
+    print(f'Mensagens: {total} | respondidas: {len(client.sent)} | prefiltro: {prefilter.stats()}')
+    print(f'Cache de parse: {parse_cache.stats()} | nomes: {names.stats()}')
+    if near_dups is not None:
+        print(f'Quase duplicadas: {near_dups.stats()}')
+    print(f'Tempo: {elapsed:.3f}s | {rate:,.0f} msg/s')
+    rec = metrics.flush()
+    if rec:
+        print(format_stage_table(rec['stages']))
+    return client.sent
+
+async def main():
+    global EVENT_STORE
+    load_dotenv(dotenv_path=os.path.join(_BASE, '.env'), override=True)
 
-        # Build shared summary text (used by both Telegram and WhatsApp notify)
-        summary = (
-            f"[AUTO] {program} | {miles}/{cpfs} = {per_cpf}/CPF | offer="
-            f"{format_price_cents(offer_cents) if offer_cents is not None else '??'} | "
-            f"reply {msg} via {sent_via} | group: {chat_title or chat_id} | from: {sender_name or '??'}"
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--send', action='store_true', help='actually send messages (overrides DRY_RUN=1)')
+    ap.add_argument('--dry-run', action='store_true', help='force dry run (never send)')
+    ap.add_argument('--auth', action='store_true', help='apenas autentica o Telegram e sai (cria session.session)')
+    ap.add_argument('command', nargs='?', choices=['replay', 'stats', 'migrate'],
+                    help='replay <export.json>: roda as regras sobre um export JSON do Telegram Desktop | '
+                         'stats stages: p50/p95/p99 de cada etapa do handler (events.jsonl) | '
+                         'stats accounts: carga por conta (TG_ACCOUNTS) | '
+                         'stats latency: mensagem → resposta por programa e por grupo | '
+                         'migrate [banco.db]: importa state.json e events.jsonl para o SQLite')
+    ap.add_argument('path', nargs='?', help='arquivo de entrada do comando (ou o relatório, para stats)')
+    args = ap.parse_args()
+    sqlite_storage = os.getenv('STORAGE', 'json').strip().lower() == 'sqlite'
+
+    # ── Comandos offline (não conectam ao Telegram, não pegam o lock) ─────────
+    if args.command == 'replay':
+        if not args.path:
+            ap.error('replay requer o caminho do export JSON')
+        await replay(
+            args.path, RuleSet.from_env(),
+            aceita_liminar=os.getenv('ACEITA_LIMINAR', '1').strip() == '1',
+            send_mode=os.getenv('SEND_MODE', 'reply').strip().lower(),
+            reply_first=os.getenv('REPLY_FIRST', '0').strip() == '1',
+            near_dups=NearDupIndex(**near_dup_options_from_env()),
         )
+        return
+    if args.command == 'stats':
+        if args.path not in ('stages', 'accounts', 'latency'):
+            ap.error('uso: monitor.py stats stages|accounts|latency')
+        events_path = DB_PATH if sqlite_storage else EVENTS_LOG_PATH
+        if not os.path.exists(events_path):
+            print(f'{events_path} não existe.')
+            return
+        if args.path == 'stages':
+            print_stage_stats(events_path)
+        elif args.path == 'latency':
+            print_latency_stats(events_path)
+        else:
+            print_account_stats(events_path)
+        return
+    if args.command == 'migrate':
+        db_path = args.path or DB_PATH
+        counts = migrate_to_sqlite(db_path)
+        print(f"{db_path}: {counts['seen']} chaves de dedupe e {counts['events']} eventos importados"
+              + (f" ({counts['invalid']} linhas inválidas ignoradas)" if counts['invalid'] else '') + '.')
+        if not sqlite_storage:
+            print('Para usar o banco, defina STORAGE=sqlite no .env.')
+        return
+
+    dedupe_ttl = float(os.getenv('DEDUPE_TTL_HOURS', '48') or '0') * 3600
+    if sqlite_storage:
+        EVENT_STORE = SqliteStore(DB_PATH, ttl=dedupe_ttl)
+        atexit.register(EVENT_STORE.close)      # also covers the sys.exit() of the license gate
+
+    # ── Verificação de Licença ──────────────────────────────────────────────
+    try:
+        from license import LicenseManager  # type: ignore
+        _lic_mgr = LicenseManager(Path(_BASE))
+        _lic_ok, _lic_reason = _lic_mgr.check_or_grace()
+        if not _lic_ok:
+            _msgs = {
+                'not_activated':  'Licença não ativada. Abra o MilhasUP.exe para ativar.',
+                'expired_local':  'Licença expirada. Renove no suporte.',
+                'revoked':        'Licença revogada. Contate o suporte.',
+                'grace_expired':  'Sem conexão com servidor de licença por mais de 24h.',
+            }
+            print(f'[LICENSE] BLOQUEADO — {_msgs.get(_lic_reason, _lic_reason)}', flush=True)
+            append_event_log({'ts': int(time.time()), 'kind': 'license_block',
+                              'reason': _lic_reason})
+            sys.exit(2)
+        print(f'[LICENSE] OK ({_lic_reason})', flush=True)
+    except ImportError:
+        _lic_mgr = None   # license.py não presente — modo dev sem licença
+    # ─────────────────────────────────────────────────────────────────────────
+
+    lock_handle = acquire_single_instance_lock()
+    if lock_handle is None:
+        print('[INFO] Another monitor instance is already running. Exiting.')
+        return
+
+    targets_raw = os.getenv('TG_TARGETS') or os.getenv('TG_TARGET')
+    targets = [t.strip() for t in (targets_raw or '').split(',') if t.strip()]
+    accounts = load_accounts(targets)
 
-        # Optional: notify to Saved Messages / another chat via Telegram
+    # ── Modo --auth: só autentica e sai ───────────────────────────────────────
+    if args.auth:
+        print(f"\n=== MilhasUP Monitor — Autenticação Telegram ===")
+        for acc in accounts:
+            print(f"Conta: {acc.label} | Telefone: {acc.phone}")
+            print("Conectando ao Telegram...\n")
+            auth_client = TelegramClient(acc.session, acc.api_id, acc.api_hash)
+            await auth_client.connect()
+            await ensure_login(auth_client, acc.phone, force_interactive=True)
+            await auth_client.disconnect()
+        print("\n✅ Autenticação concluída! Pode fechar esta janela.")
+        input("Pressione Enter para fechar...")
+        return
+
+    if not targets_raw:
+        raise SystemExit('Missing env var TG_TARGETS.')
+
+    def _dry_run() -> bool:
+        dry = os.getenv('DRY_RUN', '1').strip() == '1'   # use .env value as base; default=True (safe)
+        if args.send:              # --send CLI flag forces live
+            dry = False
+        if args.dry_run:           # --dry-run CLI flag forces dry
+            dry = True
+        return dry
+
+    dry_run = _dry_run()
+    rules = RuleSet.from_env()
+
+    if EVENT_STORE is not None:
+        store = EVENT_STORE
+    else:
+        store = DedupeStore(compact_every=int(os.getenv('DEDUPE_COMPACT_EVERY', '5000') or '5000'),
+                            ttl=dedupe_ttl)
+        store.compact()         # fold the journal of the previous run into state.json
+    state = store.state
+    seen = store.seen
+    last_ids = state.setdefault('last_ids', {})
+    startup_ids = dict(last_ids)    # where the startup gap begins, before any live message moves last_ids
+
+    try:
+        _log  # type: ignore  # noqa: F821
+    except NameError:
+        def _log(msg: str): pass  # type: ignore  # dev mode — sem log em arquivo
+
+    _log(f'Targets: {targets} | contas: {[a.label for a in accounts]} | DRY_RUN={dry_run}')
+
+    # Shared by every account: one rule set, one parse cache, one dedupe state.
+    # `live` is swapped as a whole by the .env reload.
+    live = {
+        'rules': rules,
+        'prefilter': OfferPrefilter(rules.programs),
+        'parse_cache': ParseCache(rules.programs, capacity=int(os.getenv('PARSE_CACHE_SIZE', '1024') or '0')),
+    }
+    metrics = StageHistograms()
+    near_dups = NearDupIndex(**near_dup_options_from_env())     # kept across reloads, like `state`
+    names = NameCache(
+        ttl=float(os.getenv('NAME_CACHE_TTL_SECONDS', '3600') or '3600'),
+        maxsize=int(os.getenv('NAME_CACHE_SIZE', '4096') or '4096'),
+    )
+
+    # Optional: filter raw updates by chat id before Telethon builds NewMessage events.
+    raw_filter = os.getenv('RAW_UPDATE_FILTER', '0').strip() == '1'
+
+    def _register(run: dict, first: bool):
+        """(Re)binds the account's handler slot to its current target list."""
+        if raw_filter:
+            ids = target_peer_ids(run['entities'])
+            if first:
+                run['raw'] = RawTargetFilter(run['client'], run['slot'], ids)
+                run['client'].add_event_handler(run['raw'], events.Raw(types=RawTargetFilter.UPDATE_TYPES))
+            else:
+                run['raw'].ids = ids
+            return
+        if not first:
+            run['client'].remove_event_handler(run['slot'])
+        run['client'].add_event_handler(run['slot'], events.NewMessage(chats=run['entities']))
+
+    def _print_rules(rules):
+        print('Rules:', {k: {'threshold_per_cpf': v.threshold_per_cpf, 'reply': v.reply, 'max_miles': v.max_miles, 'compare': '>=' if v.inclusive else '>'} for k,v in rules.items()})
+
+    def _build_handler(run: dict, dry_run: bool):
+        return make_handler(
+            run['client'], live['rules'], state,
+            dry_run=dry_run,
+            prefilter=live['prefilter'],
+            parse_cache=live['parse_cache'],
+            metrics=metrics,
+            scheduler=run['scheduler'],
+            names=names,
+            account=run['account'].name,
+            store=store,
+            near_dups=near_dups,
+            **handler_options_from_env(),
+        )
+
+    print('---')
+    print('Dry run:', dry_run)
+    _print_rules(rules)
+
+    running = []    # one dict per connected account
+    for acc in accounts:
+        if not acc.targets:
+            _log(f'[{acc.label}] sem targets — conta não conectada')
+            continue
+        _log(f'[{acc.label}] Criando TelegramClient...')
+        client = TelegramClient(acc.session, acc.api_id, acc.api_hash)
+        _log(f'[{acc.label}] Conectando ao Telegram...')
+        await client.connect()
+        _log(f'[{acc.label}] Conectado. Verificando sessao...')
+        await ensure_login(client, acc.phone)
+        _log(f'[{acc.label}] Sessao OK. Resolvendo targets...')
+
+        entities = await resolve_targets(client, list(acc.targets), cache_path=acc.targets_cache_path)
+        for t, ent in zip(acc.targets, entities):
+            _log(f'  {t!r} -> OK: {ent}')
+
+        _log(f'[{acc.label}] Todos os targets resolvidos ({len(entities)}). Registrando handler...')
+        print(f'Targets ({acc.label}):', list(acc.targets))
+
+        # Self-check: every reply/notify peer as a ready InputPeer before the first offer.
+        peers = PeerCache()
         notify_target = (os.getenv('TG_NOTIFY_TARGET') or '').strip()
-        if notify_target:
+        rows = await peers.warm(client, entities, names=[notify_target] if notify_target else ())
+        print(f'Peers ({acc.label}):')
+        print(format_peer_check(rows))
+        rec = {'ts': int(time.time()), 'kind': 'peer_check', 'peers': rows}
+        if acc.name:
+            rec['account'] = acc.name
+        append_event_log(rec)
+
+        scheduler = SendScheduler(client, metrics=metrics, account=acc.name, peers=peers,
+                                  **scheduler_options_from_env())
+        names.seed(entities)
+        run = {'account': acc, 'client': client, 'scheduler': scheduler, 'entities': entities}
+        run['slot'] = HandlerSlot(_build_handler(run, dry_run))
+        _register(run, first=True)
+        running.append(run)
+    print('---')
+
+    def _account_status():
+        for run in running:
+            rec = {'ts': int(time.time()), 'kind': 'account_status', 'targets': len(run['entities']),
+                   **run['scheduler'].stats()}
+            if 'raw' in run:
+                rec['updates'] = run['raw'].stats()
+            if run['account'].name:
+                rec['account'] = run['account'].name
+            append_event_log(rec)
+
+    _account_status()
+
+    # ── Hot reload: .env salvo (ex.: pelo app) é aplicado sem reiniciar ──────
+    async def _reload(changed: list):
+        t0 = time.perf_counter()
+        rec = {'ts': int(time.time()), 'kind': 'config_reload', 'changed': changed}
+        restart = restart_required_keys(changed)
+        try:
+            # Everything that can fail runs first; nothing is swapped until it all worked.
+            # The new .env is only visible to os.getenv inside staged() (no await there).
+            with env_watcher.staged():
+                new_rules = RuleSet.from_env()
+                new_targets = [t.strip() for t in (os.getenv('TG_TARGETS') or os.getenv('TG_TARGET') or '').split(',') if t.strip()]
+                if not new_targets:
+                    raise ValueError('TG_TARGETS is empty')
+                # new sessions can only be logged in on restart; the rest reloads without them
+                sessions_changed = restart_required_keys(changed, startup=False)
+                new_accounts = {a.name: a for a in load_accounts(new_targets)} if not sessions_changed else {}
+                notify_target = (os.getenv('TG_NOTIFY_TARGET') or '').strip()
+                sched = scheduler_options_from_env()
+                near_opts = near_dup_options_from_env()
+                cache_size = int(os.getenv('PARSE_CACHE_SIZE', '1024') or '0')
+                handler_options_from_env()      # checks only: each handler reads them again
+            retarget = {}
+            for i, run in enumerate(running):
+                acc = new_accounts.get(run['account'].name)
+                if acc is not None and acc.targets != run['account'].targets:
+                    retarget[i] = (acc, await resolve_targets(run['client'], list(acc.targets),
+                                                              cache_path=acc.targets_cache_path))
+                # warming only adds peers: safe before the swap
+                await run['scheduler'].peers.warm(run['client'], retarget[i][1] if i in retarget else (),
+                                                  names=[notify_target] if notify_target else ())
+        except (Exception, SystemExit) as e:
+            rec.update(error=str(e), ms=round((time.perf_counter() - t0) * 1000, 1))
+            append_event_log(rec)
+            print(f'[WARN] .env reload rejected: {e}')
+            return
+
+        # Swap (no await from here on): environment, rules, caches, send settings, handlers, targets.
+        env_watcher.apply()
+        live.update(
+            rules=new_rules,
+            prefilter=OfferPrefilter(new_rules.programs),
+            parse_cache=ParseCache(new_rules.programs, capacity=cache_size),
+        )
+        dry = _dry_run()
+        near_dups.configure(**near_opts)
+        for i, run in enumerate(running):
+            run['scheduler'].configure(**sched)
+            if i in retarget:
+                run['account'], run['entities'] = retarget[i]
+                names.seed(run['entities'])
+                # only a changed target list touches the NewMessage registration
+                _register(run, first=False)
+            run['slot'].handler = _build_handler(run, dry)
+        idle = [a.label for name, a in new_accounts.items()
+                if a.targets and name not in {run['account'].name for run in running}]
+
+        rec.update(ms=round((time.perf_counter() - t0) * 1000, 1), dry_run=dry,
+                   targets_changed=[running[i]['account'].label for i in sorted(retarget)])
+        if restart or idle:
+            rec['restart_required'] = restart + idle
+            print(f'[WARN] .env reload: restart the monitor to apply {restart + idle}')
+        append_event_log(rec)
+        _log(f'.env recarregado em {rec["ms"]}ms: {changed}')
+        print(f'[RELOAD] {len(changed)} chave(s) aplicada(s) em {rec["ms"]}ms | dry_run={dry}')
+        _print_rules(new_rules)
+        _account_status()
+
+    env_reload_seconds = float(os.getenv('ENV_RELOAD_SECONDS', '2') or '0')
+    env_watcher = EnvWatcher(os.path.join(_BASE, '.env'))
+
+    async def _env_watch():
+        while True:
+            await asyncio.sleep(env_reload_seconds)
             try:
-                await client.send_message(notify_target, summary)
-            except Exception as e:
-                append_event_log({'ts': int(time.time()), 'kind': 'notify_error', 'error': str(e)})
-
-        # Optional: notify via WhatsApp (CallMeBot free API)
-        wa_phone  = (os.getenv('WHATSAPP_NOTIFY_PHONE') or '').strip()
-        wa_apikey = (os.getenv('WHATSAPP_CALLMEBOT_APIKEY') or '').strip()
-        if wa_phone and wa_apikey:
-            import threading
-            threading.Thread(
-                target=send_whatsapp_callmebot,
-                args=(wa_phone, wa_apikey, summary),
-                daemon=True
-            ).start()
-
-        # Optional: push notification via ntfy.sh (free, Android/iOS)
-        ntfy_topic = (os.getenv('NTFY_TOPIC') or '').strip()
-        if ntfy_topic:
-            import threading
-            threading.Thread(
-                target=send_ntfy,
-                args=(ntfy_topic, summary),
-                daemon=True
-            ).start()
+                changed = env_watcher.poll()
+            except OSError:
+                continue
+            if changed:
+                await _reload(changed)
+
+    async def _disconnect_all():
+        for run in running:
+            await run['client'].disconnect()
 
     # ── Watchdog de licença (verifica a cada 6h) ───────────────────────────
     import asyncio as _asyncio
@@ -708,16 +3056,93 @@ async def main():
                 print(f'[LICENSE] Watchdog: bloqueado ({reason}). Encerrando.', flush=True)
                 append_event_log({'ts': int(time.time()), 'kind': 'license_block',
                                   'reason': reason})
-                await client.disconnect()
+                await _disconnect_all()
                 break
 
     _asyncio.get_event_loop().create_task(_license_watchdog())
+
+    # ── Métricas: histogramas por etapa (e carga por conta) gravados em events.jsonl ──
+    metrics_flush_seconds = float(os.getenv('METRICS_FLUSH_SECONDS', '300') or '0')
+
+    async def _metrics_flusher():
+        while True:
+            await _asyncio.sleep(metrics_flush_seconds)
+            rec = metrics.flush()
+            if rec:
+                append_event_log(rec)
+            _account_status()
+            await store.compact_async()     # also persists last_ids, which move on every message
+
+    if metrics_flush_seconds > 0:
+        _asyncio.get_event_loop().create_task(_metrics_flusher())
+    if env_reload_seconds > 0:
+        _asyncio.get_event_loop().create_task(_env_watch())
+
+    # ── Catch-up: mensagens postadas enquanto o monitor estava fora do ar ─────
+    catchup_max_age = float(os.getenv('CATCHUP_MAX_AGE_SECONDS', '300') or '0')
+
+    async def _catch_up(run: dict, reason: str, since: dict):
+        t0 = time.perf_counter()
+        totals = await catch_up(
+            run['client'], run['slot'], run['entities'], last_ids,
+            since=since,
+            max_age=catchup_max_age,
+            concurrency=int(os.getenv('CATCHUP_CONCURRENCY', '4') or '4'),
+            limit=int(os.getenv('CATCHUP_LIMIT', '200') or '200'),
+        )
+        rec = {'ts': int(time.time()), 'kind': 'catch_up', 'reason': reason,
+               'ms': round((time.perf_counter() - t0) * 1000, 1), **totals}
+        if run['account'].name:
+            rec['account'] = run['account'].name
+        append_event_log(rec)
+        _log(f'[{run["account"].label}] catch-up ({reason}): {totals}')
+
+    async def _reconnect_watch():
+        # Telethon reconnects on its own and only delivers new updates afterwards.
+        was_up = [True] * len(running)
+        gap_ids = [None] * len(running)     # last_ids copy from when the drop was noticed
+        while True:
+            await _asyncio.sleep(1)
+            for i, run in enumerate(running):
+                up = run['client'].is_connected()
+                if not up and was_up[i]:
+                    gap_ids[i] = dict(last_ids)
+                elif up and not was_up[i]:
+                    _asyncio.get_event_loop().create_task(_catch_up(run, 'reconnect', gap_ids[i]))
+                was_up[i] = up
+
+    if catchup_max_age > 0:
+        for run in running:
+            _asyncio.get_event_loop().create_task(_catch_up(run, 'startup', startup_ids))
+        _asyncio.get_event_loop().create_task(_reconnect_watch())
     # ─────────────────────────────────────────────────────────────────────────
 
     _log('LISTENING — run_until_disconnected()')
     print('Listening... (Ctrl+C to stop)')
-    await client.run_until_disconnected()
+    # One account dropping ends the run (like the single-account monitor) so the
+    # launcher restarts every session together.
+    waiters = [_asyncio.ensure_future(run['client'].run_until_disconnected()) for run in running]
+    await _asyncio.wait(waiters, return_when=_asyncio.FIRST_COMPLETED)
     _log('run_until_disconnected() retornou — Telegram desconectou!')
+    await _disconnect_all()
+    await _asyncio.gather(*waiters, return_exceptions=True)
+    _log(f'Prefilter: {live["prefilter"].stats()}')
+    _log(f'Parse cache: {live["parse_cache"].stats()}')
+    for run in running:
+        _log(f'Send scheduler [{run["account"].label}]: {run["scheduler"].stats()}')
+        _log(f'Peer cache [{run["account"].label}]: {run["scheduler"].peers.stats()}')
+        if 'raw' in run:
+            _log(f'Raw updates [{run["account"].label}]: {run["raw"].stats()}')
+    _log(f'Name cache: {names.stats()}')
+    _log(f'Near-dup index: {near_dups.stats()}')
+    _log(f'Dedupe: {len(seen)} chaves em memória, {store.seen.expired} expiradas (DEDUPE_TTL_HOURS)')
+    if EVENT_STORE is not None:
+        _log(f'SQLite: {EVENT_STORE.stats()}')
+    _account_status()
+    store.compact()
+    rec = metrics.flush()
+    if rec:
+        append_event_log(rec)
 
 if __name__ == '__main__':
     import asyncio
@@ -1,4 +1,4 @@
-"""
+r"""
 Smoke-test das regras e parsing sem conectar ao Telegram.
 Executa: .venv\Scripts\python test_rules.py
 """
@@ -10,57 +10,28 @@ load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'), overrid
 
 from monitor import (
     parse_miles, parse_cpfs, detect_program,
-    parse_offer_price_cents, format_price_cents,
-    compute_per_cpf, norm_text
+    parse_offer_price_cents, norm_text, parse_offer, parse_lots,
+    OfferPrefilter, ParseCache, StageHistograms, SendScheduler, NameCache, histogram_percentile, parse_offers, PROGRAM_CODES, MISSING,
+    replay, resolve_targets, shard_targets, EnvWatcher, HandlerSlot, restart_required_keys, catch_up, PeerCache,
+    RawTargetFilter, target_peer_ids, DedupeStore, SeenSet, dedupe_key, SqliteStore, migrate_to_sqlite, query_events, NearDupIndex, RuleSet,
+    PROGRAM_REGISTRY
 )
 
-# --- regras carregadas do .env ---
-LATAM_THRESH  = int(os.getenv('LATAM_THRESHOLD_PER_CPF', '50000'))
-SMILES_THRESH = int(os.getenv('SMILES_THRESHOLD_PER_CPF', '27000'))
-LATAM_REPLY   = os.getenv('LATAM_REPLY', '25,00')
-SMILES_REPLY  = os.getenv('SMILES_REPLY', '16,00')
-SMILES_MAX    = int(os.getenv('SMILES_MAX_MILES', '675000') or '0')
-LATAM_MAX     = int(os.getenv('LATAM_MAX_MILES', '194000') or '0')
-
-def reply_cents(rule_reply_str):
-    import re
-    m = re.fullmatch(r"(\d{1,2}),(\d{2})", rule_reply_str.strip())
-    return int(m.group(1)) * 100 + int(m.group(2)) if m else None
+# Os casos contam só com os programas ligados por padrão: PROGRAMS e as chaves dos outros
+# programas ficam fora do teste (o app grava AZUL_THRESHOLD_PER_CPF, o que liga o Azul).
+for _key in [k for k in os.environ if k == 'PROGRAMS'
+             or any(k.startswith(f'{p.name}_') for p in PROGRAM_REGISTRY if not p.enabled)]:
+    del os.environ[_key]
 
-LATAM_REPLY_CENTS  = reply_cents(LATAM_REPLY)
-SMILES_REPLY_CENTS = reply_cents(SMILES_REPLY)
+# --- regras carregadas do .env (mesmo RuleSet do monitor; defaults abaixo só para o teste) ---
+RULES = RuleSet.from_env(defaults={
+    'SMILES_THRESHOLD_PER_CPF': '27000', 'SMILES_REPLY': '16,00',
+    'SMILES_MAX_MILES': '675000', 'LATAM_MAX_MILES': '194000',
+})
 
 def evaluate(text):
-    tnorm = norm_text(text)
-    program = detect_program(tnorm)
-    if not program:
-        return None, "programa nao detectado"
-
-    miles = parse_miles(text)
-    cpfs  = parse_cpfs(text)
-    if miles is None:
-        return None, "milhas nao detectadas"
-    if cpfs is None or cpfs <= 0:
-        return None, "CPFs nao detectados"
-
-    if program == 'SMILES' and SMILES_MAX and miles > SMILES_MAX:
-        return None, f"SMILES acima do cap ({miles} > {SMILES_MAX})"
-    if program == 'LATAM' and LATAM_MAX and miles > LATAM_MAX:
-        return None, f"LATAM acima do cap ({miles} > {LATAM_MAX})"
-
-    per_cpf = compute_per_cpf(miles, cpfs)
-    thresh = LATAM_THRESH if program == 'LATAM' else SMILES_THRESH
-    op     = ">=" if program == 'LATAM' else ">"
-    eligible = (per_cpf >= thresh) if program == 'LATAM' else (per_cpf > thresh)
-    if not eligible:
-        return None, f"{program} {per_cpf}/CPF nao atinge threshold {thresh} ({op})"
-
-    offer_cents  = parse_offer_price_cents(text)
-    rule_cents   = LATAM_REPLY_CENTS if program == 'LATAM' else SMILES_REPLY_CENTS
-    final_cents  = max(rule_cents, offer_cents) if offer_cents is not None else rule_cents
-    reply        = format_price_cents(final_cents)
-
-    return reply, f"{program} {miles}/{cpfs}={per_cpf}/CPF | oferta={format_price_cents(offer_cents) if offer_cents else '?'} | resposta={reply}"
+    decision = RULES.evaluate(parse_offer(text))
+    return (decision.reply if decision.eligible else None), decision.reason
 
 # ── CASOS DE TESTE ─────────────────────────────────────────────────────────────
 # (mensagem, resposta_esperada_ou_None)
@@ -96,8 +67,8 @@ RESET = "\033[0m"
 ok = err = 0
 
 print(f"\nRegras carregadas:")
-print(f"  LATAM:  threshold={LATAM_THRESH}/CPF  reply={LATAM_REPLY}  max={LATAM_MAX}")
-print(f"  SMILES: threshold={SMILES_THRESH}/CPF  reply={SMILES_REPLY}  max={SMILES_MAX}")
+for name, rule in RULES.items():
+    print(f"  {name + ':':7s} threshold={rule.threshold_per_cpf}/CPF  reply={rule.reply}  max={rule.max_miles}")
 print(f"\n{'─'*72}")
 
 for msg, expected in cases:
@@ -113,6 +84,732 @@ for msg, expected in cases:
     if passed: ok  += 1
     else:      err += 1
 
+# ── parse_offer (single-pass) deve bater com a cadeia de parsers ──────────────
+print(f"\n{'─'*72}")
+for msg, _ in cases:
+    p = parse_offer(msg)
+    got  = (p.program, p.miles, p.cpfs, p.offer_cents)
+    want = (detect_program(norm_text(msg)), parse_miles(msg), parse_cpfs(msg), parse_offer_price_cents(msg))
+    if got == want:
+        ok += 1
+    else:
+        err += 1
+        print(f"{VERM}✗ parse_offer {got} != {want}{RESET}  msg: {msg!r}")
+print(f"parse_offer: {len(cases)} mensagens comparadas com a cadeia de parsers")
+
+# Mesma comparação sobre o corpus sintético do benchmark (todos os formatos de milhas).
+from bench_rules import make_corpus
+synthetic = make_corpus(3000)
+mismatches = 0
+for msg in synthetic:
+    p = parse_offer(msg)
+    got  = (p.program, p.miles, p.cpfs, p.offer_cents)
+    want = (detect_program(norm_text(msg)), parse_miles(msg), parse_cpfs(msg), parse_offer_price_cents(msg))
+    if got != want:
+        mismatches += 1
+        if mismatches <= 5:
+            print(f"{VERM}✗ parse_offer {got} != {want}{RESET}  msg: {msg!r}")
+if mismatches:
+    err += 1
+else:
+    ok += 1
+print(f"parse_offer: {len(synthetic)} mensagens sintéticas, {mismatches} divergências")
+
+# ── parse_offers (colunar) deve bater com parse_offer linha a linha ───────────
+# workers=1: sem pool de processos aqui (este script não tem guarda __main__).
+cols = parse_offers([msg for msg, _ in cases], workers=1)
+for i, (msg, _) in enumerate(cases):
+    p = parse_offer(msg)
+    row  = (cols.program[i], cols.miles[i], cols.cpfs[i], cols.offer_cents[i], cols.valid[i])
+    want = (PROGRAM_CODES[p.program],
+            MISSING if p.miles is None else p.miles,
+            MISSING if p.cpfs is None else p.cpfs,
+            MISSING if p.offer_cents is None else p.offer_cents,
+            int(bool(p.program and p.miles is not None and p.cpfs)))
+    if row == want:
+        ok += 1
+    else:
+        err += 1
+        print(f"{VERM}✗ parse_offers {row} != {want}{RESET}  msg: {msg!r}")
+
+# ── prefiltro nunca pode descartar uma mensagem que o parse aceitaria ─────────
+prefilter = OfferPrefilter()
+for msg, _ in cases:
+    p = parse_offer(msg)
+    if p.program and p.miles is not None and p.cpfs and not prefilter(msg):
+        err += 1
+        print(f"{VERM}✗ prefiltro descartou oferta válida{RESET}  msg: {msg!r}")
+    else:
+        ok += 1
+for msg in ("bom dia pessoal", "kkkkkk", "alguém tem 2 cpf livre?", "latam tá caro hoje"):
+    if prefilter(msg):
+        err += 1
+        print(f"{VERM}✗ prefiltro deixou passar conversa{RESET}  msg: {msg!r}")
+    else:
+        ok += 1
+print(f"prefiltro: {prefilter.dropped} descartadas, {prefilter.passed} passaram")
+
+# ── parse_lots: vários lotes na mesma mensagem ───────────────────────────────
+# (mensagem, respostas esperadas por lote — None = lote não elegível)
+lot_cases = [
+    ("LATAM 100k 2 cpf / SMILES 60k 1 cpf",                      ["25,00", "16,00"]),
+    ("Compro LATAM:\n100k 2 cpf 20,00\n150k 2 cpf 26,00\n80k 2 cpf", ["25,00", "26,00", None]),
+    ("smiles 81.600 3 cpf 15,00; latam 110k 2 cpf",              ["16,00", "25,00"]),
+    ("compro latam\n110k 2 cpf",                                 ["25,00"]),   # um lote só
+    ("compro 100k\nlatam 2 cpf 14,00",                           ["25,00"]),   # oferta em 2 linhas
+    ("Compro 100k 2 cpf\n150k 2 cpf\nLATAM",                      ["25,00", "25,00"]),   # programa no fim
+    ("Compro LATAM\n100k 2 cpf\n150k 2 cpf\nPago 30,00",          ["30,00", "30,00"]),   # preço no fim
+    ("Compro LATAM 30,00 o milheiro\n100k 2 cpf\n150k 2 cpf",     ["30,00", "30,00"]),   # preço no cabeçalho
+    ("Compro LATAM 30,00\n100k 2 cpf 31,00\n150k 2 cpf",          ["31,00", "30,00"]),   # preço do lote vale
+]
+for msg, expected in lot_cases:
+    got = [d.reply if d.eligible else None for d in map(RULES.evaluate, parse_lots(msg))]
+    if got == expected:
+        ok += 1
+    else:
+        err += 1
+        print(f"{VERM}✗ parse_lots {got} != {expected}{RESET}  msg: {msg!r}")
+
+# Mensagem de um lote só: parse_lots tem que dar exatamente o mesmo que parse_offer.
+lot_mismatches = sum(1 for msg in [m for m, _ in cases] + synthetic if parse_lots(msg) != [parse_offer(msg)])
+if lot_mismatches:
+    err += 1
+    print(f"{VERM}✗ parse_lots divergiu de parse_offer em {lot_mismatches} mensagens de um lote{RESET}")
+else:
+    ok += 1
+print(f"parse_lots: {len(lot_cases)} mensagens com vários lotes, {lot_mismatches} divergências em um lote")
+
+# ── cache de parse: repost em outro grupo não passa pelo regex de novo ───────
+cache = ParseCache(RULES.programs, capacity=2)
+for msg in ("latam 100k 2 cpf", "smiles 81.600 3 cpf", "latam 100k 2 cpf", "azul 50k 1 cpf", "smiles 81.600 3 cpf"):
+    if cache(msg) != parse_lots(msg, RULES.programs):
+        err += 1
+        print(f"{VERM}✗ cache divergiu de parse_lots{RESET}  msg: {msg!r}")
+want = {'hits': 1, 'misses': 4, 'size': 2, 'capacity': 2}   # o 3º evento é hit; o 5º foi despejado (LRU)
+if cache.stats() == want:
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ cache {cache.stats()} != {want}{RESET}")
+print(f"cache de parse: {cache.stats()}")
+
+# ── histogramas por etapa: registro "metrics" e percentis ────────────────────
+hist = StageHistograms()
+for us in [15] * 90 + [3_000] * 9 + [700_000]:      # 90% rápidos, 9% em ms, 1 lento
+    hist.record('parse', us / 1e6)
+rec = hist.flush()
+got = [histogram_percentile(rec['stages']['parse']['counts'], q, rec['stages']['parse']['max_us'])
+       for q in (0.50, 0.95, 0.99, 1.0)]
+want = [20, 5_000, 5_000, 700_000]    # limite superior do bucket (nunca acima do máximo)
+if rec['kind'] == 'metrics' and rec['stages']['parse']['n'] == 100 and got == want and hist.flush() is None:
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ histograma {got} != {want}{RESET}")
+
+# ── registro de programas: AZUL (e outros) só com configuração ───────────────
+azul_rules = RuleSet.from_env(defaults={'AZUL_THRESHOLD_PER_CPF': '30000', 'AZUL_REPLY': '18,00',
+                                        'AZUL_MAX_MILES': '200000', 'AZUL_COMPARE': '>='})
+registry_cases = [
+    (RULES,      "compro azul 50k 1 cpf",        None),      # AZUL não configurado
+    (azul_rules, "compro azul 50k 1 cpf",        "18,00"),
+    (azul_rules, "TudoAzul 60k 2 cpf 19,00",     "19,00"),   # 30k/cpf >= 30k (AZUL_COMPARE)
+    (azul_rules, "azul 250k 1 cpf",              None),      # acima do cap
+    (azul_rules, "latam 100k 2 cpf azul",        "25,00"),   # LATAM tem prioridade
+    (RULES,      "tamanho 100k 2 cpf",           None),      # "tam" só como palavra inteira
+    (RULES,      "compro 2tam 100k 2 cpf",       None),      # ... como \b: dígito e _ também colam
+    (RULES,      "compro _tam 100k 2 cpf",       None),
+    (RULES,      "compro tam_ 100k 2 cpf",       None),
+    (RULES,      "compro tam 100k 2 cpf",        "25,00"),
+]
+for rules, msg, expected in registry_cases:
+    decision = rules.evaluate(parse_offer(msg, rules.programs))
+    got = decision.reply if decision.eligible else None
+    if got == expected:
+        ok += 1
+    else:
+        err += 1
+        print(f"{VERM}✗ registro {got!r} != {expected!r}{RESET}  msg: {msg!r}  ({decision.reason})")
+print(f"registro: {len(registry_cases)} casos, programas com regra: {', '.join(azul_rules.rules)}")
+
+# ── fila de envio: um worker por chat, FloodWait reagenda em vez de falhar ────
+import asyncio, time
+from telethon.errors import FloodWaitError
+
+class _FakeEvent:
+    def __init__(self, chat_id, log, flood=0):
+        self.chat_id, self.log, self.flood = chat_id, log, flood
+    async def reply(self, msg):
+        if self.flood:
+            self.flood, seconds = 0, self.flood
+            raise FloodWaitError(request=None, capture=seconds)
+        self.log.append((self.chat_id, msg))
+
+async def _run_scheduler():
+    log, done = [], []
+    sched = SendScheduler(None, delay=0.05, concurrency=4, metrics=StageHistograms())
+    t0 = time.perf_counter()
+    for chat in (1, 2, 3):
+        for i in range(2):
+            ev = _FakeEvent(chat, log, flood=1 if (chat, i) == (1, 0) else 0)
+            async def on_done(via, error, timing, chat=chat, i=i):
+                done.append((chat, i, via))
+            sched.submit(ev, f"{chat}-{i}", 'reply', on_done)
+    await sched.join()
+    sched.close()
+    return log, done, sched.stats(), time.perf_counter() - t0
+
+import contextlib, io, json, monitor, tempfile
+_events_path = monitor.EVENTS_LOG_PATH
+with tempfile.TemporaryDirectory() as tmp:
+    monitor.EVENTS_LOG_PATH = os.path.join(tmp, 'events.jsonl')     # registro do flood_wait
+    try:
+        log, done, stats, elapsed = asyncio.run(_run_scheduler())
+    finally:
+        monitor.EVENTS_LOG_PATH = _events_path
+in_order = all([m for c, m in log if c == chat] == [f"{chat}-0", f"{chat}-1"] for chat in (1, 2, 3))
+# chats em paralelo: 2 e 3 terminam durante o FloodWait do chat 1, que reenvia por último
+# (em série, o chat 1 seguraria os outros); a ordem não depende da velocidade da máquina
+if (len(log) == 6 and in_order and {c for c, _ in log[:4]} == {2, 3} and log[4:] == [(1, "1-0"), (1, "1-1")]
+        and stats['flood_waits'] == 1 and stats['failed'] == 0):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ fila de envio {log} {stats} {elapsed:.2f}s{RESET}")
+print(f"fila de envio: {stats} em {elapsed:.2f}s")
+
+# ── cache de nomes: grupo/remetente repetido não faz round-trip ──────────────
+class _NamedEvent:
+    calls = 0
+    def __init__(self, chat_id, sender_id):
+        self.chat_id, self.sender_id = chat_id, sender_id
+    async def get_chat(self):
+        _NamedEvent.calls += 1
+        return type('Chat', (), {'title': f"Grupo {self.chat_id}"})()
+    async def get_sender(self):
+        _NamedEvent.calls += 1
+        return type('User', (), {'first_name': 'Ana', 'last_name': f"#{self.sender_id}"})()
+
+async def _lookup_names(names, pairs):
+    return [(await names.chat_title(e), await names.sender_name(e)) for e in map(lambda p: _NamedEvent(*p), pairs)]
+
+from telethon.tl.types import Chat, ChatPhotoEmpty
+names = NameCache(ttl=60, maxsize=3)
+# semeado com as entidades do resolve_target (id numérico fica de fora: sem título)
+names.seed([Chat(id=7, title="Grupo semeado", photo=ChatPhotoEmpty(), participants_count=3, date=None, version=1), -1007])
+got = asyncio.run(_lookup_names(names, [(-7, 10), (1, 10), (1, 10), (2, 10), (1, 11)]))
+want = [("Grupo semeado", "Ana #10"), ("Grupo 1", "Ana #10"), ("Grupo 1", "Ana #10"),
+        ("Grupo 2", "Ana #10"), ("Grupo 1", "Ana #11")]
+st = names.stats()
+# 5 eventos: 2 chats + 2 remetentes buscados (4 round-trips), o resto veio da memória
+if got == want and _NamedEvent.calls == 4 and st['chats']['hits'] == 3 and st['senders']['hits'] == 3:
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ cache de nomes {got} {st} calls={_NamedEvent.calls}{RESET}")
+print(f"cache de nomes: {st}")
+# entidade sem título nem username (usuário): o nome é o id, como no evento ao vivo
+from telethon.tl.types import User
+untitled = NameCache()
+untitled.seed([User(id=5, first_name="Ana")])
+if untitled.chats.get(5, None) == "5":
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ seed sem título {untitled.chats.get(5, None)!r}{RESET}")
+
+# ── resolução de alvos: uma varredura de diálogos, cache reaproveitado ───────
+from telethon.tl.types import Channel, InputPeerChannel
+
+def _channel(cid, title):
+    return Channel(id=cid, title=title, photo=ChatPhotoEmpty(), date=None, access_hash=cid * 11)
+
+class _DialogsClient:
+    def __init__(self, chats):
+        self.chats, self.scans, self.lookups = chats, 0, 0
+    async def get_entity(self, what):
+        self.lookups += 1
+        return [self._find(w) for w in what] if isinstance(what, list) else self._find(what)
+    def _find(self, what):
+        if isinstance(what, InputPeerChannel):
+            for ch in self.chats:
+                if ch.id == what.channel_id and ch.access_hash == what.access_hash:
+                    return ch
+        raise ValueError(what)
+    async def iter_dialogs(self):
+        self.scans += 1
+        for ch in self.chats:
+            yield type('Dialog', (), {'name': ch.title, 'entity': ch})()
+
+chats = [_channel(1, "Milhas VIP"), _channel(2, "Balcão de Milhas"), _channel(3, "Milhas")]
+targets = ["Milhas", "balcão", "-100999"]
+with tempfile.TemporaryDirectory() as tmp:
+    cache_path = os.path.join(tmp, 'targets_cache.json')
+    first = _DialogsClient(chats)
+    got = asyncio.run(resolve_targets(first, targets, cache_path=cache_path))
+    again = _DialogsClient(chats)
+    got_again = asyncio.run(resolve_targets(again, targets, cache_path=cache_path))
+    # grupo recriado (access_hash novo): só ele volta para a varredura
+    stale = _DialogsClient([chats[0], chats[1], Channel(id=3, title="Milhas", photo=ChatPhotoEmpty(), date=None, access_hash=5)])
+    got_stale = asyncio.run(resolve_targets(stale, targets, cache_path=cache_path))
+ids = lambda ents: [getattr(e, 'id', e) for e in ents]
+# título exato vence o parcial; 2 títulos numa varredura só; 2º start sem varredura
+if (ids(got) == ids(got_again) == ids(got_stale) == [3, 2, -100999] and first.scans == 1
+        and again.scans == 0 and again.lookups == 1 and stale.scans == 1 and got_stale[0].access_hash == 5):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ resolve_targets {ids(got)} {ids(got_again)} {ids(got_stale)} "
+          f"scans={first.scans}/{again.scans}/{stale.scans} lookups={again.lookups}{RESET}")
+print(f"resolve_targets: {len(targets)} alvos, varreduras de diálogos 1 → {again.scans} com cache")
+
+# ── várias contas: alvos repartidos, dedupe e logs compartilhados ────────────
+shards = shard_targets(["A", "B", "C", "D", "E"], ["um", "dois"], pinned={"dois": ["E", "X"]})
+want_shards = {"um": ["A", "B", "C"], "dois": ["E", "X", "D"]}   # fixados contam na carga
+
+class _AccountEvent(_NamedEvent):
+    def __init__(self, chat_id, text, log, account):
+        super().__init__(chat_id, 10)
+        self.raw_text, self.log, self.account = text, log, account
+    async def reply(self, msg):
+        self.log.append((self.account, self.chat_id, msg))
+
+async def _run_accounts(text):
+    state, log = {}, []
+    handlers = {name: monitor.make_handler(None, RULES, state, dry_run=False, send_delay_seconds=0,
+                                           whatsapp_relay_enabled=False, account=name)
+                for name in ("um", "dois")}
+    # as duas contas estão no mesmo grupo e recebem a mesma mensagem
+    await asyncio.gather(*(h(_AccountEvent(-100, text, log, name)) for name, h in handlers.items()))
+    for _ in range(20):
+        await asyncio.sleep(0.01)
+    return log
+
+_events_path, _state_path = monitor.EVENTS_LOG_PATH, monitor.STATE_PATH
+with tempfile.TemporaryDirectory() as tmp:
+    monitor.EVENTS_LOG_PATH = os.path.join(tmp, 'events.jsonl')
+    monitor.STATE_PATH = os.path.join(tmp, 'state.json')
+    try:
+        replies = asyncio.run(_run_accounts(next(msg for msg, exp in cases if exp)))
+        with open(monitor.EVENTS_LOG_PATH, encoding='utf-8') as f:
+            tagged = [json.loads(line).get('account') for line in f]
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            monitor.print_account_stats(monitor.EVENTS_LOG_PATH)
+    finally:
+        monitor.EVENTS_LOG_PATH, monitor.STATE_PATH = _events_path, _state_path
+if shards == want_shards and len(replies) == 1 and tagged == [replies[0][0]] * 2 and replies[0][0] in out.getvalue():
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ várias contas {shards} {replies} {tagged}{RESET}")
+print(f"várias contas: {shards} | 1 resposta para 2 contas no mesmo grupo")
+
+# ── hot reload: .env salvo é aplicado sem reiniciar ──────────────────────────
+with tempfile.TemporaryDirectory() as tmp:
+    env_path = os.path.join(tmp, '.env')
+    with open(env_path, 'w', encoding='utf-8') as f:
+        f.write("RELOAD_TESTE_A=1\nRELOAD_TESTE_B=x\nTG_PHONE=+55\n")
+    watcher = EnvWatcher(env_path)
+    unchanged = watcher.poll()
+    with open(env_path, 'w', encoding='utf-8') as f:
+        f.write("RELOAD_TESTE_A=2\nTG_PHONE=+55\n")
+    os.utime(env_path, ns=(watcher.mtime + 10**9, watcher.mtime + 10**9))
+    os.environ['RELOAD_TESTE_B'] = 'x'
+    changed = watcher.poll()
+    _env = lambda: (os.environ.get('RELOAD_TESTE_A'), os.environ.get('RELOAD_TESTE_B'))
+    polled = _env()
+    with watcher.staged():
+        staged = _env()
+    rejected = _env()
+    watcher.apply()
+    reloaded = _env()
+    os.environ.pop('RELOAD_TESTE_A', None)
+
+async def _swap():
+    calls = []
+    async def old(ev): calls.append(('old', ev))
+    async def new(ev): calls.append(('new', ev))
+    slot = HandlerSlot(old)
+    await slot(1)
+    slot.handler = new
+    await slot(2)
+    return calls
+
+# chave removida do .env volta ao default; telefone/sessão e o que só é lido na partida pedem reinício;
+# poll() não mexe no ambiente e um .env rejeitado (saída do staged) deixa o anterior
+if (unchanged is None and changed == ['RELOAD_TESTE_A', 'RELOAD_TESTE_B'] and reloaded == ('2', None)
+        and polled == rejected == (None, 'x') and staged == ('2', None)
+        and restart_required_keys(['SMILES_REPLY', 'TG_PHONE', 'TG_RESERVA_SESSION', 'TG_TARGETS', 'DEDUPE_TTL_HOURS',
+                                   'CATCHUP_LIMIT', 'NAME_CACHE_SIZE', 'ENV_RELOAD_SECONDS', 'NEAR_DUP_THRESHOLD'])
+            == ['TG_PHONE', 'TG_RESERVA_SESSION', 'DEDUPE_TTL_HOURS', 'NAME_CACHE_SIZE', 'ENV_RELOAD_SECONDS']
+        and restart_required_keys(['TG_PHONE', 'DEDUPE_TTL_HOURS'], startup=False) == ['TG_PHONE']
+        and asyncio.run(_swap()) == [('old', 1), ('new', 2)]):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ hot reload {unchanged} {changed} {polled} {staged} {rejected} {reloaded}{RESET}")
+print(f"hot reload: chaves alteradas {changed}")
+
+# ── catch-up: mensagens do intervalo fora do ar, sem responder oferta velha ──
+from datetime import datetime, timezone
+
+class _GapMessage:
+    def __init__(self, chat_id, msg_id, age):
+        self.chat_id, self.id, self.raw_text = chat_id, msg_id, f"bom dia #{msg_id}"
+        self.date = datetime.fromtimestamp(time.time() - age, timezone.utc)
+
+class _GapClient:
+    def __init__(self, history):
+        self.history, self.calls = history, []
+    async def iter_messages(self, entity, min_id=0, limit=None):
+        self.calls.append((entity, min_id))
+        for m in sorted(self.history.get(entity, []), key=lambda m: -m.id)[:limit]:
+            if m.id > min_id:
+                yield m
+
+gap_state = {'last_ids': {'-100': 10}}
+gap_handler = monitor.make_handler(None, RULES, gap_state, dry_run=True, send_delay_seconds=0)
+handled = []
+async def _gap_handler(ev):
+    handled.append(ev.id)
+    await gap_handler(ev)
+# 11 é de 1h atrás: fica de fora; -200 nunca foi visto: não busca
+gap_client = _GapClient({-100: [_GapMessage(-100, i, 3600 if i == 11 else 5) for i in range(8, 16)],
+                         -200: [_GapMessage(-200, 1, 5)]})
+totals = asyncio.run(catch_up(gap_client, _gap_handler, [-100, -200], gap_state['last_ids'], max_age=300))
+if (handled == [12, 13, 14, 15] and gap_client.calls == [(-100, 10)] and gap_state['last_ids'] == {'-100': 15}
+        and totals == {'chats': 1, 'fetched': 5, 'handled': 4, 'stale': 1, 'errors': []}):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ catch-up {handled} {gap_client.calls} {gap_state['last_ids']} {totals}{RESET}")
+print(f"catch-up: {totals}")
+
+# mensagem ao vivo (15) chega antes do catch-up: a busca parte da cópia tirada na queda
+live_state = {'last_ids': {'-100': 10}}
+gap_since = dict(live_state['last_ids'])
+live_state['last_ids']['-100'] = 15
+live_handler = monitor.make_handler(None, RULES, live_state, dry_run=True, send_delay_seconds=0)
+handled = []
+async def _live_handler(ev):
+    handled.append(ev.id)
+    await live_handler(ev)
+live_client = _GapClient({-100: [_GapMessage(-100, i, 5) for i in range(8, 16)]})
+totals = asyncio.run(catch_up(live_client, _live_handler, [-100], live_state['last_ids'],
+                              max_age=300, since=gap_since))
+if handled == [11, 12, 13, 14, 15] and live_client.calls == [(-100, 10)] and live_state['last_ids'] == {'-100': 15}:
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ catch-up após mensagem ao vivo {handled} {live_client.calls} {live_state['last_ids']}{RESET}")
+
+# ── peers aquecidos: envio e notificação sem resolver entidade ───────────────
+from telethon.tl.types import InputPeerSelf
+from telethon.utils import get_peer_id
+
+class _PeerClient:
+    def __init__(self):
+        self.lookups, self.sent = [], []
+    async def get_input_entity(self, what):
+        self.lookups.append(what)
+        if what == 'me':
+            return InputPeerSelf()
+        raise ValueError(f"Could not find the input entity for {what!r}")
+    async def send_message(self, peer, msg, reply_to=None):
+        self.sent.append((peer, msg, reply_to))
+
+class _PeerEvent:
+    chat_id = get_peer_id(chats[1])       # id "marcado", como no evento do Telethon
+    message = type('Message', (), {'id': 77})()
+    async def reply(self, msg):
+        raise AssertionError("event.reply() resolveria a entidade")
+
+async def _send_warm():
+    peers, client = PeerCache(), _PeerClient()
+    rows = await peers.warm(client, [chats[1], -100555], names=['me'])
+    sched = SendScheduler(client, peers=peers, metrics=StageHistograms())
+    sched.submit(_PeerEvent(), "25,00", 'reply')
+    await sched.join()
+    sched.close()
+    return rows, client, peers
+
+rows, peer_client, peers = asyncio.run(_send_warm())
+# canal vem da entidade já resolvida (offline); -100555 não está na sessão: erro no self-check
+if ([r['error'] is None for r in rows] == [True, False, True] and peer_client.lookups == [-100555, 'me']
+        and peer_client.sent == [(InputPeerChannel(chats[1].id, chats[1].access_hash), "25,00", 77)]
+        and isinstance(peers.get('me'), InputPeerSelf)):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ peers aquecidos {rows} {peer_client.lookups} {peer_client.sent}{RESET}")
+print(f"peers aquecidos: {peers.stats()}")
+
+# ── latência oferta → resposta no send_result ────────────────────────────────
+async def _run_latency(text):
+    log = []
+    ev = _AccountEvent(-100, text, log, None)
+    ev.message = type('Message', (), {'id': 5, 'date': datetime.fromtimestamp(time.time() - 3, timezone.utc)})()
+    handler = monitor.make_handler(None, RULES, {}, dry_run=False, send_delay_seconds=0.05,
+                                   whatsapp_relay_enabled=False)
+    await handler(ev)
+    for _ in range(30):
+        await asyncio.sleep(0.01)
+
+_events_path, _state_path = monitor.EVENTS_LOG_PATH, monitor.STATE_PATH
+with tempfile.TemporaryDirectory() as tmp:
+    monitor.EVENTS_LOG_PATH = os.path.join(tmp, 'events.jsonl')
+    monitor.STATE_PATH = os.path.join(tmp, 'state.json')
+    try:
+        asyncio.run(_run_latency(next(msg for msg, exp in cases if exp)))
+        with open(monitor.EVENTS_LOG_PATH, encoding='utf-8') as f:
+            result = [r for r in map(json.loads, f) if r['kind'] == 'send_result']
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            monitor.print_latency_stats(monitor.EVENTS_LOG_PATH)
+    finally:
+        monitor.EVENTS_LOG_PATH, monitor.STATE_PATH = _events_path, _state_path
+lat = result[0] if result else {}
+# mensagem de 3s atrás + 50ms de SEND_DELAY
+if (len(result) == 1 and 3000 <= lat.get('e2e_ms', 0) < 4000 and 40 <= lat.get('delay_ms', 0) < 200
+        and 'Por grupo (sem SEND_DELAY)' in out.getvalue() and lat['program'] in out.getvalue()):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ latência {result}{RESET}")
+print(f"latência: e2e={lat.get('e2e_ms')}ms delay={lat.get('delay_ms')}ms reply={lat.get('reply_ms')}ms")
+
+# ── filtro de updates crus: só vira evento o que é de um grupo monitorado ────
+from telethon import TelegramClient, events
+from telethon.sessions import MemorySession
+from telethon.tl.types import (UpdateNewChannelMessage, UpdateShortChatMessage, UpdateChannel,
+                               Message, MessageService, MessageActionPinMessage, PeerChannel, PeerUser)
+
+def _raw_updates():
+    now = datetime.now(timezone.utc)
+    msg = lambda ch, i, text: UpdateNewChannelMessage(
+        Message(id=i, peer_id=PeerChannel(ch), date=now, message=text, from_id=PeerUser(5)), pts=i, pts_count=1)
+    out = [msg(2, 1, "compro 90k latam"), msg(9, 2, "de outro grupo"),
+           UpdateShortChatMessage(id=3, from_id=5, chat_id=7, message="grupo básico", pts=3, pts_count=1, date=now),
+           UpdateNewChannelMessage(MessageService(id=4, peer_id=PeerChannel(2), date=now,
+                                                  action=MessageActionPinMessage()), pts=4, pts_count=1),
+           UpdateChannel(channel_id=2)]
+    for u in out:
+        u._entities = {}
+    return out
+
+async def _run_raw_filter():
+    client = TelegramClient(MemorySession(), 1, 'teste')
+    client._mb_entity_cache.set_self_user(1, False, 1)
+    got = []
+    async def handler(ev):
+        got.append((ev.chat_id, ev.raw_text))
+    raw = RawTargetFilter(client, handler, target_peer_ids([chats[1], -7]))
+    client.add_event_handler(raw, events.Raw(types=RawTargetFilter.UPDATE_TYPES))
+    for u in _raw_updates():
+        await client._dispatch_update(u)
+    return got, raw.stats()
+
+got, raw_stats = asyncio.run(_run_raw_filter())
+# UpdateChannel nem chega ao filtro (tipo); mensagem de serviço é vista e descartada
+if (got == [(get_peer_id(chats[1]), "compro 90k latam"), (-7, "grupo básico")]
+        and raw_stats == {'seen': 4, 'accepted': 2, 'dropped': 2}
+        and target_peer_ids([5]) == {5, -5, -1000000000005}):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ filtro de updates {got} {raw_stats}{RESET}")
+print(f"filtro de updates: {raw_stats}")
+
+# ── dedupe em diário: snapshot + journal, compactação sem perder chave ───────
+k = [dedupe_key(f"oferta {i}") for i in range(5)]
+with tempfile.TemporaryDirectory() as tmp:
+    state_path = os.path.join(tmp, 'state.json')
+    store = DedupeStore(state_path, compact_every=2)
+    for i in range(3):
+        store.record(k[i], i)
+    due = store.due()
+    reloaded = list(DedupeStore(state_path).seen)                # só o journal existe
+    asyncio.run(store.compact_async())
+    after_compact = (os.path.exists(store.journal_path), list(DedupeStore(state_path).seen))
+    # compactação interrompida: journal.1 ficou para trás e o journal novo já tem registros
+    store.record(k[3], 3)
+    store._rotate()
+    store.record(k[4], 4)
+    crashed = DedupeStore(state_path)
+if (due and reloaded == [(k[0], 0), (k[1], 1), (k[2], 2)] and after_compact == (False, reloaded)
+        and [key for key, _ in crashed.seen] == k and k[1] in crashed.seen):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ dedupe em diário {reloaded} {after_compact} {list(crashed.seen)}{RESET}")
+print(f"dedupe em diário: {len(crashed.seen)} chaves recuperadas após compactação interrompida")
+
+# ── dedupe compacto: digest de 16 bytes, state.json antigo convertido ────────
+legacy = {sha: {'ts': ts, 'program': 'LATAM', 'text': 'oferta'} for sha, ts in
+          ((monitor.sha1("LATAM|1|b"), 20), (monitor.sha1("LATAM|1|a"), 10))}
+with tempfile.TemporaryDirectory() as tmp:
+    state_path = os.path.join(tmp, 'state.json')
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump({'seen': legacy}, f)
+    store = DedupeStore(state_path)
+    converted = list(store.seen)
+    store.compact()
+    with open(state_path, encoding='utf-8') as f:
+        fmt = json.load(f)['seen']['format']
+    repacked = list(DedupeStore(state_path).seen)
+if (converted == [(dedupe_key("LATAM|1|a"), 10), (dedupe_key("LATAM|1|b"), 20)] and repacked == converted
+        and fmt == 'digest16' and len(converted[0][0]) == 16 and dedupe_key("LATAM|1|c") not in store.seen):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ dedupe compacto {converted} {repacked} {fmt}{RESET}")
+
+# ── dedupe com TTL: chaves velhas saem em ordem de tempo, sem varrer o set ───
+with tempfile.TemporaryDirectory() as tmp:
+    state_path = os.path.join(tmp, 'state.json')
+    now = int(time.time())
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump({'seen': {monitor.sha1("velha"): {'ts': now - 7200}, monitor.sha1("nova"): {'ts': now - 60}}}, f)
+    store = DedupeStore(state_path, ttl=3600)
+    on_load = [key for key, _ in store.seen]
+    store.record(dedupe_key("k"), now)
+    gone = store.seen.expire(now + 3600)                            # "nova" passou do TTL, "k" não
+    store.compact()
+    snapshot = [key for key, _ in DedupeStore(state_path).seen]
+    forever = SeenSet()
+    forever.add(dedupe_key("velha"), 0)
+if (on_load == [dedupe_key("nova")] and gone == 1 and snapshot == [dedupe_key("k")] and store.seen.expired == 2
+        and forever.expire() == 0 and len(forever) == 1):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ dedupe TTL {on_load} {gone} {snapshot} {store.seen.expired}{RESET}")
+print(f"dedupe TTL: {store.seen.expired} chaves expiradas, {len(snapshot)} no snapshot")
+
+# ── sqlite: migração de state.json/events.jsonl e escritor único em lote ─────
+with tempfile.TemporaryDirectory() as tmp:
+    state_path, events_path, db_path = (os.path.join(tmp, n) for n in ('state.json', 'events.jsonl', 'milhas.db'))
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump({'seen': {monitor.sha1("k0"): {'ts': 10, 'program': 'LATAM'}}, 'last_ids': {"-100": 7}}, f)
+    with open(events_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'ts': 10, 'kind': 'eligible', 'chat_id': -100, 'program': 'LATAM'}) + '\n')
+        f.write(json.dumps({'ts': 20, 'kind': 'skipped', 'chat_id': -200, 'program': 'SMILES'}) + '\n')
+    first = migrate_to_sqlite(db_path, state_path, events_path)
+    again = migrate_to_sqlite(db_path, state_path, events_path)    # nada novo para importar
+    store = SqliteStore(db_path)
+    loaded = ([key for key, _ in store.seen], dict(store.state['last_ids']))
+    store.record(dedupe_key("k1"), 30)
+    store.state['last_ids']["-200"] = 9
+    monitor.EVENT_STORE = store
+    try:
+        monitor.append_event_log({'ts': 30, 'kind': 'eligible', 'chat_id': -200, 'program': 'SMILES'})
+    finally:
+        monitor.EVENT_STORE = None
+    store.close()
+    reopened = SqliteStore(db_path)
+    reopened.close()
+    by_chat = [e['ts'] for e in query_events(db_path, chat_id=-200)]
+    by_range = [e['kind'] for e in query_events(db_path, since=15, until=30)]
+if (first == {'seen': 1, 'events': 2, 'invalid': 0} and again == {'seen': 0, 'events': 0, 'invalid': 0}
+        and loaded == ([dedupe_key("k0")], {"-100": 7}) and list(reopened.seen) == [(dedupe_key("k0"), 10), (dedupe_key("k1"), 30)]
+        and reopened.state['last_ids'] == {"-100": 7, "-200": 9} and by_chat == [20, 30] and by_range == ['skipped']):
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ sqlite {first} {again} {loaded} {list(reopened.seen)} {reopened.state['last_ids']} {by_chat} {by_range}{RESET}")
+print(f"sqlite: {first['seen']} chave e {first['events']} eventos migrados, {store.stats()['batches']} lotes gravados")
+
+# ── quase duplicadas: repost com emoji, outro preço ou frases trocadas ────────
+base = "Compro LATAM 94.200 milhas\n2 CPFs\nPago 15,00 o milheiro\nChama no PV"
+reposts = [
+    base + " 🔥🔥",                                                  # emoji a mais
+    base.replace("15,00", "16,50"),                                  # linha de preço mudou
+    "Chama no PV\nPago 15,00 o milheiro\nCompro LATAM 94.200 milhas\n2 CPFs",  # frases trocadas
+]
+others = [
+    ((-100, 7, 'LATAM', 94200, 2), "preciso de latam 94200 pra 2 cpf, quem tiver me chama"),  # outro texto
+    ((-100, 7, 'LATAM', 50000, 2), base.replace("94.200", "50.000")),                          # outro lote
+    ((-100, 8, 'LATAM', 94200, 2), base),                                                      # outro comprador
+]
+idx = NearDupIndex(threshold=0.7, window=3600)
+scope = (-100, 7, 'LATAM', 94200, 2)
+first = idx.claim(scope, norm_text(base), 1000)
+near = [idx.claim(scope, norm_text(t), 1010) for t in reposts]
+far = [idx.claim(sc, norm_text(t), 1020) for sc, t in others]
+late = idx.claim(scope, norm_text(reposts[0]), 1000 + 3601 + 60)        # fora da janela
+if first is None and all(s is not None and s >= 0.7 for s in near) and far == [None] * 3 and late is None:
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ quase duplicadas {first} {near} {far} {late}{RESET}")
+print(f"quase duplicadas: {idx.stats()}")
+# NEAR_DUP_WINDOW_MINUTES vazio é o padrão (60 min); só "0" desliga
+_window = os.environ.get('NEAR_DUP_WINDOW_MINUTES')
+try:
+    os.environ['NEAR_DUP_WINDOW_MINUTES'] = ''
+    empty_window = monitor.near_dup_options_from_env()['window']
+    os.environ['NEAR_DUP_WINDOW_MINUTES'] = '0'
+    zero_window = monitor.near_dup_options_from_env()['window']
+finally:
+    if _window is None:
+        os.environ.pop('NEAR_DUP_WINDOW_MINUTES', None)
+    else:
+        os.environ['NEAR_DUP_WINDOW_MINUTES'] = _window
+if empty_window == 3600 and zero_window == 0:
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ NEAR_DUP_WINDOW_MINUTES vazio={empty_window} zero={zero_window}{RESET}")
+# no replay: o mesmo comprador reposta com emoji, outro preço e frases trocadas → uma resposta;
+# a janela vale pela data do export: o repost de 2h depois é respondido de novo
+msgs = ["compro 100k latam 2 cpf 14,00", "compro 100k latam 2 cpf 14,00 🔥", "compro 100k latam 2 cpf 15,00",
+        "latam 2 cpf 100k compro", "compro 110k latam 2 cpf", "compro 100k latam 2 cpf 14,00 🔥🔥"]
+dates = ["2026-01-01T10:00:00", "2026-01-01T10:05:00", "2026-01-01T10:20:00",
+         "2026-01-01T10:40:00", "2026-01-01T10:45:00", "2026-01-01T12:00:00"]
+export = {"name": "Grupo Teste", "type": "private_supergroup", "id": 43, "messages": [
+    {"id": i, "type": "message", "date": d, "from": "Fulano", "from_id": "user7", "text": m}
+    for i, (m, d) in enumerate(zip(msgs, dates), start=1)]}
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'result.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(export, f)
+    with contextlib.redirect_stdout(io.StringIO()):
+        plain = asyncio.run(replay(path, RULES))
+        near_dedup = asyncio.run(replay(path, RULES, near_dups=NearDupIndex(threshold=0.7, window=3600)))
+got = [ev.raw_text for ev, _, _ in near_dedup]
+if len(plain) == 6 and got == [msgs[0], msgs[4], msgs[5]]:
+    ok += 1
+else:
+    err += 1
+    print(f"{VERM}✗ replay quase duplicadas {len(plain)} {got}{RESET}")
+
+# ── replay: mesmo handler do monitor sobre um export do Telegram Desktop ─────
+export = {"name": "Grupo Teste", "type": "private_supergroup", "id": 42, "messages": [
+    {"id": i, "type": "message", "date": "2026-01-01T10:00:00", "from": "Teste", "text": msg}
+    for i, (msg, _) in enumerate(cases + [(cases[0][0], None)], start=1)  # última = repost (dedupe)
+]}
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'result.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(export, f)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sent = asyncio.run(replay(path, RULES))
+        # reply-first: mesmas respostas, metadados/logs depois do envio
+        sent_fast = asyncio.run(replay(path, RULES, reply_first=True))
+        # SEND_MODE=plain: o envio sai depois, na fila; cada resposta tem que ficar com a sua mensagem
+        sent_plain = asyncio.run(replay(path, RULES, send_mode='plain'))
+want = [(msg, exp) for msg, exp in cases if exp]
+for mode, result in (("replay", sent), ("replay reply-first", sent_fast), ("replay plain", sent_plain)):
+    got = [(ev.raw_text, msg) for ev, msg, _ in result]
+    if got == want:
+        ok += 1
+    else:
+        err += 1
+        print(f"{VERM}✗ {mode} {got} != {want}{RESET}")
+if {via for _, _, via in sent_plain} != {'plain'}:
+    err += 1
+    print(f"{VERM}✗ replay plain {[via for _, _, via in sent_plain]}{RESET}")
+print(f"replay: {len(sent)} respostas em {len(export['messages'])} mensagens")
+
 print(f"\n{'─'*72}")
 print(f"Resultado: {ok} OK  |  {err} FALHAS")
 if err: